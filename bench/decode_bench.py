@@ -0,0 +1,67 @@
+"""Parse time and allocations per response: SimpleNamespace object_hook decoding vs the models layer.
+
+Run from the repository root: python -m bench.decode_bench [iterations]
+"""
+from types import SimpleNamespace
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import models
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixture(name) -> str:
+    with open(os.path.join(FIXTURES, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def namespace(text):
+    return json.loads(text, object_hook=lambda d: SimpleNamespace(**d))
+
+
+def homework_old(text):
+    # what meshapi.homework did per entry before: json.loads of the whole payload and of every embedded data field
+    return [json.loads(entry['homework_entry']['data'])['materialObj'] for entry in json.loads(text)]
+
+
+def homework_new(text):
+    return [models.homework_materials(entry) for entry in models.loads(text)]
+
+
+def measure(func, text, iterations) -> tuple[float, int, int]:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(text)
+    elapsed = (time.perf_counter() - start) / iterations * 1e6
+
+    tracemalloc.start()
+    result = func(text)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return elapsed, peak, retained
+
+
+def main(iterations=2000) -> None:
+    cases = [
+        ('schedule', fixture('schedule.json'), namespace, models.ScheduleDay.from_json),
+        ('profile', fixture('profile.json'), namespace, models.Profile.from_json),
+        ('homework', fixture('student_homeworks.json'), homework_old, homework_new),
+        ('marks', fixture('progress.json'), json.loads, models.progress)
+    ]
+
+    print(f'json backend: {models.loads.__module__}')
+    print(f'{"payload":<10} {"decoder":<10} {"us/response":>12} {"peak KiB":>10} {"kept KiB":>10}')
+    for name, text, old, new in cases:
+        for label, func in (('before', old), ('models', new)):
+            elapsed, peak, retained = measure(func, text, iterations)
+            print(f'{name:<10} {label:<10} {elapsed:>12.1f} {peak / 1024:>10.1f} {retained / 1024:>10.1f}')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
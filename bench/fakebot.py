@@ -0,0 +1,41 @@
+import asyncio
+import itertools
+
+
+class FakeMessage():
+    __slots__ = ('chat_id', 'id', 'text')
+
+    def __init__(self, chat_id, id, text) -> None:
+        self.chat_id = chat_id
+        self.id = id
+        self.text = text
+
+
+class FakeBot():
+    """Records the Bot calls the handlers make instead of talking to Telegram; `latency` simulates the API round trip."""
+
+    def __init__(self, latency=0.0) -> None:
+        self.latency = latency
+        self.ids = itertools.count(1)
+        self.calls = []
+
+    async def call(self, method, chat_id, text=None):
+        self.calls.append((method, chat_id, len(text) if text else 0))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs) -> FakeMessage:
+        await self.call('send_message', chat_id, text)
+        return FakeMessage(chat_id, next(self.ids), text)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs) -> FakeMessage:
+        await self.call('edit_message_text', chat_id, text)
+        return FakeMessage(chat_id, message_id, text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs) -> bool:
+        await self.call('delete_message', chat_id)
+        return True
+
+    async def send_document(self, chat_id, document, **kwargs) -> FakeMessage:
+        await self.call('send_document', chat_id)
+        return FakeMessage(chat_id, next(self.ids), None)
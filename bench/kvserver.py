@@ -0,0 +1,125 @@
+"""Local stand-in for Redis: the subset of commands shared.RedisBackend uses, over the same protocol.
+
+Run from the repository root: python -m bench.kvserver [port]
+"""
+import asyncio
+import sys
+
+import shared
+
+
+def reply(value) -> bytes:
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        return b'+OK\r\n' if value else b'$-1\r\n'
+    if isinstance(value, int):
+        return f':{value}\r\n'.encode()
+    if isinstance(value, list):
+        return f'*{len(value)}\r\n'.encode() + b''.join(reply(x) for x in value)
+    data = value.encode()
+    return f'${len(data)}\r\n'.encode() + data + b'\r\n'
+
+
+async def read_command(reader: asyncio.StreamReader) -> list:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # inline command, like redis-cli sends when typed by hand
+        return line.decode().split()
+    args = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2].decode())
+    return args
+
+
+class KVServer():
+    def __init__(self, host='127.0.0.1', port=0) -> None:
+        self.host = host
+        self.port = port
+        # MemoryBackend never awaits inside a method, so commands run one at a time like in Redis
+        self.store = shared.MemoryBackend()
+        self.server: asyncio.Server = None
+        self.connections = 0
+        self.commands = 0
+
+    async def execute(self, args) -> bytes:
+        store = self.store
+        name, args = args[0].upper(), args[1:]
+        match name:
+            case 'PING':
+                return b'+PONG\r\n'
+            case 'AUTH' | 'SELECT':
+                return b'+OK\r\n'
+            case 'GET':
+                return reply(await store.get(args[0]))
+            case 'MGET':
+                return reply(await store.get_many(args))
+            case 'SET':
+                key, value, options = args[0], args[1], [x.upper() for x in args[2:]]
+                ttl = None
+                if 'EX' in options:
+                    ttl = int(args[2 + options.index('EX') + 1])
+                if 'PX' in options:
+                    ttl = int(args[2 + options.index('PX') + 1]) / 1000
+                if 'NX' in options:
+                    return reply(await store.add(key, value, ttl))
+                await store.set(key, value, ttl)
+                return b'+OK\r\n'
+            case 'DEL':
+                count = 0
+                for key in args:
+                    count += await store.get(key) is not None
+                    await store.delete(key)
+                return reply(count)
+            case 'SADD':
+                for member in args[1:]:
+                    await store.set_add(args[0], member)
+                return reply(len(args) - 1)
+            case 'SREM':
+                for member in args[1:]:
+                    await store.set_remove(args[0], member)
+                return reply(len(args) - 1)
+            case 'SMEMBERS':
+                return reply(await store.members(args[0]))
+        return f'-ERR unknown command {name}\r\n'.encode()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    return
+                if not args:
+                    continue
+                self.commands += 1
+                writer.write(await self.execute(args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self) -> 'KVServer':
+        """Serves on the running loop; port 0 picks a free one, read it back from .port."""
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+async def serve(port) -> None:
+    server = await KVServer(port=port).start()
+    print(f'Listening on 127.0.0.1:{server.port}')
+    await server.server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(int(sys.argv[1]) if len(sys.argv) > 1 else 6379))
@@ -0,0 +1,36 @@
+"""POSTs recorded Update JSON to a running webhook server, the way Telegram does.
+
+Run from the repository root, e.g.:
+    python -m bench.post_update --secret <secret_token> bench/fixtures/updates/*.json
+"""
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import aiohttp
+
+from webhook import SECRET_HEADER
+
+
+async def main_async(args) -> None:
+    async with aiohttp.ClientSession() as session:
+        for path in args.files:
+            with open(path, 'rb') as f:
+                body = f.read()
+            async with session.post(args.url, data=body, headers={SECRET_HEADER: args.secret, 'Content-Type': 'application/json'}) as response:
+                print(f'{path}: {response.status}')
+        base = urlsplit(args.url)
+        for endpoint in ('/healthz', '/readyz'):
+            async with session.get(f'{base.scheme}://{base.netloc}{endpoint}') as response:
+                print(f'{endpoint}: {response.status} {await response.text()}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='Update JSON files')
+    parser.add_argument('--url', default='http://127.0.0.1:8080/telegram', help='webhook url')
+    parser.add_argument('--secret', required=True, help='secret_token from env.json')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main_async(parse_args()))
@@ -0,0 +1,133 @@
+"""Offline scenarios: the real meshapi functions and main.py handlers against the stub server and a fake Bot.
+
+Run from the repository root, e.g.:
+    python -m bench.scenarios --chats 50 --rounds 5 --latency 0.05 --jitter 0.05 --errors 0.01
+"""
+from datetime import datetime
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import main
+import meshapi
+import shared
+import storage
+from bench.fakebot import FakeBot, FakeMessage
+from bench.kvserver import KVServer
+from bench.stub import Stub, start_stub
+
+DATE1 = datetime(2024, 2, 1)
+DATE2 = datetime(2024, 2, 7)
+
+SCENARIOS = {
+    'meshapi.schedule': lambda msg, bot: meshapi.schedule(str(msg.chat_id), DATE1, DATE2),
+    'meshapi.homework': lambda msg, bot: meshapi.homework(str(msg.chat_id), DATE1, DATE2),
+    'profile': lambda msg, bot: main.profile(msg, bot),
+    'schedule': lambda msg, bot: main.schedule(msg, bot, DATE1, DATE2),
+    'homework': lambda msg, bot: main.homework(msg, bot, DATE1, DATE2),
+    'marksdate': lambda msg, bot: main.marksdate(msg, bot, DATE1, DATE2),
+    'marks': lambda msg, bot: main.marks(msg, bot),
+    'notifications': lambda msg, bot: main.notifications(msg, bot)
+}
+
+
+def percentile(values, p) -> float:
+    values = sorted(values)
+    return values[max(0, int(round(p * len(values) + 0.5)) - 1)] if values else 0.0
+
+
+async def add_users(chats) -> None:
+    for chat_id in range(1, chats + 1):
+        await meshapi.db.set(str(chat_id), {'token': f'token-{chat_id}', 'student_id': str(1000000 + chat_id)})
+
+
+def reset_caches() -> None:
+    meshapi.response_cache.clear()
+    if isinstance(meshapi.db.storage, storage.MemoryStorage):
+        meshapi.db.storage.values.clear()
+
+
+async def run(name, func, chats, rounds, cold) -> dict:
+    bot = FakeBot()
+    latencies = []
+
+    async def chat(chat_id):
+        for _ in range(rounds):
+            if cold:
+                reset_caches()
+            msg = FakeMessage(chat_id, 1, 'Загрузка...')
+            started = time.perf_counter()
+            await func(msg, bot)
+            latencies.append(time.perf_counter() - started)
+
+    reset_caches()
+    started = time.perf_counter()
+    await asyncio.gather(*[chat(chat_id) for chat_id in range(1, chats + 1)])
+    wall = time.perf_counter() - started
+
+    return {
+        'name': name,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'throughput': len(latencies) / wall,
+        'sends': len(bot.calls)
+    }
+
+
+async def main_async(args) -> None:
+    stub = Stub(args.latency, args.jitter, args.errors)
+    runner, base = await start_stub(stub=stub)
+    meshapi.SCHOOL_URL = meshapi.DNEVNIK_URL = base
+    meshapi.REFDATA_PATH = os.path.join(tempfile.mkdtemp(), 'refdata.json')
+    if args.shared:
+        # users and responses go through the stand-in KV server, as with several workers
+        kv = await KVServer().start()
+        meshapi.use_shared(shared.RedisBackend(port=kv.port))
+    await meshapi.start()
+    await add_users(args.chats)
+
+    if args.memory:
+        tracemalloc.start()
+
+    names = args.only or list(SCENARIOS)
+    print(f'{args.chats} chats x {args.rounds} rounds, latency {args.latency}s+{args.jitter}s, errors {args.errors:.0%}'
+          f'{", cold caches" if args.cold else ""}{", shared state" if args.shared else ""}')
+    print(f'{"scenario":<18} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"req/s":>8} {"sends":>7} {"peak MiB":>9}')
+    try:
+        for name in names:
+            if args.memory:
+                tracemalloc.reset_peak()
+            res = await run(name, SCENARIOS[name], args.chats, args.rounds, args.cold)
+            peak = f'{tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f}' if args.memory else '-'
+            print(f'{res["name"]:<18} {res["p50"]:>8.1f} {res["p95"]:>8.1f} {res["p99"]:>8.1f} {res["throughput"]:>8.1f} {res["sends"]:>7} {peak:>9}')
+    finally:
+        await meshapi.stop()
+        await runner.cleanup()
+        if args.shared:
+            await kv.stop()
+
+    print(f'upstream requests: {stub.requests} ({stub.errors} errors), cache: {meshapi.response_cache.stats()}')
+    print(f'max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=50, help='concurrent chats')
+    parser.add_argument('--rounds', type=int, default=5, help='requests per chat and scenario')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub response delay, seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='extra random delay, seconds')
+    parser.add_argument('--errors', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--cold', action='store_true', help='clear caches before every request')
+    parser.add_argument('--memory', action='store_true', help='trace allocations (slower)')
+    parser.add_argument('--shared', action='store_true', help='keep users and caches in a local KV server')
+    parser.add_argument('--only', nargs='*', choices=list(SCENARIOS), help='scenarios to run')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main_async(parse_args()))
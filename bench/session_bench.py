@@ -0,0 +1,59 @@
+"""Per-request latency of async_request: a new ClientSession per call vs the shared meshapi session.
+
+Run from the repository root: python -m bench.session_bench [rounds] [urls_per_round]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+import meshapi
+from bench.stub import start_stub
+
+
+async def async_request_per_call(urls):
+    # what async_request did before the shared session
+    async with aiohttp.ClientSession() as session:
+        async def get(url):
+            async with session.get(url) as response:
+                return await response.text(), response.status
+        return await asyncio.gather(*[get(url) for url in urls])
+
+
+async def measure(func, urls, rounds) -> list[float]:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await func(urls)
+        timings.append((time.perf_counter() - start) / len(urls) * 1000)
+    return timings
+
+
+def report(name, timings) -> None:
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f'{name:<12} mean {statistics.mean(timings):.3f} ms/request, p50 {statistics.median(timings):.3f}, p95 {p95:.3f}')
+
+
+async def main(rounds=200, per_round=7) -> None:
+    runner, base = await start_stub()
+    # meshapi.start() loads the academic years, from the stub and into a throwaway refdata.json
+    meshapi.SCHOOL_URL = meshapi.DNEVNIK_URL = base
+    meshapi.REFDATA_PATH = os.path.join(tempfile.mkdtemp(), 'refdata.json')
+    await meshapi.start()
+
+    urls = [f'{base}/api/family/mobile/v1/schedule/?date={i}' for i in range(per_round)]
+    try:
+        report('per-call', await measure(async_request_per_call, urls, rounds))
+        report('shared', await measure(meshapi.async_request, urls, rounds))
+    finally:
+        await meshapi.stop()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*[int(x) for x in sys.argv[1:]]))
@@ -0,0 +1,73 @@
+from aiohttp import web
+import asyncio
+import json
+import os
+import random
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# path -> recorded response replayed for it
+ROUTES = {
+    '/api/family/mobile/v1/profile': 'profile.json',
+    '/api/family/mobile/v1/schedule/': 'schedule.json',
+    '/api/family/mobile/v1/notifications/search': 'notifications.json',
+    '/core/api/student_homeworks': 'student_homeworks.json',
+    '/core/api/marks': 'marks.json',
+    '/core/api/subjects': 'subjects.json',
+    '/core/api/academic_years': 'academic_years.json',
+    '/reports/api/progress/json': 'progress.json'
+}
+
+
+def fixture(name) -> str:
+    with open(os.path.join(FIXTURES, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+class Stub():
+    """Local stand-in for school.mos.ru and dnevnik.mos.ru that replays the recorded fixtures.
+
+    Every response is delayed by `latency` seconds (plus up to `jitter`), and `error_rate` of them are 503s.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.fixtures = {path: fixture(name) for path, name in ROUTES.items()}
+        self.schedule = json.loads(self.fixtures['/api/family/mobile/v1/schedule/'])
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503)
+
+        path = request.path
+        if path == '/api/family/mobile/v1/schedule/':
+            return web.json_response({**self.schedule, 'date': request.query.get('date', self.schedule['date'])})
+        if path == '/api/ej/partners/v1/homeworks/launch':
+            return web.Response(text=f'https://example.com/launch/{request.query.get("material_id")}')
+        if path == '/lms/api/sessions':
+            return web.json_response({'profiles': [{'id': 1234567}], 'last_name': 'Петров', 'first_name': 'Пётр', 'middle_name': 'Иванович'})
+        if path in self.fixtures:
+            return web.Response(text=self.fixtures[path], content_type='application/json')
+        return web.Response(text='{"ok": true}', content_type='application/json')
+
+
+async def start_stub(host='127.0.0.1', port=0, stub: Stub = None) -> tuple[web.AppRunner, str]:
+    stub = stub or Stub()
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', stub.handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    port = runner.addresses[0][1]
+    return runner, f'http://{host}:{port}'
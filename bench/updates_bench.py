@@ -0,0 +1,108 @@
+"""Update processing with many chats: one update at a time (PTB's default), PTB's SimpleUpdateProcessor and the
+per-chat ordered processor.ChatProcessor, each feeding main.homework against the stub server.
+
+Run from the repository root: python -m bench.updates_bench --chats 100 --updates 3
+"""
+from datetime import datetime
+from types import SimpleNamespace
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from telegram.ext import SimpleUpdateProcessor
+
+import main
+import meshapi
+import processor
+from bench.fakebot import FakeBot, FakeMessage
+from bench.scenarios import add_users, percentile, reset_caches
+from bench.stub import Stub, start_stub
+
+DATE1 = datetime(2024, 2, 1)
+DATE2 = datetime(2024, 2, 7)
+
+
+async def feed(update_processor, updates, bot) -> dict:
+    latencies = []
+    order = {}  # chat_id -> sequence numbers in the order their handlers started
+    running = set()
+    overlaps = 0
+
+    # the whole burst arrives at once, so latency includes the time an update waited for its turn
+    async def handle(update, seq):
+        nonlocal overlaps
+        chat_id = update.effective_chat.id
+        if chat_id in running:
+            overlaps += 1
+        running.add(chat_id)
+        order.setdefault(chat_id, []).append(seq)
+        try:
+            await main.homework(FakeMessage(chat_id, 1, 'Загрузка...'), bot, DATE1, DATE2)
+        finally:
+            running.discard(chat_id)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    if update_processor is None:
+        for seq, update in enumerate(updates):
+            await handle(update, seq)
+    else:
+        # what Application._update_fetcher does with max_concurrent_updates > 1: a task per update
+        await asyncio.gather(*[update_processor.process_update(update, handle(update, seq))
+                               for seq, update in enumerate(updates)])
+    wall = time.perf_counter() - started
+
+    return {
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'throughput': len(latencies) / wall,
+        'handled': len(latencies),
+        'reordered': sum(seqs != sorted(seqs) for seqs in order.values()),
+        'overlaps': overlaps
+    }
+
+
+async def main_async(args) -> None:
+    stub = Stub(args.latency, args.jitter)
+    runner, base = await start_stub(stub=stub)
+    meshapi.SCHOOL_URL = meshapi.DNEVNIK_URL = base
+    meshapi.REFDATA_PATH = os.path.join(tempfile.mkdtemp(), 'refdata.json')
+    await meshapi.start()
+    await add_users(args.chats)
+
+    # round-robin over chats, like presses arriving from many people at once
+    updates = [SimpleNamespace(effective_chat=SimpleNamespace(id=str(chat_id)))
+               for _ in range(args.updates) for chat_id in range(1, args.chats + 1)]
+    modes = [
+        ('sequential', lambda: None),
+        ('simple', lambda: SimpleUpdateProcessor(args.concurrency)),
+        ('chat-ordered', lambda: processor.ChatProcessor(args.concurrency))
+    ]
+
+    print(f'{args.chats} chats x {args.updates} updates, concurrency {args.concurrency}, latency {args.latency}s+{args.jitter}s')
+    print(f'{"processor":<14} {"p50 ms":>8} {"p95 ms":>8} {"upd/s":>8} {"handled":>8} {"reordered":>10} {"overlaps":>9}')
+    try:
+        for name, factory in modes:
+            reset_caches()
+            res = await feed(factory(), updates, FakeBot())
+            print(f'{name:<14} {res["p50"]:>8.1f} {res["p95"]:>8.1f} {res["throughput"]:>8.1f} {res["handled"]:>8} '
+                  f'{res["reordered"]:>10} {res["overlaps"]:>9}')
+    finally:
+        await meshapi.stop()
+        await runner.cleanup()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=100, help='simulated chats')
+    parser.add_argument('--updates', type=int, default=3, help='updates per chat')
+    parser.add_argument('--concurrency', type=int, default=32, help='global cap for the concurrent processors')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub response delay, seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='extra random delay, seconds')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main_async(parse_args()))
@@ -0,0 +1,88 @@
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# consecutive failures that open a circuit; a response slower than SLOW counts as a failure
+FAILURES = 5
+SLOW = 8.0
+OPEN_FOR = 30
+PROBES = 1
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Breaker():
+    """Circuit breaker for one upstream endpoint.
+
+    Closed: requests go through, FAILURES failures in a row open it.
+    Open: requests fail at once, for OPEN_FOR seconds.
+    Half-open: up to PROBES requests go through; a success closes the circuit, a failure opens it again.
+    """
+
+    __slots__ = ('failures', 'slow', 'open_for', 'probes', 'state', 'failed', 'opened_at', 'probing', 'opened')
+
+    def __init__(self, failures=FAILURES, slow=SLOW, open_for=OPEN_FOR, probes=PROBES) -> None:
+        self.failures = failures
+        self.slow = slow
+        self.open_for = open_for
+        self.probes = probes
+        self.state = CLOSED
+        self.failed = 0
+        self.opened_at = 0
+        self.probing = 0
+        self.opened = 0
+
+    def allow(self) -> bool:
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_for:
+                return False
+            self.state = HALF_OPEN
+            self.probing = 0
+
+        if self.state == HALF_OPEN:
+            if self.probing >= self.probes:
+                return False
+            self.probing += 1
+
+        return True
+
+    def success(self, latency) -> None:
+        if latency > self.slow:
+            self.failure()
+            return
+        self.state = CLOSED
+        self.failed = 0
+
+    def cancel(self) -> None:
+        # a probe that was cancelled says nothing about the upstream, let another one go
+        if self.state == HALF_OPEN and self.probing > 0:
+            self.probing -= 1
+
+    def failure(self) -> None:
+        self.failed += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failed >= self.failures):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.opened += 1
+
+
+class Breakers():
+    """One Breaker per endpoint, created on first use with the same settings."""
+
+    def __init__(self, **settings) -> None:
+        self.settings = settings
+        self.breakers = {}
+
+    def get(self, endpoint) -> Breaker:
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.breakers[endpoint] = Breaker(**self.settings)
+        return breaker
+
+    def stats(self) -> dict:
+        return {endpoint: STATE_CODES[breaker.state] for endpoint, breaker in self.breakers.items()}
@@ -0,0 +1,258 @@
+from collections import OrderedDict
+from functools import wraps
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import time
+
+import models
+
+MISSING = object()
+
+# how often a worker waiting on another worker's load checks for the result
+LOCK_POLL = 0.05
+
+lock_ids = itertools.count()
+
+# times (time.time()) the stale values served to the current handler were stored at, see track_stale
+stale_reads = contextvars.ContextVar('stale_reads', default=None)
+
+
+def track_stale() -> list:
+    """Starts collecting stale reads for the calling task; returns the list they are appended to.
+
+    The list is shared, not copied, with the tasks the caller starts (like asyncio.gather does), so
+    loads running in those tasks are collected too.
+    """
+    reads = []
+    stale_reads.set(reads)
+    return reads
+
+
+def size_of(value) -> int:
+    # rough, but cheap enough to run on every insert
+    if isinstance(value, str):
+        return len(value)
+    return len(repr(value))
+
+
+class Cache():
+    """TTL cache with LRU eviction under a memory cap and single-flight loading.
+
+    `scope` (a coroutine function) maps the first argument of a cached function (the chat id) to whatever identifies
+    the data owner (the student id), so chats sharing a student share entries.
+
+    With a `shared` backend (shared.Backend) loaded values are also stored there for the other workers,
+    and a lock in the backend makes only one worker at a time load a key; the rest wait for its result.
+
+    Expired entries are kept for up to `max_stale` seconds more (memory cap permitting): when a reload
+    fails, the last good value is served instead, and recorded for track_stale.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, scope=None, shared=None, lock_ttl=30, max_stale=24 * 60 * 60) -> None:
+        self.max_bytes = max_bytes
+        self.scope = scope
+        self.shared = shared
+        self.lock_ttl = lock_ttl
+        self.max_stale = max_stale
+        self.entries = OrderedDict()  # key -> (expires_at, size, value, stored_at)
+        self.inflight = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.shared_hits = 0
+        self.lock_waits = 0
+        self.prefetched = {}  # keys loaded ahead of time and not requested since
+        self.prefetches = 0
+        self.prefetch_hits = 0
+        self.stale_served = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING
+
+        expires_at, size, value, _ = entry
+        if expires_at < time.monotonic():
+            if expires_at + self.max_stale < time.monotonic():
+                self.delete(key)
+            return MISSING
+
+        self.entries.move_to_end(key)
+        return value
+
+    def get_stale(self, key):
+        """Returns (value, stored_at) of an expired entry that is still kept, or None."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] + self.max_stale < time.monotonic():
+            return None
+        return entry[2], entry[3]
+
+    def set(self, key, value, ttl) -> None:
+        self.delete(key)
+
+        size = size_of(value)
+        if size > self.max_bytes:
+            return
+
+        self.entries[key] = (time.monotonic() + ttl, size, value, time.time())
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            old_key, (_, old_size, _, _) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+            self.prefetched.pop(old_key, None)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.prefetched.clear()
+        self.bytes = 0
+
+    def delete(self, key) -> None:
+        self.prefetched.pop(key, None)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    async def load(self, key, ttl, loader, prefetch=False):
+        """Returns the cached value for key, or awaits loader() once for all concurrent callers.
+
+        None results are not cached, so failed upstream calls are retried on the next request.
+        A prefetch always reloads, so the entry gets the full (usually longer) ttl.
+        """
+        if not prefetch:
+            value = self.get(key)
+            if value is not MISSING:
+                self.hits += 1
+                if self.prefetched.pop(key, False):
+                    self.prefetch_hits += 1
+                return value
+
+        if key in self.inflight:
+            self.coalesced += 1
+            value, stored_at = await asyncio.shield(self.inflight[key])
+            if stored_at is not None:
+                self.note_stale(stored_at)
+            return value
+
+        if prefetch:
+            self.prefetches += 1
+        else:
+            self.misses += 1
+        ttl = ttl(*key[2:]) if callable(ttl) else ttl
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            if self.shared is None:
+                value = await loader()
+            else:
+                value, ttl = await self.load_shared(key, ttl, loader)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # don't warn when nobody else was waiting
+            raise
+        finally:
+            del self.inflight[key]
+
+        if value is not None:
+            self.set(key, value, ttl)
+            if prefetch:
+                self.prefetched[key] = True
+            future.set_result((value, None))
+            return value
+
+        stale = self.get_stale(key) if not prefetch else None
+        if stale is None:
+            future.set_result((None, None))
+            return None
+
+        # the reload failed, the last good value is better than nothing
+        value, stored_at = stale
+        self.note_stale(stored_at)
+        future.set_result((value, stored_at))
+        return value
+
+    def note_stale(self, stored_at) -> None:
+        self.stale_served += 1
+        reads = stale_reads.get()
+        if reads is not None:
+            reads.append(stored_at)
+
+    async def load_shared(self, key, ttl, loader):
+        """Single flight across workers; returns the value and how long it has left to live."""
+        name = 'cache:' + ':'.join(str(x) for x in key)
+        waited = False
+        deadline = time.monotonic() + self.lock_ttl
+
+        while True:
+            data = await self.shared.get(name)
+            if data is not None:
+                self.shared_hits += 1
+                entry = json.loads(data)
+                return models.from_plain(entry['value']), max(0, entry['expires_at'] - time.time())
+
+            token = f'{os.getpid()}:{next(lock_ids)}'
+            if await self.shared.add('lock:' + name, token, self.lock_ttl):
+                try:
+                    value = await loader()
+                    if value is not None and ttl > 0:
+                        await self.shared.set(name, json.dumps({'expires_at': time.time() + ttl, 'value': models.to_plain(value)},
+                                                         ensure_ascii=False), ttl)
+                finally:
+                    # after a load slower than lock_ttl the lock may be someone else's by now
+                    if await self.shared.get('lock:' + name) == token:
+                        await self.shared.delete('lock:' + name)
+                return value, ttl
+
+            if time.monotonic() > deadline:
+                # the lock holder is stuck or gone, don't wait for its lock to expire
+                return await loader(), ttl
+
+            if not waited:
+                self.lock_waits += 1
+                waited = True
+            await asyncio.sleep(LOCK_POLL)
+
+    def cached(self, endpoint, ttl):
+        """Decorator for `async def f(chat_id, *args)`; ttl is seconds or a function of *args returning seconds."""
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(chat_id, *args):
+                owner = await self.scope(chat_id) if self.scope else chat_id
+                if owner is None:
+                    return await func(chat_id, *args)
+                return await self.load((endpoint, owner, *args), ttl, lambda: func(chat_id, *args))
+
+            async def prefetch(chat_id, *args, ttl):
+                owner = await self.scope(chat_id) if self.scope else chat_id
+                if owner is None:
+                    return None
+                return await self.load((endpoint, owner, *args), ttl, lambda: func(chat_id, *args), prefetch=True)
+
+            # f.prefetch(chat_id, *args, ttl=seconds) warms the entry f(chat_id, *args) will be served from
+            wrapper.prefetch = prefetch
+            return wrapper
+        return decorator
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'shared_hits': self.shared_hits,
+            'lock_waits': self.lock_waits,
+            'prefetches': self.prefetches,
+            'prefetch_hits': self.prefetch_hits,
+            'stale_served': self.stale_served,
+            'entries': len(self.entries),
+            'bytes': self.bytes
+        }
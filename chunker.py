@@ -0,0 +1,90 @@
+from telegram import Bot, Message
+import re
+
+MESSAGE_LIMIT = 4096
+
+TAG = re.compile(r'<(/?)([a-zA-Z-]+)[^>]*>')
+
+
+def closing_tags(open_tags) -> str:
+    return ''.join(f'</{TAG.match(tag).group(2)}>' for tag in reversed(open_tags))
+
+
+def update_open_tags(open_tags, text) -> None:
+    for match in TAG.finditer(text):
+        if not match.group(1):
+            open_tags.append(match.group(0))
+        elif open_tags and TAG.match(open_tags[-1]).group(2) == match.group(2):
+            open_tags.pop()
+
+
+def safe_cut(text, limit) -> int:
+    """Index <= limit to cut text at without splitting a tag, an html entity or, if possible, a word."""
+    cut = limit
+    tag_start = text.rfind('<', 0, cut)
+    if tag_start > text.rfind('>', 0, cut):
+        cut = tag_start
+    entity_start = text.rfind('&', max(0, cut - 10), cut)
+    if entity_start != -1 and text.find(';', entity_start, cut) == -1:
+        cut = entity_start
+    space = text.rfind(' ', 0, cut)
+    if space > cut // 2:
+        cut = space + 1
+    return cut or limit
+
+
+def split(fragment, limit=MESSAGE_LIMIT):
+    """Splits a fragment longer than limit at line boundaries, closing open tags at each cut and reopening them after it."""
+    if len(fragment) <= limit:
+        yield fragment
+        return
+
+    # leave room for the tags that have to be closed and reopened around a cut
+    part_limit = limit - 256
+
+    parts = []
+    for line in fragment.splitlines(keepends=True):
+        while len(line) > part_limit:
+            cut = safe_cut(line, part_limit)
+            parts.append(line[:cut])
+            line = line[cut:]
+        parts.append(line)
+
+    open_tags = []
+    piece = ''
+    for part in parts:
+        if piece and len(piece) + len(part) + len(closing_tags(open_tags)) > limit:
+            yield piece + closing_tags(open_tags)
+            piece = ''.join(open_tags)
+        piece += part
+        update_open_tags(open_tags, part)
+    if piece:
+        yield piece + closing_tags(open_tags)
+
+
+def pack(fragments, limit=MESSAGE_LIMIT):
+    """Combines fragments into as few messages of at most limit characters as possible, keeping their order."""
+    buffer = []
+    size = 0
+    for fragment in fragments:
+        for piece in split(fragment, limit):
+            if buffer and size + len(piece) > limit:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+            buffer.append(piece)
+            size += len(piece)
+    if buffer:
+        yield ''.join(buffer)
+
+
+async def send(bot: Bot, msg: Message, fragments, **kwargs) -> int:
+    """Replaces msg with the first packed message and sends the rest after it. Returns the number of messages."""
+    count = 0
+    for txt in pack(fragments):
+        if count == 0:
+            await bot.edit_message_text(txt, msg.chat_id, msg.id, **kwargs)
+        else:
+            await bot.send_message(msg.chat_id, txt, **kwargs)
+        count += 1
+    return count
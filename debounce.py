@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from outbox import TokenBucket
+
+# a press of the same button within COOLDOWN seconds after its answer was shown is dropped
+COOLDOWN = 3
+# and a chat starts at most CHAT_BURST loads at once, then CHAT_RATE per second, whatever the buttons
+CHAT_RATE = 0.5
+CHAT_BURST = 3
+
+
+class Debouncer():
+    """De-duplicates button presses per (chat, action).
+
+    A press while the same action of the chat is still loading waits for that load instead of starting another
+    (coalesced), a press within `cooldown` after it succeeded is dropped, and so is one over the chat's rate (limited).
+
+    With ChatProcessor a chat's presses run one after another, so repeats usually arrive right after the load
+    they repeat and fall into the cooldown; coalescing covers updates that do run concurrently.
+    """
+
+    def __init__(self, cooldown=COOLDOWN, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, max_idle_chats=1000) -> None:
+        self.cooldown = cooldown
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_idle_chats = max_idle_chats
+        self.inflight = {}  # (chat_id, action) -> future set when the load finishes
+        self.finished = {}  # (chat_id, action) -> time.monotonic() of the last finish
+        self.buckets = {}
+        self.started = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.limited = 0
+
+    def bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.buckets:
+            if len(self.buckets) >= self.max_idle_chats:
+                self.sweep()
+            self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.buckets[chat_id]
+
+    def sweep(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, finished_at in self.finished.items() if now - finished_at >= self.cooldown]:
+            del self.finished[key]
+        for chat_id in [chat_id for chat_id, bucket in self.buckets.items() if bucket.full()]:
+            del self.buckets[chat_id]
+
+    async def run(self, chat_id, action, func, answer=None) -> str:
+        """Awaits func() unless the press is a repeat; returns the press's outcome: 'started', 'coalesced', 'dropped'
+        or 'limited'. answer(outcome), if given, is awaited as soon as the outcome is known, before any waiting.
+
+        func() returning False means the load failed: no cooldown starts, so the next press tries again.
+        """
+        key = (chat_id, action)
+        if key in self.inflight:
+            self.coalesced += 1
+            if answer is not None:
+                await answer('coalesced')
+            await asyncio.shield(self.inflight[key])
+            return 'coalesced'
+
+        finished_at = self.finished.get(key)
+        if finished_at is not None and time.monotonic() - finished_at < self.cooldown:
+            self.dropped += 1
+            if answer is not None:
+                await answer('dropped')
+            return 'dropped'
+
+        bucket = self.bucket(chat_id)
+        if bucket.delay() > 0:
+            self.limited += 1
+            if answer is not None:
+                await answer('limited')
+            return 'limited'
+        bucket.consume()
+
+        self.started += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        ok = False
+        try:
+            if answer is not None:
+                await answer('started')
+            ok = await func() is not False
+        finally:
+            del self.inflight[key]
+            if ok:
+                self.finished[key] = time.monotonic()
+            future.set_result(None)
+        return 'started'
+
+    def stats(self) -> dict:
+        return {
+            'started': self.started,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'limited': self.limited,
+            'inflight': len(self.inflight),
+            'chats': len(self.buckets)
+        }
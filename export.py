@@ -0,0 +1,164 @@
+from datetime import datetime, timedelta
+from pytz import timezone
+import csv
+import hashlib
+import os
+import tempfile
+
+import meshapi
+
+MSK = timezone('Europe/Moscow')
+UTC = timezone('Etc/UTC')
+
+# the range is loaded and written a week at a time, so a quarter is never held in memory at once
+CHUNK_DAYS = 7
+MAX_DAYS = 183
+
+# RFC 5545: lines longer than 75 octets are folded
+ICS_LINE = 75
+
+
+def chunks(date1: datetime, date2: datetime):
+    while date1 <= date2:
+        end = min(date1 + timedelta(days=CHUNK_DAYS - 1), date2)
+        yield date1, end
+        date1 = end + timedelta(days=1)
+
+
+def ics_escape(text) -> str:
+    return str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def ics_fold(line) -> str:
+    data = line.encode('utf-8')
+    if len(data) <= ICS_LINE:
+        return line + '\r\n'
+
+    parts = []
+    start = 0
+    limit = ICS_LINE
+    while start < len(data):
+        end = min(start + limit, len(data))
+        # don't cut a multi-byte character in half
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(data[start:end].decode('utf-8'))
+        start = end
+        limit = ICS_LINE - 1  # continuation lines start with a space
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def uid(*parts) -> str:
+    return hashlib.sha1(':'.join(str(x) for x in parts).encode('utf-8')).hexdigest() + '@meshbot'
+
+
+class ICSWriter():
+    """Writes VEVENTs to a text file as they come, between the header and the footer of one VCALENDAR."""
+
+    def __init__(self, f, name) -> None:
+        self.f = f
+        self.stamp = datetime.now(UTC).strftime('%Y%m%dT%H%M%SZ')
+        for line in ('BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//meshbot//RU', 'CALSCALE:GREGORIAN',
+                     f'X-WR-CALNAME:{ics_escape(name)}', 'X-WR-TIMEZONE:Europe/Moscow'):
+            self.f.write(ics_fold(line))
+
+    def event(self, uid, start, end, summary, description=None, location=None) -> None:
+        lines = ['BEGIN:VEVENT', f'UID:{uid}', f'DTSTAMP:{self.stamp}', start, end, f'SUMMARY:{ics_escape(summary)}']
+        if description:
+            lines.append(f'DESCRIPTION:{ics_escape(description)}')
+        if location:
+            lines.append(f'LOCATION:{ics_escape(location)}')
+        lines.append('END:VEVENT')
+        self.f.write(''.join(ics_fold(line) for line in lines))
+
+    def lesson(self, student, number, event) -> None:
+        start = datetime.fromtimestamp(event.begin_utc, UTC).strftime('%Y%m%dT%H%M%SZ')
+        end = datetime.fromtimestamp(event.end_utc, UTC).strftime('%Y%m%dT%H%M%SZ')
+        summary = f'{number}. {event.subject_name}' + (' (зам.)' if event.replaced else '')
+        location = f'каб. {event.room_number}' if event.room_number is not None else None
+        self.event(uid('lesson', student, event.begin_utc, event.subject_name), f'DTSTART:{start}', f'DTEND:{end}',
+                   summary, event.homework, location)
+
+    def homework(self, student, date: datetime, entry) -> None:
+        day = date.strftime('%Y%m%d')
+        next_day = (date + timedelta(days=1)).strftime('%Y%m%d')
+        description = '\n'.join([entry.text] + [f'{att.name}: {att.url}' for att in entry.attachments] +
+                                [f'{test.name}: {test.url}' for test in entry.execute if test.url])
+        self.event(uid('homework', student, day, entry.subject, entry.created_at), f'DTSTART;VALUE=DATE:{day}',
+                   f'DTEND;VALUE=DATE:{next_day}', f'ДЗ: {entry.subject}', description)
+
+    def close(self) -> None:
+        self.f.write(ics_fold('END:VCALENDAR'))
+
+
+class CSVWriter():
+    SCHEDULE = ['date', 'lesson', 'begin', 'end', 'subject', 'room', 'replaced', 'homework']
+    HOMEWORK = ['date', 'subject', 'text', 'created_at', 'updated_at', 'links']
+
+    def __init__(self, f, kind) -> None:
+        self.writer = csv.writer(f)
+        self.writer.writerow(self.SCHEDULE if kind == 'schedule' else self.HOMEWORK)
+
+    def lesson(self, student, number, event) -> None:
+        begin = datetime.fromtimestamp(event.begin_utc, MSK)
+        end = datetime.fromtimestamp(event.end_utc, MSK)
+        self.writer.writerow([begin.strftime('%d.%m.%Y'), number, begin.strftime('%H:%M'), end.strftime('%H:%M'), event.subject_name,
+                              event.room_number or '', 'да' if event.replaced else '', event.homework or ''])
+
+    def homework(self, student, date: datetime, entry) -> None:
+        links = [att.url for att in entry.attachments] + [test.url for test in entry.execute if test.url]
+        self.writer.writerow([date.strftime('%d.%m.%Y'), entry.subject, entry.text, entry.created_at, entry.updated_at, ' '.join(links)])
+
+    def close(self) -> None:
+        pass
+
+
+async def export(chat_id, kind, fmt, date1: datetime, date2: datetime) -> tuple[str, int, int]:
+    """Writes kind ('schedule' or 'homework') for the range to a temporary .ics or .csv file chunk by chunk.
+
+    Returns the file's path, the number of rows written and the number of days that couldn't be loaded;
+    the caller removes the file.
+    """
+    student = await meshapi.student_of(chat_id)
+    fd, path = tempfile.mkstemp(suffix='.' + fmt, prefix=f'{kind}-')
+    written = 0
+    failed = 0
+
+    try:
+        # a BOM in CSV files, so spreadsheets don't guess the encoding wrong
+        with os.fdopen(fd, 'w', encoding='utf-8-sig' if fmt == 'csv' else 'utf-8', newline='') as f:
+            writer = ICSWriter(f, 'Расписание' if kind == 'schedule' else 'Домашние задания') if fmt == 'ics' else CSVWriter(f, kind)
+
+            for begin, end in chunks(date1, date2):
+                if kind == 'schedule':
+                    days = await meshapi.schedule(chat_id, begin, end)
+                    if days is None:
+                        failed += (end - begin).days + 1
+                        continue
+                    for _, day in days:
+                        if day is None:
+                            failed += 1
+                            continue
+                        number = 1
+                        for event in day.activities:
+                            if event.type == 'LESSON':
+                                writer.lesson(student, number, event)
+                                number += 1
+                                written += 1
+                else:
+                    days = await meshapi.homework(chat_id, begin, end)
+                    if days is None:
+                        failed += (end - begin).days + 1
+                        continue
+                    for date, entries in days:
+                        date = datetime.strptime(date, '%d.%m.%Y')
+                        for entry in entries:
+                            writer.homework(student, date, entry)
+                            written += 1
+
+            writer.close()
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path, written, failed
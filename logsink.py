@@ -0,0 +1,94 @@
+from datetime import datetime
+import asyncio
+import json
+import os
+import time
+
+LOG_DIR = 'logs'
+LOG_FILE = os.path.join(LOG_DIR, 'log.txt')
+MAX_BYTES = 5 * 1024 * 1024
+MAX_AGE = 24 * 60 * 60
+RETENTION = 10  # rotated files to keep
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+
+queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+writer_task: asyncio.Task = None
+dropped = 0
+opened_at = time.time()
+
+
+def log(event, **fields) -> None:
+    """Puts a record on the queue without waiting; records are dropped (and counted) if the writer can't keep up."""
+    global dropped
+
+    record = {'time': datetime.now().isoformat(timespec='milliseconds'), 'event': event, **fields}
+    try:
+        queue.put_nowait(record)
+    except asyncio.QueueFull:
+        dropped += 1
+
+
+def log_error(endpoint, chat_id, e: Exception, **fields) -> None:
+    log('error', endpoint=endpoint, chat_id=chat_id, exception=e.__class__.__name__, message=str(e), **fields)
+
+
+def rotate() -> None:
+    global opened_at
+
+    if os.path.exists(LOG_FILE):
+        mtime = os.stat(LOG_FILE).st_mtime
+        creation_date = datetime.fromtimestamp(mtime).strftime('%d_%m_%Y__%H_%M_%S')
+        os.replace(LOG_FILE, os.path.join(LOG_DIR, f'log_{creation_date}.txt'))
+
+    old_logs = sorted((x for x in os.listdir(LOG_DIR) if x.startswith('log_')),
+                      key=lambda x: os.stat(os.path.join(LOG_DIR, x)).st_mtime)
+    for name in old_logs[:-RETENTION]:
+        os.remove(os.path.join(LOG_DIR, name))
+
+    opened_at = time.time()
+
+
+def write_batch(lines) -> None:
+    if os.path.exists(LOG_FILE) and (os.stat(LOG_FILE).st_size >= MAX_BYTES or time.time() - opened_at >= MAX_AGE):
+        rotate()
+
+    with open(LOG_FILE, 'a', encoding='utf-8') as f:
+        f.write(''.join(lines))
+
+
+async def writer() -> None:
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        lines = [json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in batch]
+        try:
+            await asyncio.to_thread(write_batch, lines)
+        except Exception as e:
+            print(f'Failed to write {len(lines)} log records ({e})')
+
+
+async def start() -> None:
+    global writer_task
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    rotate()
+    writer_task = asyncio.create_task(writer())
+
+
+async def stop() -> None:
+    global writer_task
+
+    if writer_task is None:
+        return
+
+    writer_task.cancel()
+    writer_task = None
+
+    lines = []
+    while not queue.empty():
+        lines.append(json.dumps(queue.get_nowait(), ensure_ascii=False, default=str) + '\n')
+    if lines:
+        write_batch(lines)
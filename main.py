@@ -2,24 +2,79 @@ from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, BotComm
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters, Application
 import logging
 import json
+import os
+import socket
 from datetime import datetime
-from types import SimpleNamespace
 
+import cache
+import chunker
+import debounce
+import export
+import logsink
 import meshapi
+import metrics
+import outbox
+import poller
+import prefetch
+import processor
+import shared
+import state
 import tg_cal
+import webhook
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.WARNING
 )
 
-print('Starting bot')
+TOKEN_PROMPT_TTL = 60 * 60
+# with a shared backend one worker owns each push chat; polls come at most MAX_INTERVAL * 1.1 apart
+PUSH_LEASE = poller.MAX_INTERVAL * 1.5
+PUSH_MEMBERS = 'push_chats'
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
 
-calendars = {}
-token_messages = {}
+# chats that were asked to reply with a new token
+token_messages = state.StateStore(ttl=TOKEN_PROMPT_TTL, max_entries=10000)
+outbox_limiter = outbox.Outbox()
+presses = debounce.Debouncer()
+push_poller: poller.Poller = None
+prefetcher: prefetch.Prefetcher = None
+update_processor: processor.ChatProcessor = None
+webhook_server: webhook.Webhook = None
+shared_backend: shared.Backend = None
+env = {}
+
+
+REFRESH_TOKEN_TEXT = 'Пожалуйста, перейдите по <a href="https://school.mos.ru/?backUrl=https%3A%2F%2Fschool.mos.ru%2Fv2%2Ftoken%2Frefresh%3FroleId%3D1%26subsystem%3D4">этой ссылке</a>, войдите в аккаунт, скопируйте весь текст и ответьте на это сообщение скопированным текстом'
+
+
+async def ask_for_token(bot: Bot, chat_id, message_id, reason='') -> None:
+    await bot.edit_message_text(reason + REFRESH_TOKEN_TEXT, chat_id, message_id, parse_mode='HTML')
+    await token_messages.set(chat_id, message_id)
+
+
+async def token_expired(msg: Message, bot: Bot) -> bool:
+    """If МЭШ has rejected the chat's token, turns msg into the token prompt instead of an error and returns True."""
+    if not await meshapi.token_invalid(str(msg.chat_id)):
+        return False
+    await ask_for_token(bot, msg.chat_id, msg.id, 'Токен МЭШ больше не действует. ')
+    return True
+
+
+def stale_note(stale) -> str:
+    """Marker for answers served from the last good data because МЭШ didn't answer."""
+    if not stale:
+        return ''
+    stored = datetime.fromtimestamp(min(stale))
+    when = stored.strftime('%H:%M') if stored.date() == datetime.today().date() else stored.strftime('%d.%m %H:%M')
+    return f'⚠️ <i>МЭШ не отвечает, данные от {when}</i>\n\n'
+
+
+def with_stale_note(stale, fragments):
+    if stale:
+        yield stale_note(stale)
+    yield from fragments
 
-with open('env.json', 'r') as f:
-    env = json.load(f)
 
 def mark_to_string(value, weight, is_exam) -> str:
     WEIGHT_CHARS = ['₁', '₂', '₃', '₄', '₅']
@@ -34,13 +89,31 @@ def mark_to_string(value, weight, is_exam) -> str:
     return txt
 
 
+def calendar_callbacks() -> dict:
+    return {
+        'schedule': schedule,
+        'homework': homework,
+        'marksdate': marksdate,
+        'export_schedule_ics': exporter('schedule', 'ics'),
+        'export_schedule_csv': exporter('schedule', 'csv'),
+        'export_homework_ics': exporter('homework', 'ics'),
+        'export_homework_csv': exporter('homework', 'csv')
+    }
+
+
+async def open_calendar(msg: Message, action, bot: Bot) -> None:
+    # the picker keeps its state in callback_data, so nothing is stored per open picker
+    await tg_cal.open_picker(bot, msg.chat_id, msg.id, action)
+
+
 async def start(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
     markup = InlineKeyboardMarkup([
         [InlineKeyboardButton('Расписание', callback_data='schedule'), InlineKeyboardButton('ДЗ', callback_data='homework')],
         [InlineKeyboardButton('Оценки по дате', callback_data='marksdate'), InlineKeyboardButton('Все оценки', callback_data='marks')],
         [InlineKeyboardButton('Ответы на тест МЭШ', callback_data='testanswers'),
          InlineKeyboardButton('Уведомления', callback_data='notifications')],
-        [InlineKeyboardButton('Профиль', callback_data='profile'), InlineKeyboardButton('Обновить токен', callback_data='refreshtoken')]
+        [InlineKeyboardButton('Профиль', callback_data='profile'), InlineKeyboardButton('Обновить токен', callback_data='refreshtoken')],
+        [InlineKeyboardButton('Экспорт в файл', callback_data='export')]
     ])
 
     await ctx.bot.send_message(upd.effective_chat.id, 'Выберите действие', reply_markup=markup)
@@ -51,171 +124,228 @@ async def profile_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
     await profile(msg, ctx.bot)
 
 
-async def profile(msg: Message, bot: Bot) -> None:
+async def profile(msg: Message, bot: Bot) -> bool:
+    if await token_expired(msg, bot):
+        return False
+    stale = cache.track_stale()
     data = await meshapi.profile(str(msg.chat_id))
+    if await token_expired(msg, bot):
+        return False
     if not data:
         await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
-        return
-
-    data = json.loads(data, object_hook=lambda d: SimpleNamespace(**d)).children[0]
+        return False
 
     txt = f'''Здравствуйте, {data.last_name} {data.first_name} {data.middle_name}!
 Дата рождения: {data.birth_date or 'Не указана'}
 Номер телефона: {data.phone or 'Не указан'}
 Email: {data.email or 'Не указан'}
-Школа: {data.school.short_name or data.school.name or 'Не указана'}
+Школа: {data.school_short_name or data.school_name or 'Не указана'}
 Класс: {data.class_name or 'Не указан'}
 Снилс: <tg-spoiler>{data.snils or 'Не указан'}</tg-spoiler>
 
 person_id: {data.contingent_guid}
 id: {data.id}
-school_id: {data.school.id}
+school_id: {data.school_id}
 
 <b>Внимание! Мы не храним вашу информацию, вся эта информация получена из МЭШ!</b>'''
 
-    await bot.edit_message_text(txt, msg.chat_id, msg.id, parse_mode='HTML')
+    await bot.edit_message_text(stale_note(stale) + txt, msg.chat_id, msg.id, parse_mode='HTML')
+    return True
 
 
 async def schedule_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    global calendars
     msg = await ctx.bot.send_message(upd.effective_chat.id, 'Выберите начальную дату')
-    if not upd.effective_chat.id in calendars:
-        calendars[upd.effective_chat.id] = {}
-    calendars[upd.effective_chat.id][msg.id] = await tg_cal.Calendar.create(msg, schedule, ctx.bot)
+    await open_calendar(msg, 'schedule', ctx.bot)
 
 
-async def schedule(msg: Message, bot: Bot, date1: datetime, date2: datetime) -> None:
-    await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
+def schedule_fragments(data_all):
+    for date, data in data_all:
+        if data is None:
+            yield f'🗓 <b>{date.strftime("%d.%m.%Y")}</b>: не удалось получить данные, попробуйте ещё раз позже\n\n'
+            continue
 
-    data_all = await meshapi.schedule(str(msg.chat_id), date1, date2)
-    if not data_all:
-        await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
-        return
-
-    i = 0
-    for data in data_all:
-        data = json.loads(data, object_hook=lambda d: SimpleNamespace(**d))
         date = datetime.strptime(data.date, '%Y-%m-%d')
 
-        txt = f'🗓 <b>{date.strftime("%d.%m.%Y")}</b>: {data.summary}\n\n'
+        yield f'🗓 <b>{date.strftime("%d.%m.%Y")}</b>: {data.summary}\n\n'
 
         cur_lesson = 1
         for event in data.activities:
+            begin = datetime.fromtimestamp(event.begin_utc).strftime("%H:%M")
+            end = datetime.fromtimestamp(event.end_utc).strftime("%H:%M")
             if event.type == 'LESSON':
-                txt += f'<i>{cur_lesson} урок 🕒 {datetime.fromtimestamp(event.begin_utc).strftime("%H:%M")} - {datetime.fromtimestamp(event.end_utc).strftime("%H:%M")}'
-                if event.room_number is not None:
-                    txt += f' 🚪каб. {event.room_number}'
-                if event.lesson.replaced:
-                    txt += ' (зам.)'
-                txt += '</i>\n'
-                txt += f'📖 <b>{event.lesson.subject_name}</b>'
-                if event.lesson.homework:
-                    txt += f'\n🏠 {event.lesson.homework}'
+                room = f' 🚪каб. {event.room_number}' if event.room_number is not None else ''
+                replaced = ' (зам.)' if event.replaced else ''
+                homework = f'\n🏠 {event.homework}' if event.homework else ''
+                yield f'<i>{cur_lesson} урок 🕒 {begin} - {end}{room}{replaced}</i>\n📖 <b>{event.subject_name}</b>{homework}\n\n'
                 cur_lesson += 1
             else:
-                txt += f'🏃 <i>Перемена {datetime.fromtimestamp(event.begin_utc).strftime("%H:%M")} - {datetime.fromtimestamp(event.end_utc).strftime("%H:%M")}</i>'
-            txt += '\n\n'
+                yield f'🏃 <i>Перемена {begin} - {end}</i>\n\n'
 
-        if i == 0:
-            await bot.edit_message_text(txt, msg.chat_id, msg.id, parse_mode='HTML', disable_web_page_preview=True)
-        else:
-            await bot.send_message(msg.chat_id, txt, parse_mode='HTML', disable_web_page_preview=True)
-        i += 1
+
+async def schedule(msg: Message, bot: Bot, date1: datetime, date2: datetime) -> None:
+    await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
+
+    if await token_expired(msg, bot):
+        return
+    stale = cache.track_stale()
+    data_all = await meshapi.schedule(str(msg.chat_id), date1, date2)
+    if await token_expired(msg, bot):
+        return
+    if not data_all:
+        await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
+        return
+    if prefetcher:
+        await prefetcher.record(str(msg.chat_id), 'schedule')
+
+    await chunker.send(bot, msg, with_stale_note(stale, schedule_fragments(data_all)), parse_mode='HTML', disable_web_page_preview=True)
 
 
 async def homework_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    global calendars
     msg = await ctx.bot.send_message(upd.effective_chat.id, 'Выберите начальную дату')
-    if not upd.effective_chat.id in calendars:
-        calendars[upd.effective_chat.id] = {}
-    calendars[upd.effective_chat.id][msg.id] = await tg_cal.Calendar.create(msg, homework, ctx.bot)
+    await open_calendar(msg, 'homework', ctx.bot)
+
+
+def plural_tests(count) -> str:
+    def f1(a): return (a % 100)//10 != 1 and a % 10 == 1
+    def f2(a): return (a % 100)//10 != 1 and a % 10 in [2, 3, 4]
+    return "тест" if f1(count) else "теста" if f2(count) else "тестов"
+
+
+def homework_fragments(data_all):
+    for date, entries in data_all:
+        yield f'🗓 <b>{date}</b>\n\n'
+
+        for entry in entries:
+            lines = [
+                f'📖 <b>{entry.subject}</b>',
+                f'🏠 {entry.text}',
+                f'🕒 <i>Добавлено: {entry.created_at}</i>'
+            ]
+            if entry.created_at != entry.updated_at:
+                lines.append(f'🕒 <i>Изменено: {entry.updated_at}</i>')
+
+            for att in entry.attachments:
+                lines.append(f'📄 <a href="{att.url}">{att.name}</a>')
+
+            if len(entry.execute) > 0:
+                lines.append('<i>Выполнить (см. дз!):</i>')
+            for att in entry.execute:
+                if att.url is None:
+                    lines.append(f'🏆 {att.name} (ссылку получить не удалось)')
+                else:
+                    lines.append(f'🏆 <a href="{att.url}">{att.name}</a>')
+
+            examine = entry.examine
+            if examine > 0:
+                lines.append(f'<i>Изучить: {examine} {plural_tests(examine)}...</i>')
+
+            yield '\n'.join(lines) + '\n\n'
 
 
 async def homework(msg: Message, bot: Bot, date1: datetime, date2: datetime) -> None:
     await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
 
+    if await token_expired(msg, bot):
+        return
+    stale = cache.track_stale()
     data_all = await meshapi.homework(str(msg.chat_id), date1, date2)
+    if await token_expired(msg, bot):
+        return
     if not data_all:
         await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
         return
+    if prefetcher:
+        await prefetcher.record(str(msg.chat_id), 'homework')
 
-    i = 0
+    await chunker.send(bot, msg, with_stale_note(stale, homework_fragments(data_all)), parse_mode='HTML', disable_web_page_preview=True)
 
-    for date, entries in data_all:
-        txt = f'🗓 <b>{date}</b>\n\n'
 
-        for entry in entries:
-            txt += f'📖 <b>{entry["subject"]}</b>\n'
-            txt += f'🏠 {entry["text"]}\n'
-            txt += f'🕒 <i>Добавлено: {entry["created_at"]}</i>\n'
-            if entry['created_at'] != entry['updated_at']:
-                txt += f'🕒 <i>Изменено: {entry["updated_at"]}</i>\n'
+async def export_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    msg = await ctx.bot.send_message(upd.effective_chat.id, 'Загрузка...')
+    await export_menu(msg, ctx.bot)
+
+
+async def export_menu(msg: Message, bot: Bot) -> None:
+    markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton('Расписание .ics', callback_data='export_schedule_ics'),
+         InlineKeyboardButton('Расписание .csv', callback_data='export_schedule_csv')],
+        [InlineKeyboardButton('ДЗ .ics', callback_data='export_homework_ics'),
+         InlineKeyboardButton('ДЗ .csv', callback_data='export_homework_csv')]
+    ])
+    await bot.edit_message_text('Выберите, что выгрузить. Файл .ics можно импортировать в календарь, .csv открыть в таблице',
+                                msg.chat_id, msg.id, reply_markup=markup)
 
-            for att in entry['attachements']:
-                txt += f'📄 <a href="{att["url"]}">{att["name"]}</a>\n'
 
-            if len(entry['tests']['execute']) > 0:
-                txt += '<i>Выполнить (см. дз!):</i>\n'
-            for att in entry['tests']['execute']:
-                txt += f'🏆 <a href="{att["url"]}">{att["name"]}</a>\n'
+def exporter(kind, fmt):
+    async def callback(msg: Message, bot: Bot, date1: datetime, date2: datetime) -> None:
+        await export_document(msg, bot, kind, fmt, date1, date2)
+    return callback
 
-            examine = entry['tests']['examine']
-            if examine > 0:
-                def f1(a): return (a % 100)//10 != 1 and a % 10 == 1
-                def f2(a): return (a % 100)//10 != 1 and a % 10 in [2, 3, 4]
-                word = "тест" if f1(examine) else "теста" if f2(examine) else "тестов"
-                txt += f'<i>Изучить: {examine} {word}...</i>\n'
 
-            txt += '\n'
+async def export_document(msg: Message, bot: Bot, kind, fmt, date1: datetime, date2: datetime) -> None:
+    """Sends the range as one .ics/.csv document instead of a message per day."""
+    if (date2 - date1).days + 1 > export.MAX_DAYS:
+        await bot.edit_message_text(f'Можно выгрузить не больше {export.MAX_DAYS} дней за раз', msg.chat_id, msg.id)
+        return
 
-        if i == 0:
-            await bot.edit_message_text(txt, msg.chat_id, msg.id, parse_mode='HTML', disable_web_page_preview=True)
-        else:
-            await bot.send_message(msg.chat_id, txt, parse_mode='HTML', disable_web_page_preview=True)
+    await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
 
-        i += 1
+    if await token_expired(msg, bot):
+        return
+    stale = cache.track_stale()
+    path, written, failed = await export.export(str(msg.chat_id), kind, fmt, date1, date2)
+    try:
+        if await token_expired(msg, bot):
+            return
+        if written == 0 and failed:
+            await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
+            return
+
+        name = f'{kind}_{date1.strftime("%Y%m%d")}-{date2.strftime("%Y%m%d")}.{fmt}'
+        caption = f'{"Расписание" if kind == "schedule" else "ДЗ"} с {date1.strftime("%d.%m.%Y")} по {date2.strftime("%d.%m.%Y")}'
+        if failed:
+            caption += f'\nНе удалось получить данные за {failed} дн.'
+        with open(path, 'rb') as f:
+            await bot.send_document(msg.chat_id, f, filename=name, caption=stale_note(stale) + caption, parse_mode='HTML')
+        await bot.delete_message(msg.chat_id, msg.id)
+    finally:
+        os.remove(path)
 
 
 async def marksdate_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    global calendars
     msg = await ctx.bot.send_message(upd.effective_chat.id, 'Выберите начальную дату')
-    if not upd.effective_chat.id in calendars:
-        calendars[upd.effective_chat.id] = {}
-    calendars[upd.effective_chat.id][msg.id] = await tg_cal.Calendar.create(msg, marksdate, ctx.bot)
-
+    await open_calendar(msg, 'marksdate', ctx.bot)
 
-async def marksdate(msg: Message, bot: Bot, date1: datetime, date2: datetime) -> None:
-    await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
 
-    data = await meshapi.marksdate(str(msg.chat_id), date1, date2)
-    if not data:
-        await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
-        return
-
-    i = 0
+def marksdate_fragments(data):
     for day, entry in data:
-        txt = f'🗓 <b>{day}</b>\n\n'
+        yield f'🗓 <b>{day}</b>\n\n'
 
         for name, marks in entry.items():
-            txt += f'📖 <b>{name}</b>\n'
-
+            values = []
             for mark in marks:
-                txt += mark_to_string(mark['value'], mark['weight'], mark['is_exam'])
+                value = mark_to_string(mark.value, mark.weight, mark.is_exam)
+                if mark.comment != '':
+                    value += f' <tg-spoiler>({mark.comment})</tg-spoiler>'
+                values.append(value)
 
-                if mark['comment'] != '':
-                    txt += f' <tg-spoiler>({mark["comment"]})</tg-spoiler>'
+            yield f'📖 <b>{name}</b>\n{", ".join(values)}\n\n'
 
-                txt += ', '
-            txt = txt[:-2]
 
-            txt += '\n\n'
+async def marksdate(msg: Message, bot: Bot, date1: datetime, date2: datetime) -> None:
+    await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
 
-        if i == 0:
-            await bot.edit_message_text(txt, msg.chat_id, msg.id, disable_web_page_preview=True, parse_mode='HTML')
-        else:
-            await bot.send_message(msg.chat_id, txt, disable_web_page_preview=True, parse_mode='HTML')
+    if await token_expired(msg, bot):
+        return
+    stale = cache.track_stale()
+    data = await meshapi.marksdate(str(msg.chat_id), date1, date2)
+    if await token_expired(msg, bot):
+        return
+    if not data:
+        await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
+        return
 
-        i += 1
+    await chunker.send(bot, msg, with_stale_note(stale, marksdate_fragments(data)), disable_web_page_preview=True, parse_mode='HTML')
 
 
 async def marks_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
@@ -223,32 +353,31 @@ async def marks_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
     await marks(msg, ctx.bot)
 
 
-async def marks(msg: Message, bot: Bot) -> None:
-    data = await meshapi.marks(str(msg.chat_id))
-    if not data:
-        await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
-        return
+def marks_fragments(data):
+    for subj in data:
+        lines = [f'📖 {subj.subject}: {subj.avg}']
 
-    txt = ''
+        for period in subj.periods:
+            final_mark = f' (итог: <b>{period.final_mark}</b>)' if period.final_mark else ''
+            lines.append(f'<b>{period.name}</b>: {period.avg}{final_mark}')
+            lines.append(', '.join(mark_to_string(mark.value, mark.weight, mark.is_exam) for mark in period.marks))
 
-    for subj, entry in data.items():
-        txt += f'📖 {subj}: {entry["avg"]}\n'
+        yield '\n'.join(lines) + '\n\n'
 
-        for period, entry2 in entry['periods'].items():
-            txt += f'<b>{period}</b>: {entry2["avg"]}'
-            if entry2['final_mark']:
-                txt += f' (итог: <b>{entry2["final_mark"]}</b>)'
-            txt += '\n'
-            for mark in entry2['marks']:
-                txt += mark_to_string(mark['value'], mark['weight'], mark['is_exam'])
 
-                txt += ', '
-
-            txt = txt[:-2] + '\n'
-
-        txt += '\n'
+async def marks(msg: Message, bot: Bot) -> bool:
+    if await token_expired(msg, bot):
+        return False
+    stale = cache.track_stale()
+    data = await meshapi.marks(str(msg.chat_id))
+    if await token_expired(msg, bot):
+        return False
+    if not data:
+        await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
+        return False
 
-    await bot.edit_message_text(txt, msg.chat_id, msg.id, parse_mode='HTML')
+    await chunker.send(bot, msg, with_stale_note(stale, marks_fragments(data)), parse_mode='HTML')
+    return True
 
 
 async def notifications_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
@@ -256,11 +385,34 @@ async def notifications_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None
     await notifications(msg, ctx.bot)
 
 
-async def notifications(msg: Message, bot: Bot) -> None:
+def notification_to_string(entry, time) -> str:
+    lesson_date = datetime.strptime(
+        entry['lesson_date'] if 'lesson_date' in entry else entry['new_date_prepared_for'], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y')
+
+    match entry['event_type']:
+        case 'update_mark':
+            txt = f'📕 <i>{time}</i>: Изменение оценки ({mark_to_string(entry["new_mark_value"], entry["new_mark_weight"], entry["new_is_exam"])})\n'
+        case 'create_mark':
+            txt = f'📕 <i>{time}</i>: Новая оценка ({mark_to_string(entry["new_mark_value"], entry["new_mark_weight"], entry["new_is_exam"])})\n'
+        case 'update_homework':
+            txt = f'🏠 <i>{time}</i>: Изменение ДЗ ({entry["new_hw_description"]})\n'
+        case 'create_homework':
+            txt = f'🏠 <i>{time}</i>: Новое ДЗ ({entry["new_hw_description"]})\n'
+        case _:
+            return ''
+
+    return txt + f'Урок: {entry["subject_name"]} {lesson_date}\n'
+
+
+async def notifications(msg: Message, bot: Bot) -> bool:
+    if await token_expired(msg, bot):
+        return False
     data = await meshapi.notifications(str(msg.chat_id))
+    if await token_expired(msg, bot):
+        return False
     if not data:
         await bot.edit_message_text('Не удалось получить данные. Попробуйте обновить токен или попробуйте ещё раз позже', msg.chat_id, msg.id)
-        return
+        return False
 
     last_date = ''
     txt = ''
@@ -282,92 +434,159 @@ async def notifications(msg: Message, bot: Bot) -> None:
                 break
             txt = f'🗓 <b>{date}</b>\n\n'
 
-        lesson_date = datetime.strptime(
-            entry['lesson_date'] if 'lesson_date' in entry else entry['new_date_prepared_for'], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y')
-
-        match entry['event_type']:
-            case 'update_mark':
-                txt += f'📕 <i>{time}</i>: Изменение оценки ({mark_to_string(entry["new_mark_value"], entry["new_mark_weight"], entry["new_is_exam"])})\n'
-                txt += f'Урок: {entry["subject_name"]} {lesson_date}\n'
-            case 'create_mark':
-                txt += f'📕 <i>{time}</i>: Новая оценка ({mark_to_string(entry["new_mark_value"], entry["new_mark_weight"], entry["new_is_exam"])})\n'
-                txt += f'Урок: {entry["subject_name"]} {lesson_date}\n'
-            case 'update_homework':
-                txt += f'🏠 <i>{time}</i>: Изменение ДЗ ({entry["new_hw_description"]})\n'
-                txt += f'Урок: {entry["subject_name"]} {lesson_date}\n'
-            case 'create_homework':
-                txt += f'🏠 <i>{time}</i>: Новое ДЗ ({entry["new_hw_description"]})\n'
-                txt += f'Урок: {entry["subject_name"]} {lesson_date}\n'
+        txt += notification_to_string(entry, time)
 
         last_date = date
 
+    return True
+
+
+def notification_fragments(entries):
+    last_date = ''
+    for entry in entries:
+        date_and_time = datetime.strptime(entry['datetime'], '%Y-%m-%d %H:%M:%S.%f')
+        date = date_and_time.strftime('%d.%m.%Y')
+
+        if date != last_date:
+            if last_date:
+                yield '\n'
+            yield f'🗓 <b>{date}</b>\n\n'
+            last_date = date
+
+        yield notification_to_string(entry, date_and_time.strftime('%H:%M:%S'))
+
+
+async def push_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = str(upd.effective_chat.id)
+    record = await meshapi.db.get(chat_id)
+    if record is None:
+        await ctx.bot.send_message(upd.effective_chat.id, 'Сначала добавьте токен (/refreshtoken)')
+        return
+
+    enabled = not record.get('push', False)
+    await meshapi.update_user(chat_id, push=enabled)
+
+    if shared_backend:
+        # the other workers pick the change up from this set within poller.SYNC_INTERVAL
+        if enabled:
+            await shared_backend.set_add(PUSH_MEMBERS, chat_id)
+        else:
+            await shared_backend.set_remove(PUSH_MEMBERS, chat_id)
+
+    if enabled:
+        push_poller.add(chat_id)
+        await ctx.bot.send_message(upd.effective_chat.id, 'Уведомления о новых оценках и ДЗ включены')
+    else:
+        push_poller.remove(chat_id)
+        await ctx.bot.send_message(upd.effective_chat.id, 'Уведомления о новых оценках и ДЗ выключены')
+
+
+async def push_claim(chat_id) -> bool:
+    # every worker schedules every chat in PUSH_MEMBERS, but only the lease owner polls it; the lease outlives the
+    # longest poll interval, so it lapses only when the owner stops renewing it and another worker takes over
+    if not (await meshapi.db.get(chat_id, {})).get('push'):
+        return False
+    key = f'push:{chat_id}'
+    if await shared_backend.add(key, WORKER_ID, PUSH_LEASE):
+        return True
+    if await shared_backend.get(key) != WORKER_ID:
+        return False
+    await shared_backend.set(key, WORKER_ID, PUSH_LEASE)
+    return True
+
+
+async def push_members() -> list:
+    return await shared_backend.members(PUSH_MEMBERS)
+
+
+async def push_last(chat_id):
+    return (await meshapi.db.get(chat_id, {})).get('push_last')
+
+
+async def set_push_last(chat_id, key) -> None:
+    await meshapi.update_user(chat_id, push_last=key)
+
+
+def push_deliver(bot: Bot):
+    async def deliver(chat_id, events) -> None:
+        for txt in chunker.pack(notification_fragments(events)):
+            await bot.send_message(chat_id, txt, parse_mode='HTML', disable_web_page_preview=True)
+    return deliver
+
 
 async def refreshtoken_cmd(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
     global token_messages
     bot = ctx.bot
 
-    txt = 'Пожалуйста, перейдите по <a href="https://school.mos.ru/?backUrl=https%3A%2F%2Fschool.mos.ru%2Fv2%2Ftoken%2Frefresh%3FroleId%3D1%26subsystem%3D4">этой ссылке</a>, войдите в аккаунт, скопируйте весь текст и ответьте на это сообщение скопированным текстом'
+    msg = await bot.send_message(upd.effective_chat.id, REFRESH_TOKEN_TEXT, parse_mode='HTML')
+
+    await token_messages.set(upd.effective_chat.id, msg.id)
+
+
+async def load_marks(msg: Message, bot: Bot) -> bool:
+    await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
+    return await marks(msg, bot)
+
 
-    msg = await bot.send_message(upd.effective_chat.id, txt, parse_mode='HTML')
+async def load_notifications(msg: Message, bot: Bot) -> bool:
+    await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
+    return await notifications(msg, bot)
 
-    token_messages[upd.effective_chat.id] = msg
+
+async def load_profile(msg: Message, bot: Bot) -> bool:
+    await bot.edit_message_text('Загрузка...', msg.chat_id, msg.id)
+    return await profile(msg, bot)
+
+
+# buttons whose presses go through the debouncer, and what a press that doesn't start a load of its own is answered with
+DEBOUNCED = {
+    'marks': load_marks,
+    'notifications': load_notifications,
+    'profile': load_profile
+}
+PRESS_ANSWERS = {
+    'coalesced': 'Уже загружается…',
+    'dropped': 'Только что обновлено',
+    'limited': 'Слишком часто, попробуйте через пару секунд'
+}
 
 
 async def callback(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    global calendars, token_messages
     query = upd.callback_query
 
-    try:
-        if not upd.effective_chat.id in calendars:
-            calendars[upd.effective_chat.id] = {}
-        cal = calendars[upd.effective_chat.id][upd.effective_message.id]
-    except:
-        cal = None
+    if query.data in DEBOUNCED:
+        load = DEBOUNCED[query.data]
+        await presses.run(upd.effective_chat.id, query.data, lambda: load(upd.effective_message, ctx.bot),
+                          lambda outcome: query.answer(PRESS_ANSWERS.get(outcome)))
+        return
 
     await query.answer()
 
+    if query.data.startswith(tg_cal.PICKER_PREFIX):
+        await tg_cal.handle_picker(upd.effective_message, ctx.bot, query.data, calendar_callbacks())
+        return
+
     match query.data:
         case 'homework':
-            calendars[upd.effective_chat.id][upd.effective_message.id] = await tg_cal.Calendar.create(upd.effective_message, homework, ctx.bot)
+            await open_calendar(upd.effective_message, 'homework', ctx.bot)
         case 'schedule':
-            calendars[upd.effective_chat.id][upd.effective_message.id] = await tg_cal.Calendar.create(upd.effective_message, schedule, ctx.bot)
+            await open_calendar(upd.effective_message, 'schedule', ctx.bot)
         case 'marksdate':
-            calendars[upd.effective_chat.id][upd.effective_message.id] = await tg_cal.Calendar.create(upd.effective_message, marksdate, ctx.bot)
-        case 'marks':
-            await ctx.bot.edit_message_text('Загрузка...', upd.effective_chat.id, upd.effective_message.id)
-            await marks(upd.effective_message, ctx.bot)
+            await open_calendar(upd.effective_message, 'marksdate', ctx.bot)
         case 'testanswers':
             await ctx.bot.send_message(upd.effective_chat.id, 'Получение ответов из теста МЭШ пока не поддерживается!')
-        case 'notifications':
-            await ctx.bot.edit_message_text('Загрузка...', upd.effective_chat.id, upd.effective_message.id)
-            await notifications(upd.effective_message, ctx.bot)
-        case 'profile':
-            await ctx.bot.edit_message_text('Загрузка...', upd.effective_chat.id, upd.effective_message.id)
-            await profile(upd.effective_message, ctx.bot)
+        case 'export':
+            await export_menu(upd.effective_message, ctx.bot)
+        case 'export_schedule_ics' | 'export_schedule_csv' | 'export_homework_ics' | 'export_homework_csv':
+            await open_calendar(upd.effective_message, query.data, ctx.bot)
         case 'refreshtoken':
-            txt = 'Пожалуйста, перейдите по <a href="https://school.mos.ru/?backUrl=https%3A%2F%2Fschool.mos.ru%2Fv2%2Ftoken%2Frefresh%3FroleId%3D1%26subsystem%3D4">этой ссылке</a>, войдите в аккаунт, скопируйте весь текст и ответьте на это сообщение скопированным текстом'
-            await ctx.bot.edit_message_text(txt, upd.effective_chat.id, upd.effective_message.id, parse_mode='HTML')
-
-            token_messages[upd.effective_chat.id] = upd.effective_message
-        case 'cal_left':
-            if cal:
-                await cal.backward()
-        case 'cal_right':
-            if cal:
-                await cal.forward()
-        case 'cal_close':
-            if cal:
-                await cal.close()
-                calendars[upd.effective_chat.id][upd.effective_message.id] = None
-        case _:
-            if query.data.startswith('date') and cal:
-                await cal.on_date(datetime.strptime(query.data, 'date %Y/%m/%d'))
+            await ask_for_token(ctx.bot, upd.effective_chat.id, upd.effective_message.id)
 
 
 async def reply_callback(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
     global token_messages
 
-    if upd.effective_chat.id in token_messages:
+    if await token_messages.has(upd.effective_chat.id):
         new_token = upd.effective_message.text
 
         msg = await ctx.bot.send_message(upd.effective_chat.id, 'Пожалуйста, подождите...')
@@ -379,10 +598,64 @@ async def reply_callback(upd: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
             await ctx.bot.edit_message_text('Не получилось проверить токен, пожалуйста, попробуйте ещё раз (отвечайте на предыдущее сообщение)', msg.chat_id, msg.id)
         else:
             await ctx.bot.edit_message_text('Токен успешно изменён!', msg.chat_id, msg.id)
-            del token_messages[upd.effective_chat.id]
+            await token_messages.pop(upd.effective_chat.id)
+
+
+def prefetch_hit_rate() -> float:
+    stats = meshapi.response_cache.stats()
+    return stats['prefetch_hits'] / stats['prefetches'] if stats['prefetches'] else 0.0
 
 
 async def post_init(application: Application) -> None:
+    global push_poller, prefetcher
+
+    await logsink.start()
+    if shared_backend:
+        # users of the single-worker setup, on its first start in shared mode
+        migrated = await meshapi.db.storage.migrate_sqlite()
+        if migrated:
+            print(f'Imported {migrated} users from db.sqlite3 into the shared backend')
+    await meshapi.start(**env.get('http', {}))
+
+    users = await meshapi.db.items()
+    push_chats = [chat_id for chat_id, record in users if record.get('push')]
+    if shared_backend:
+        # chats that opted in before the set existed, or were imported
+        for chat_id in push_chats:
+            await shared_backend.set_add(PUSH_MEMBERS, chat_id)
+    push_poller = poller.Poller(meshapi.notifications, push_deliver(application.bot), push_last, set_push_last,
+                                claim=push_claim if shared_backend else None,
+                                members=push_members if shared_backend else None)
+    push_poller.start(push_chats)
+
+    # the next school day for chats that check it regularly, loaded before the peaks
+    prefetcher = prefetch.Prefetcher({
+        'schedule': lambda chat_id, day, ttl: meshapi.schedule(chat_id, day, day, prefetch_ttl=ttl),
+        # homework is cached per requested range, so only a request for that one day is served from the prefetch;
+        # longer ranges still go to MESH, but reuse the processed entries and launch urls stored for the day
+        'homework': lambda chat_id, day, ttl: meshapi.homework.prefetch(chat_id, day, day, ttl=ttl)
+    }, lambda chat_ids: meshapi.db.storage.get_values('usage', chat_ids),
+        lambda chat_id, usage: meshapi.db.storage.put_values('usage', {chat_id: usage}),
+        **env.get('prefetch', {}))
+    await prefetcher.start(chat_id for chat_id, _ in users)
+
+    if env.get('persist_state'):
+        token_messages.load('token_messages.json')
+
+    metrics.collect_stats('cache', meshapi.response_cache.stats)
+    metrics.collect_stats('outbox', outbox_limiter.stats)
+    metrics.collect_stats('poller', push_poller.stats)
+    metrics.collect_stats('updates', update_processor.stats)
+    metrics.collect_stats('breakers', lambda: meshapi.breakers.stats())
+    metrics.collect_stats('tokens', lambda: meshapi.token_stats)
+    metrics.collect_stats('presses', presses.stats)
+    metrics.collect_stats('prefetch', lambda: {**prefetcher.stats(), 'hit_rate': prefetch_hit_rate()})
+    metrics.collect_stats('token_prompts', token_messages.stats)
+    if webhook_server:
+        metrics.collect_stats('webhook', webhook_server.stats)
+    metrics.collect_stats('logsink', lambda: {'queued': logsink.queue.qsize(), 'dropped': logsink.dropped})
+    await metrics.start(**env.get('metrics', {}))
+
     bot: Bot = application.bot
     await bot.set_my_commands(commands=[
         BotCommand('start', 'Start working with the bot'),
@@ -393,7 +666,9 @@ async def post_init(application: Application) -> None:
         BotCommand('marks', 'Get all your marks'),
         BotCommand('refreshtoken', 'Refresh/change your Mesh token'),
         BotCommand('testanswers', 'Get answers for a Mesh test'),
-        BotCommand('notifications', 'Get latest notifications')
+        BotCommand('notifications', 'Get latest notifications'),
+        BotCommand('push', 'Turn new marks/homework notifications on or off'),
+        BotCommand('export', 'Export schedule or homework to an .ics/.csv file')
     ], scope=BotCommandScopeAllPrivateChats(), language_code='')
     await bot.set_my_commands(commands=[
         BotCommand('start', 'Начать работать с ботом'),
@@ -404,22 +679,67 @@ async def post_init(application: Application) -> None:
         BotCommand('marks', 'Получить все оценки'),
         BotCommand('refreshtoken', 'Обновить/изменить свой токен МЭШ'),
         BotCommand('testanswers', 'Получить ответы на тест МЭШ'),
-        BotCommand('notifications', 'Получить последние уведомления')
+        BotCommand('notifications', 'Получить последние уведомления'),
+        BotCommand('push', 'Включить/выключить уведомления о новых оценках и ДЗ'),
+        BotCommand('export', 'Выгрузить расписание или ДЗ в файл .ics/.csv')
     ], scope=BotCommandScopeAllPrivateChats(), language_code='ru')
 
+
+async def post_shutdown(application: Application) -> None:
+    await metrics.stop()
+    await push_poller.stop()
+    await prefetcher.stop()
+    await meshapi.stop()
+    print('Response cache:', meshapi.response_cache.stats())
+    print('Outbox:', outbox_limiter.stats())
+    print('Updates:', update_processor.stats())
+    print('Presses:', presses.stats())
+    print('Tokens:', meshapi.token_stats)
+    print('Prefetch:', prefetcher.stats(), f'hit rate {prefetch_hit_rate():.0%}')
+    print('Token prompts:', token_messages.stats())
+
+    if env.get('persist_state'):
+        token_messages.save('token_messages.json')
+    await logsink.stop()
+
 if __name__ == '__main__':
-    meshapi.load_db()
-
-    app = ApplicationBuilder().token(env['token']).post_init(post_init).build()
-    app.add_handler(CommandHandler('start', start))
-    app.add_handler(CommandHandler('profile', profile_cmd))
-    app.add_handler(CommandHandler('schedule', schedule_cmd))
-    app.add_handler(CommandHandler('homework', homework_cmd))
-    app.add_handler(CommandHandler('marksdate', marksdate_cmd))
-    app.add_handler(CommandHandler('marks', marks_cmd))
-    app.add_handler(CommandHandler('notifications', notifications_cmd))
-    app.add_handler(CommandHandler('refreshtoken', refreshtoken_cmd))
-    app.add_handler(CallbackQueryHandler(callback))
-    app.add_handler(MessageHandler(filters.REPLY, reply_callback))
-
-    app.run_polling()
+    print('Starting bot')
+
+    with open('env.json', 'r') as f:
+        env = json.load(f)
+
+    if 'shared' in env:
+        # {"shared": {"backend": "redis", "host": "10.0.0.5", "port": 6379}}: workers share users, state and caches
+        shared_backend = shared.connect(**env['shared'])
+        meshapi.use_shared(shared_backend)
+        token_messages = state.SharedStateStore('token_messages', shared_backend, TOKEN_PROMPT_TTL)
+    else:
+        meshapi.load_db()
+
+    # handlers of different chats run concurrently, those of one chat in order
+    update_processor = processor.ChatProcessor(**env.get('updates', {}))
+    # repeated presses of the same button don't go to MESH again
+    presses = debounce.Debouncer(**env.get('debounce', {}))
+
+    app = ApplicationBuilder().token(env['token']).rate_limiter(outbox_limiter).concurrent_updates(update_processor) \
+        .post_init(post_init).post_shutdown(post_shutdown).build()
+    app.add_handler(CommandHandler('start', metrics.instrument_handler('start', start)))
+    app.add_handler(CommandHandler('profile', metrics.instrument_handler('profile', profile_cmd)))
+    app.add_handler(CommandHandler('schedule', metrics.instrument_handler('schedule', schedule_cmd)))
+    app.add_handler(CommandHandler('homework', metrics.instrument_handler('homework', homework_cmd)))
+    app.add_handler(CommandHandler('marksdate', metrics.instrument_handler('marksdate', marksdate_cmd)))
+    app.add_handler(CommandHandler('marks', metrics.instrument_handler('marks', marks_cmd)))
+    app.add_handler(CommandHandler('notifications', metrics.instrument_handler('notifications', notifications_cmd)))
+    app.add_handler(CommandHandler('refreshtoken', metrics.instrument_handler('refreshtoken', refreshtoken_cmd)))
+    app.add_handler(CommandHandler('push', metrics.instrument_handler('push', push_cmd)))
+    app.add_handler(CommandHandler('export', metrics.instrument_handler('export', export_cmd)))
+    app.add_handler(CallbackQueryHandler(metrics.instrument_handler('callback', callback)))
+    app.add_handler(MessageHandler(filters.REPLY, metrics.instrument_handler('reply', reply_callback)))
+
+    if 'webhook' in env:
+        # {"webhook": {"secret_token": "...", "url": "https://bot.example.com", "port": 8080, ...}}
+        config = dict(env['webhook'])
+        webhook_server = webhook.Webhook(app, config.pop('secret_token'), config.pop('path', '/telegram'))
+        webhook.run(app, webhook_server, **config)
+    else:
+        app.run_polling()
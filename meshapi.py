@@ -1,4 +1,3 @@
-import requests
 from datetime import datetime
 from pytz import timezone
 from dateutil.relativedelta import relativedelta
@@ -6,125 +5,499 @@ import aiohttp
 import asyncio
 import json
 import os
+import random
+import time
+from urllib.parse import urlsplit
+
+import breaker
+import cache
+import logsink
+import metrics
+import models
+import storage
+
+db = storage.TokenDB(storage.MemoryStorage())
+
+SCHOOL_URL = 'https://school.mos.ru'
+DNEVNIK_URL = 'https://dnevnik.mos.ru'
+
+# academic years and subject names barely change, so they are kept across restarts
+refdata = {
+    'academic_years': [],
+    'subjects': {}
+}
+refdata_task: asyncio.Task = None
+REFDATA_REFRESH_INTERVAL = 6 * 60 * 60
+# processed homework entries and resolved launch urls are kept this long after they were last written
+HOMEWORK_KV_TTL = 30 * 24 * 60 * 60
+REFDATA_PATH = 'refdata.json'
+
+session: aiohttp.ClientSession = None
+
+# defaults for the shared client, can be overridden through env.json ("http" section)
+TOTAL_TIMEOUT = 30
+CONNECT_TIMEOUT = 10
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 30
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+
+# fan-out settings for async_request
+FANOUT_CONCURRENCY = 6
+FANOUT_TIMEOUT = 10
+FANOUT_RETRIES = 2
+FANOUT_BACKOFF = 0.5
+
+# MESH answers these to a token that expired or was revoked
+AUTH_ERRORS = (401, 403)
+# stored tokens are checked in the background, so dead ones are found before their users press a button
+token_task: asyncio.Task = None
+TOKEN_CHECK_INTERVAL = 6 * 60 * 60
+TOKEN_CHECK_CONCURRENCY = 4
+token_stats = {'checked': 0, 'invalidated': 0, 'skipped': 0}
+
+
+def load_db(path='db.sqlite3') -> None:
+    global db
 
-db = {}
+    backend = storage.SQLiteStorage(path)
+    migrated = backend.migrate_json('db.json')
+    if migrated:
+        print(f'Migrated {migrated} users from db.json')
+    db = storage.TokenDB(backend)
 
 
-def load_db() -> None:
+def use_shared(backend, cache_ttl=5) -> None:
+    """Keeps users and cached responses in a shared.Backend, for several workers serving the same users."""
     global db
 
-    with open('db.json', 'r', encoding='utf-8') as f:
-        db = json.load(f)
+    db = storage.TokenDB(storage.SharedStorage(backend), cache_ttl=cache_ttl)
+    response_cache.shared = backend
 
-    if not os.path.exists("logs"):
-        os.mkdir("logs")
 
-    if os.path.exists('logs/log.txt'):
-        (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat('logs/log.txt')
-        creation_date = datetime.fromtimestamp(mtime).strftime('%d_%m_%Y__%H_%M_%S')
-        new_name = f"logs/log_{creation_date}.txt"
-        os.rename('logs/log.txt', new_name)
+async def update_user(chat_id, **fields) -> None:
+    global db
+    record = await db.get(chat_id)
+    if record is not None:
+        await db.set(chat_id, {**record, **fields})
 
-    open('logs/log.txt', 'w').close()
 
+async def active_user(chat_id) -> dict:
+    """The chat's record if it has a token that MESH hasn't rejected yet; calls with a rejected one are skipped."""
+    record = await db.get(chat_id)
+    if record is None:
+        return None
+    if record.get('token_invalid'):
+        token_stats['skipped'] += 1
+        return None
+    return record
 
-def save_db() -> None:
-    global db
 
-    with open('db.json', 'w', encoding='utf-8') as f:
-        json.dump(db, f, indent=4, ensure_ascii=False)
+async def token_invalid(chat_id) -> bool:
+    record = await db.get(chat_id)
+    return record is not None and record.get('token_invalid', False)
+
+
+async def mark_token_invalid(chat_id) -> None:
+    record = await db.get(chat_id)
+    if record is not None and not record.get('token_invalid'):
+        await db.set(chat_id, {**record, 'token_invalid': True})
+        token_stats['invalidated'] += 1
+        logsink.log('token_invalid', chat_id=chat_id)
+
+
+async def check_auth(chat_id, code) -> None:
+    if code in AUTH_ERRORS:
+        await mark_token_invalid(chat_id)
+
+
+async def student_of(chat_id):
+    record = await db.get(chat_id)
+    return record['student_id'] if record is not None else None
+
+
+response_cache = cache.Cache(scope=student_of)
+# per upstream path; settings can be overridden with start(circuit_breaker={...})
+breakers = breaker.Breakers()
+
+SCHEDULE_PAST_TTL = 24 * 60 * 60
+SCHEDULE_CURRENT_TTL = 5 * 60
+
+
+def range_ttl(past, current):
+    # ranges that end before today don't change anymore, anything touching today does
+    def ttl(date1: datetime, date2: datetime):
+        return past if date2.date() < datetime.today().date() else current
+    return ttl
+
+
+def load_refdata() -> None:
+    global refdata
+
+    if os.path.exists(REFDATA_PATH):
+        with open(REFDATA_PATH, 'r', encoding='utf-8') as f:
+            refdata.update(json.load(f))
+
+
+def save_refdata() -> None:
+    with open(REFDATA_PATH + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(refdata, f, ensure_ascii=False)
+    os.replace(REFDATA_PATH + '.tmp', REFDATA_PATH)
+
+
+async def refresh_academic_years() -> bool:
+    try:
+        code, data = await fetch('GET', f"{DNEVNIK_URL}/core/api/academic_years")
+        if code != 200:
+            return False
+
+        refdata['academic_years'] = json.loads(data)
+        save_refdata()
+        return True
+    except Exception as e:
+        logsink.log_error('academic_years', None, e)
+        return False
+
+
+async def refdata_refresher() -> None:
+    while True:
+        await asyncio.sleep(REFDATA_REFRESH_INTERVAL)
+        await refresh_academic_years()
+        await db.storage.prune()
+
+
+async def current_year_id():
+    years = [year['id'] for year in refdata['academic_years'] if year['current_year'] == True]
+    if not years and await refresh_academic_years():
+        years = [year['id'] for year in refdata['academic_years'] if year['current_year'] == True]
+    return years[0] if years else None
+
+
+async def subject_names(ids, token, student_id) -> dict:
+    """Maps subject ids (as strings) to names, asking MESH only for ids that aren't known yet. Returns None on failure."""
+    subjects = refdata['subjects']
+
+    missing = sorted({str(x) for x in ids} - subjects.keys())
+    if missing:
+        code, data = await fetch('GET', f'{DNEVNIK_URL}/core/api/subjects?ids={",".join(missing)}', headers={
+            'Auth-token': token,
+            'Profile-Id': student_id
+        }, cookies={
+            'auth_token': token,
+            'student_id': student_id
+        })
+
+        if code != 200:
+            return None
+
+        for entry in models.loads(data):
+            subjects[str(entry['id'])] = entry['name']
+        save_refdata()
+
+    return {str(x): subjects[str(x)] for x in ids}
+
+
+async def check_token(chat_id) -> None:
+    record = await db.get(chat_id)
+    if record is None or record.get('token_invalid'):
+        return
+    code, _ = await fetch('GET', f"{SCHOOL_URL}/api/family/mobile/v1/profile", headers={
+        'auth-token': record['token'],
+        'profile-id': record['student_id'],
+        'x-mes-subsystem': 'familymp'
+    })
+    token_stats['checked'] += 1
+    await check_auth(chat_id, code)
+
+
+async def validate_tokens(chat_ids, concurrency=TOKEN_CHECK_CONCURRENCY) -> None:
+    """Checks the tokens of chat_ids with `concurrency` workers, marking the rejected ones invalid."""
+    chat_ids = iter(list(chat_ids))
+
+    async def worker():
+        # the workers share one iterator, so there is no task per chat
+        for chat_id in chat_ids:
+            try:
+                await check_token(chat_id)
+            except breaker.CircuitOpen:
+                pass
+            except Exception as e:
+                logsink.log_error('token_check', chat_id, e)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+async def token_validator(interval) -> None:
+    while True:
+        await asyncio.sleep(interval * random.uniform(0.5, 1))
+        await validate_tokens(await db.keys())
 
 
 def date_to_msk(date) -> datetime:
     return timezone("Etc/UTC").localize(date).astimezone(timezone('Europe/Moscow'))
 
 
-async def get(url, session: aiohttp.ClientSession, headers, cookies):
+async def start(total_timeout=TOTAL_TIMEOUT, connect_timeout=CONNECT_TIMEOUT, limit=POOL_LIMIT,
+                limit_per_host=POOL_LIMIT_PER_HOST, keepalive_timeout=KEEPALIVE_TIMEOUT, dns_cache_ttl=DNS_CACHE_TTL,
+                fanout_concurrency=FANOUT_CONCURRENCY, fanout_timeout=FANOUT_TIMEOUT, fanout_retries=FANOUT_RETRIES,
+                circuit_breaker=None, token_check_interval=TOKEN_CHECK_INTERVAL) -> None:
+    global session, refdata_task, token_task, breakers, FANOUT_CONCURRENCY, FANOUT_TIMEOUT, FANOUT_RETRIES
+
+    if circuit_breaker:
+        breakers = breaker.Breakers(**circuit_breaker)
+
+    FANOUT_CONCURRENCY = fanout_concurrency
+    FANOUT_TIMEOUT = fanout_timeout
+    FANOUT_RETRIES = fanout_retries
+
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, keepalive_timeout=keepalive_timeout,
+                                     use_dns_cache=True, ttl_dns_cache=dns_cache_ttl)
+    # cookies are passed per request, so the shared jar must not remember them between users
+    session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar(),
+                                    timeout=aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout))
+
+    load_refdata()
+    await db.storage.prune()
+    await refresh_academic_years()
+    refdata_task = asyncio.create_task(refdata_refresher())
+    token_task = asyncio.create_task(token_validator(token_check_interval))
+
+
+async def stop() -> None:
+    global session, refdata_task, token_task
+
+    if refdata_task is not None:
+        refdata_task.cancel()
+        refdata_task = None
+
+    if token_task is not None:
+        token_task.cancel()
+        token_task = None
+
+    if session is not None:
+        await session.close()
+        session = None
+
+    if isinstance(db, storage.TokenDB):
+        await db.storage.close()
+
+
+async def fetch(method, url, headers=None, cookies=None, payload=None, timeout=None) -> tuple[int, str]:
+    endpoint = urlsplit(url).path
+    circuit = breakers.get(endpoint)
+    if not circuit.allow():
+        # fail fast while the endpoint is down instead of waiting for the timeout again
+        metrics.upstream_errors.inc(endpoint, 'CircuitOpen')
+        raise breaker.CircuitOpen(endpoint)
+
+    metrics.upstream_in_flight.inc(endpoint)
+    started = time.monotonic()
     try:
-        async with session.get(url=url, headers=headers, cookies=cookies) as response:
-            resp = await response.text()
-            return resp, response.status
+        # timeout=None would turn the session's timeouts off, so it is only passed when a call sets its own
+        kwargs = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        async with session.request(method, url, headers=headers, cookies=cookies, json=payload, **kwargs) as response:
+            text = await response.text()
+    except asyncio.CancelledError:
+        circuit.cancel()
+        raise
     except Exception as e:
-        print("Unable to get url {} due to {}.".format(url, e.__class__))
+        circuit.failure()
+        metrics.upstream_errors.inc(endpoint, e.__class__.__name__)
+        logsink.log('upstream_error', endpoint=endpoint, method=method, latency=round(time.monotonic() - started, 3),
+                    exception=e.__class__.__name__)
+        raise
+    finally:
+        metrics.upstream_in_flight.dec(endpoint)
+        metrics.upstream_seconds.observe(endpoint, value=time.monotonic() - started)
+
+    metrics.upstream_responses.inc(endpoint, response.status)
+    if response.status >= 500 or response.status == 429:
+        circuit.failure()
+    else:
+        # a 401 for a bad token still means the endpoint is up
+        circuit.success(time.monotonic() - started)
+    if response.status >= 400:
+        logsink.log('upstream_error', endpoint=endpoint, method=method, latency=round(time.monotonic() - started, 3),
+                    status=response.status)
+    return response.status, text
+
+
+async def get(url, headers, cookies, semaphore: asyncio.Semaphore, ok_codes, chat_id=None):
+    for attempt in range(FANOUT_RETRIES + 1):
+        if attempt > 0:
+            # full jitter, so retries of one fan-out don't hit the server at the same moment
+            await asyncio.sleep(random.uniform(0, FANOUT_BACKOFF * 2 ** attempt))
+
+        try:
+            async with semaphore:
+                # once one day of a fan-out gets a 401 the token is marked, the queued ones don't try it again
+                if chat_id is not None and await token_invalid(chat_id):
+                    return None
+                code, resp = await fetch('GET', url, headers, cookies, timeout=FANOUT_TIMEOUT)
+        except breaker.CircuitOpen:
+            return None
+        except Exception:
+            # already logged by fetch
+            continue
+
+        if code in ok_codes:
+            return resp
+        if chat_id is not None:
+            await check_auth(chat_id, code)
+        if code < 500 and code != 429:
+            # retrying won't help with a bad token or a bad request
+            return None
+
+    return None
+
 
+async def async_request(urls, headers={}, cookies={}, ok_codes=(200,), chat_id=None) -> list:
+    """Fetches all urls with at most FANOUT_CONCURRENCY requests in flight.
 
-async def async_request(urls, headers={}, cookies={}):
-    async with aiohttp.ClientSession() as session:
-        result = await asyncio.gather(*[get(url, session, headers, cookies) for url in urls])
-        res_code = 200
-        for _, code in result:
-            if code != 200:
-                res_code = code
-        return [x[0] for x in result], res_code
+    Every url is retried on timeouts and server errors, and a failed url doesn't fail the others:
+    the result has the body for every url in order, or None where the url couldn't be fetched.
+    With chat_id, auth errors mark the chat's token and stop the urls that haven't been sent yet.
+    """
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    return await asyncio.gather(*[get(url, headers, cookies, semaphore, ok_codes, chat_id) for url in urls])
 
 
+@metrics.instrument_call('profile')
+@response_cache.cached('profile', 60 * 60)
 async def profile(chat_id):
-    global db
-    if not chat_id in db:
+    record = await active_user(chat_id)
+    if record is None:
         return None
 
-    token = db[chat_id]['token']
-    student_id = db[chat_id]['student_id']
+    token = record['token']
+    student_id = record['student_id']
 
     try:
-        data = requests.get("https://school.mos.ru/api/family/mobile/v1/profile", headers={
+        code, data = await fetch('GET', f"{SCHOOL_URL}/api/family/mobile/v1/profile", headers={
             'auth-token': token,
             'profile-id': student_id,
             'x-mes-subsystem': 'familymp'
         })
-        if data.status_code != 200:
+        if code != 200:
+            await check_auth(chat_id, code)
             return None
-        return data.text
+        return models.Profile.from_json(data)
     except Exception as e:
-        with open('logs/log.txt', 'a') as f:
-            f.write(f'{datetime.now().strftime("[%d.%m.%Y %H:%M:%S]")} Error: "profile" for chat_id {chat_id} ({str(e)})')
+        logsink.log_error('profile', chat_id, e)
         return None
 
 
-async def schedule(chat_id, date1: datetime, date2: datetime):
-    global db
-    if not chat_id in db:
+@metrics.instrument_call('schedule')
+async def schedule(chat_id, date1: datetime, date2: datetime, prefetch_ttl=None):
+    """With prefetch_ttl the days are reloaded and kept that long, to be served from the cache later."""
+    record = await active_user(chat_id)
+    if record is None:
         return None
 
-    token = db[chat_id]['token']
-    student_id = db[chat_id]['student_id']
+    token = record['token']
+    student_id = record['student_id']
 
     try:
-        urls = []
+        headers = {
+            "x-mes-subsystem": "familymp",
+            "auth-token": token
+        }
+        semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+        today = datetime.today().date()
+
+        # days are cached one by one, so overlapping ranges only fetch the days that aren't stored yet
+        def load_day(date: datetime):
+            url = f"{SCHOOL_URL}/api/family/mobile/v1/schedule/?student_id={student_id}&date={date.strftime('%Y-%m-%d')}"
+            ttl = prefetch_ttl or (SCHEDULE_PAST_TTL if date.date() < today else SCHEDULE_CURRENT_TTL)
+
+            # days are cached decoded, so a cache hit doesn't parse the payload again
+            async def load():
+                text = await get(url, headers, {}, semaphore, (200,), chat_id)
+                return models.ScheduleDay.from_json(text) if text is not None else None
+
+            return response_cache.load(('schedule', student_id, date.date()), ttl, load, prefetch=prefetch_ttl is not None)
+
+        dates = []
 
         date = date1
         while True:
-            urls.append(f"https://school.mos.ru/api/family/mobile/v1/schedule/?student_id={student_id}&date={date.strftime('%Y-%m-%d')}")
+            dates.append(date)
 
             date += relativedelta(days=1)
             if date > date2:
                 break
 
-        res, code = await async_request(urls, {
-            "x-mes-subsystem": "familymp",
-            "auth-token": token
-        })
+        res = await asyncio.gather(*[load_day(date) for date in dates])
 
-        if code != 200:
+        if all(x is None for x in res):
             return None
-        
-        return res
+
+        # days that failed are kept as None so the rest can still be shown
+        return list(zip(dates, res))
     except Exception as e:
-        with open('logs/log.txt', 'a') as f:
-            f.write(f'{datetime.now().strftime("[%d.%m.%Y %H:%M:%S]")} Error: "schedule" for chat_id {chat_id} ({str(e)})')
+        logsink.log_error('schedule', chat_id, e)
         return None
 
 
+EXECUTE_TESTS = ['TestSpecBinding', 'Workbook', 'FizikonModule']
+
+
+def homework_entry(entry) -> models.HomeworkEntry:
+    attachments = [models.Attachment(att['file_file_name'], ('https://dnevnik.mos.ru' + att['path']).replace(' ', '%20'))
+                   for att in entry['homework_entry']['attachments']]
+    tests = models.homework_materials(entry)
+
+    return models.HomeworkEntry(
+        entry['homework_entry']['homework']['subject']['name'],
+        entry['homework_entry']['description'],
+        date_to_msk(datetime.strptime(entry['created_at'], '%d.%m.%Y %H:%M')).strftime("%d.%m.%Y %H:%M"),
+        date_to_msk(datetime.strptime(entry['updated_at'], '%d.%m.%Y %H:%M')).strftime("%d.%m.%Y %H:%M"),
+        attachments,
+        [models.Test(test.name, test.uuid) for test in tests if test.type in EXECUTE_TESTS],
+        len([x for x in tests if x.type not in EXECUTE_TESTS])
+    )
+
+
+async def resolve_launch_urls(chat_id, entries, token, student_id) -> None:
+    """Fills in test launch urls of (entry_id, updated_at, obj) entries, asking MESH only for urls that aren't stored."""
+    tests = {f'{entry_id}/{test.material_id}': test for entry_id, _, obj in entries for test in obj.execute}
+    if not tests:
+        return
+
+    # urls are resolved with the student's token, so they are stored per student
+    stored = await db.storage.get_values('launch_url', [f'{student_id}:{key}' for key in tests])
+    stored = {key.split(':', 1)[1]: url for key, url in stored.items()}
+    missing = [key for key in tests if key not in stored]
+
+    urls = await async_request([
+        f'{SCHOOL_URL}/api/ej/partners/v1/homeworks/launch?homework_entry_id={key.split("/")[0]}&material_id={key.split("/")[1]}'
+        for key in missing
+    ], headers={
+        'Auth-Token': token,
+        'Profile-Id': student_id,
+        'X-Mes-Subsystem': 'familyweb'
+    }, ok_codes=(200, 302), chat_id=chat_id)
+
+    resolved = {key: url for key, url in zip(missing, urls) if url is not None}
+    if resolved:
+        await db.storage.put_values('launch_url', {f'{student_id}:{key}': url for key, url in resolved.items()}, HOMEWORK_KV_TTL)
+
+    for key, test in tests.items():
+        test.url = stored.get(key) or resolved.get(key)
+
+
+@metrics.instrument_call('homework')
+@response_cache.cached('homework', range_ttl(6 * 60 * 60, 5 * 60))
 async def homework(chat_id, date1: datetime, date2: datetime):
-    global db
-    if not chat_id in db:
+    record = await active_user(chat_id)
+    if record is None:
         return None
 
-    token = db[chat_id]['token']
-    student_id = db[chat_id]['student_id']
+    token = record['token']
+    student_id = record['student_id']
 
     try:
-        data = requests.get(f'https://dnevnik.mos.ru/core/api/student_homeworks?begin_prepared_date={date1.strftime("%d.%m.%Y")}&end_prepared_date={date2.strftime("%d.%m.%Y")}&student_profile_id={student_id}', headers={
+        code, data = await fetch('GET', f'{DNEVNIK_URL}/core/api/student_homeworks?begin_prepared_date={date1.strftime("%d.%m.%Y")}&end_prepared_date={date2.strftime("%d.%m.%Y")}&student_profile_id={student_id}', headers={
             "Auth-token": token,
             "Profile-Id": student_id
         }, cookies={
@@ -132,82 +505,62 @@ async def homework(chat_id, date1: datetime, date2: datetime):
             "student_id": student_id
         })
 
-        if data.status_code != 200:
+        if code != 200:
+            await check_auth(chat_id, code)
             return None
 
         res = {}
 
-        test_urls = []
-        execute_tests = ['TestSpecBinding', 'Workbook', 'FizikonModule']
+        entries = models.loads(data)
+        # entries whose updated_at didn't change since they were last processed are taken as they are
+        # updated_at is the student's own, so entries are stored per student
+        known = await db.storage.get_values('homework', [f'{student_id}:{entry["homework_entry"]["id"]}' for entry in entries])
+        changed = []
 
-        for entry in data.json():
-            obj = {}
+        for entry in entries:
+            entry_id = f'{student_id}:{entry["homework_entry"]["id"]}'
             date = entry['homework_entry']['homework']['date_prepared_for']
-            obj['created_at'] = date_to_msk(datetime.strptime(entry['created_at'], '%d.%m.%Y %H:%M')).strftime("%d.%m.%Y %H:%M")
-            obj['updated_at'] = date_to_msk(datetime.strptime(entry['updated_at'], '%d.%m.%Y %H:%M')).strftime("%d.%m.%Y %H:%M")
-            obj['text'] = entry['homework_entry']['description']
-            obj['subject'] = entry['homework_entry']['homework']['subject']['name']
-
-            obj['attachements'] = []
-            for att in entry['homework_entry']['attachments']:
-                obj['attachements'].append({
-                    'name': att['file_file_name'],
-                    'url': ('https://dnevnik.mos.ru' + att['path']).replace(' ', '%20')
-                })
-
-            tests = json.loads(entry['homework_entry']['data'])['materialObj']
-
-            obj['tests'] = {
-                'execute': [],
-                'examine': len([x for x in tests if x['type'] not in execute_tests])
-            }
-
-            for test in tests:
-                if test['type'] in execute_tests:
-                    obj['tests']['execute'].append({
-                        'name': test['name'],
-                        'url': len(test_urls)
-                    })
-                    test_urls.append(
-                        f'https://school.mos.ru/api/ej/partners/v1/homeworks/launch?homework_entry_id={entry["homework_entry"]["id"]}&material_id={test["uuid"]}')
+
+            if entry_id in known and known[entry_id]['updated_at'] == entry['updated_at']:
+                obj = models.from_plain(known[entry_id]['obj'])
+            else:
+                obj = homework_entry(entry)
+                changed.append((entry_id, entry['updated_at'], obj))
 
             if date not in res:
                 res[date] = []
             res[date].append(obj)
 
-        test_urls2, code = await async_request(test_urls, headers={
-            'Auth-Token': token,
-            'Profile-Id': student_id,
-            'X-Mes-Subsystem': 'familyweb'
-        })
+        await resolve_launch_urls(chat_id, [(entry_id.split(':', 1)[1], updated_at, obj) for entry_id, updated_at, obj in changed],
+                                  token, student_id)
 
-        if code != 200 and code != 302:
-            return None
-
-        for date, entries in res.items():
-            for entry in entries:
-                for test in entry['tests']['execute']:
-                    test['url'] = test_urls2[test['url']]
+        # entries with links that couldn't be resolved are processed again next time
+        await db.storage.put_values('homework', {
+            entry_id: {'updated_at': updated_at, 'obj': models.to_plain(obj)}
+            for entry_id, updated_at, obj in changed
+            if all(test.url is not None for test in obj.execute)
+        }, HOMEWORK_KV_TTL)
 
         res = sorted(res.items(), key=lambda x: (datetime.strptime(x[0], '%d.%m.%Y')))
 
         return res
     except Exception as e:
-        with open('logs/log.txt', 'a') as f:
-            f.write(f'{datetime.now().strftime("[%d.%m.%Y %H:%M:%S]")} Error: "homework" for chat_id {chat_id} ({str(e)})')
+        logsink.log_error('homework', chat_id, e)
         return None
 
 
+@metrics.instrument_call('marksdate')
+@response_cache.cached('marksdate', range_ttl(60 * 60, 60))
 async def marksdate(chat_id, date1: datetime, date2: datetime):
-    global db
-    if not chat_id in db:
+    record = await active_user(chat_id)
+    if record is None:
         return None
 
-    token = db[chat_id]['token']
-    student_id = db[chat_id]['student_id']
+    token = record['token']
+    student_id = record['student_id']
 
     try:
-        data = requests.get(f"https://dnevnik.mos.ru/core/api/marks?created_at_from={date1.strftime('%d.%m.%Y')}&created_at_to={date2.strftime('%d.%m.%Y')}&student_profile_id={student_id}", headers={
+        code, data = await fetch('GET', f"{DNEVNIK_URL}/core/api/marks?created_at_from={date1.strftime('%d.%m.%Y')}&created_at_to={date2.strftime('%d.%m.%Y')}&student_profile_id={student_id}", headers={
             "Auth-token": token,
             "Profile-Id": student_id
         }, cookies={
@@ -215,12 +568,13 @@ async def marksdate(chat_id, date1: datetime, date2: datetime):
             'student_id': student_id
         })
 
-        if data.status_code != 200:
+        if code != 200:
+            await check_auth(chat_id, code)
             return None
 
         res = {}
 
-        for entry in data.json():
+        for entry in models.loads(data):
             date = entry['date']
             if not date in res:
                 res[date] = {}
@@ -229,31 +583,12 @@ async def marksdate(chat_id, date1: datetime, date2: datetime):
             if not subject_id in res[date]:
                 res[date][subject_id] = []
 
-            res[date][subject_id].append({
-                'value': int(entry['name']),
-                'weight': int(entry['weight']),
-                'comment': entry['comment'],
-                # 'created_at': date_to_msk(datetime.strptime(entry['created_at'], '%d.%m.%Y %H:%M')).strftime('%d.%m.%Y %H:%M'),
-                # 'updated_at': date_to_msk(datetime.strptime(entry['updated_at'], '%d.%m.%Y %H:%M')).strftime('%d.%m.%Y %H:%M'),
-                'is_exam': entry['is_exam']
-            })
-
-        subj_url = f'https://dnevnik.mos.ru/core/api/subjects?ids={",".join([str(element) for day in res.values() for element in day])}'
-        data2 = requests.get(subj_url, headers={
-            'Auth-token': token,
-            'Profile-Id': student_id
-        }, cookies={
-            'auth_token': token,
-            'student_id': student_id
-        })
+            res[date][subject_id].append(models.Mark(int(entry['name']), int(entry['weight']), entry['is_exam'], entry['comment']))
 
-        if data2.status_code != 200:
+        subjects = await subject_names({subject_id for day in res.values() for subject_id in day}, token, student_id)
+        if subjects is None:
             return None
 
-        subjects = {}
-        for entry in data2.json():
-            subjects[str(entry['id'])] = entry['name']
-
         for day in res.values():
             for subj in list(day.keys()):
                 day[subjects[subj]] = day.pop(subj)
@@ -262,24 +597,26 @@ async def marksdate(chat_id, date1: datetime, date2: datetime):
 
         return res
     except Exception as e:
-        with open('logs/log.txt', 'a') as f:
-            f.write(f'{datetime.now().strftime("[%d.%m.%Y %H:%M:%S]")} Error: "marksdate" for chat_id {chat_id} ({str(e)})')
+        logsink.log_error('marksdate', chat_id, e)
         return None
 
 
+@metrics.instrument_call('marks')
+@response_cache.cached('marks', 60)
 async def marks(chat_id):
-    global db
-    if not chat_id in db:
+    record = await active_user(chat_id)
+    if record is None:
         return None
 
-    token = db[chat_id]['token']
-    student_id = db[chat_id]['student_id']
+    token = record['token']
+    student_id = record['student_id']
 
     try:
-        years = requests.get("https://dnevnik.mos.ru/core/api/academic_years")
-        this_year = [year['id'] for year in years.json() if year['current_year'] == True][0]
+        this_year = await current_year_id()
+        if this_year is None:
+            return None
 
-        data = requests.get(f'https://dnevnik.mos.ru/reports/api/progress/json?academic_year_id={this_year}&student_profile_id={student_id}', headers={
+        code, data = await fetch('GET', f'{DNEVNIK_URL}/reports/api/progress/json?academic_year_id={this_year}&student_profile_id={student_id}', headers={
             'Auth-Token': token,
             'Profile-Id': student_id
         }, cookies={
@@ -287,64 +624,39 @@ async def marks(chat_id):
             'student_id': student_id
         })
 
-        if data.status_code != 200:
+        if code != 200:
+            await check_auth(chat_id, code)
             return None
 
-        res = {}
-
-        for entry in data.json():
-            obj = {}
-            res[entry['subject_name']] = obj
-
-            obj['avg'] = entry['avg_five']
-
-            obj['periods'] = {}
-            for period in entry['periods']:
-                obj2 = {}
-                obj['periods'][period['name']] = obj2
-
-                obj2['marks'] = []
-                for mark in period['marks']:
-                    obj2['marks'].append({
-                        'value': int(mark['values'][0]['original']),
-                        'weight': mark['weight'],
-                        'is_exam': mark['is_exam']
-                    })
-
-                obj2['avg'] = period['avg_five']
-                obj2['final_mark'] = period['final_mark'] if 'final_mark' in period else None
-
-        # print(res)
-
-        return res
+        return models.progress(data)
     except Exception as e:
-        with open('logs/log.txt', 'a') as f:
-            f.write(f'{datetime.now().strftime("[%d.%m.%Y %H:%M:%S]")} Error: "marks" for chat_id {chat_id} ({str(e)})')
+        logsink.log_error('marks', chat_id, e)
         return None
 
 
+@metrics.instrument_call('notifications')
 async def notifications(chat_id):
-    global db
-    if not chat_id in db:
+    record = await active_user(chat_id)
+    if record is None:
         return None
 
-    token = db[chat_id]['token']
-    student_id = db[chat_id]['student_id']
+    token = record['token']
+    student_id = record['student_id']
 
     try:
-        data = requests.get(f"https://school.mos.ru/api/family/mobile/v1/notifications/search?student_id={student_id}", headers={
+        code, data = await fetch('GET', f"{SCHOOL_URL}/api/family/mobile/v1/notifications/search?student_id={student_id}", headers={
             'Auth-Token': token,
             'Profile-Id': student_id,
             "x-mes-subsystem": "familymp"
         })
 
-        if data.status_code != 200:
+        if code != 200:
+            await check_auth(chat_id, code)
             return None
 
-        return data.json()
+        return models.loads(data)
     except Exception as e:
-        with open('logs/log.txt', 'a') as f:
-            f.write(f'{datetime.now().strftime("[%d.%m.%Y %H:%M:%S]")} Error: "notifications" for chat_id {chat_id} ({str(e)})')
+        logsink.log_error('notifications', chat_id, e)
         return None
 
 
@@ -352,29 +664,34 @@ async def try_add_new_token(token, chat_id) -> bool:
     global db
 
     # get profile id
-    req = requests.post("https://dnevnik.mos.ru/lms/api/sessions", json={
-        'auth_token': token
-    }, headers={
-        'Auth-Token': token
-    }, cookies={
-        'auth_token': token
-    })
+    try:
+        code, data = await fetch('POST', f"{DNEVNIK_URL}/lms/api/sessions", payload={
+            'auth_token': token
+        }, headers={
+            'Auth-Token': token
+        }, cookies={
+            'auth_token': token
+        })
+    except Exception as e:
+        print(f'Failed to get token info! ({e})')
+        return False
 
-    if req.status_code != 200:
+    if code != 200:
         print('Failed to get token info!')
         return False
 
-    data = req.json()
+    data = json.loads(data)
 
     student_id = str(data["profiles"][0]["id"])
 
     print(f'Token: {token[:100]}... Student id: {student_id} Name: {data["last_name"]} {data["first_name"]} {data["middle_name"]}')
 
-    db[str(chat_id)] = {
+    # other fields (push settings) are kept, the invalid mark goes away with the old token
+    record = {k: v for k, v in (await db.get(str(chat_id), {})).items() if k != 'token_invalid'}
+    await db.set(str(chat_id), {
+        **record,
         'token': token,
         'student_id': student_id
-    }
-
-    save_db()
+    })
 
     return True
@@ -0,0 +1,199 @@
+from aiohttp import web
+from functools import wraps
+import asyncio
+import bisect
+import time
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape(value) -> str:
+    # the text format wants backslashes, quotes and newlines in label values escaped
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric():
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for labels, value in self.values.items():
+            yield f'{self.name}{format_labels(self.labels, labels)} {value}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, value=1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, *labels, value) -> None:
+        self.values[labels] = value
+
+    def inc(self, *labels, value=1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def dec(self, *labels, value=1) -> None:
+        self.inc(*labels, value=-value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, *labels, value) -> None:
+        if labels not in self.values:
+            self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts, _, _ = entry = self.values[labels]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{format_labels((*self.labels, "le"), (*labels, bound))} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, labels)} {total}'
+            yield f'{self.name}_count{format_labels(self.labels, labels)} {count}'
+
+
+class Collected(Metric):
+    """Metric read at scrape time from func(), which returns a number or a {label value(s): number} dict."""
+
+    def __init__(self, name, help, func, type='gauge', labels=()) -> None:
+        super().__init__(name, help, labels)
+        self.type = type
+        self.func = func
+
+    def expose(self):
+        value = self.func()
+        self.values = {(k if isinstance(k, tuple) else (k,)): v for k, v in value.items()} if isinstance(value, dict) else {(): value}
+        yield from super().expose()
+
+
+registry = []
+
+
+def collect_stats(component, stats) -> None:
+    """Exposes a stats() dict of some component as bot_<component>{stat="..."} gauges."""
+    Collected(f'bot_{component}', f'{component} stats() read at scrape time', stats, labels=('stat',))
+
+upstream_seconds = Histogram('mesh_upstream_request_seconds', 'Latency of HTTP requests to MESH', ('endpoint',))
+upstream_responses = Counter('mesh_upstream_responses_total', 'HTTP responses from MESH', ('endpoint', 'status'))
+upstream_errors = Counter('mesh_upstream_errors_total', 'MESH requests that failed without a response', ('endpoint', 'error'))
+upstream_in_flight = Gauge('mesh_upstream_in_flight', 'MESH requests in flight', ('endpoint',))
+
+call_seconds = Histogram('meshapi_call_seconds', 'Latency of meshapi endpoint calls, cache hits included', ('endpoint',))
+call_failures = Counter('meshapi_call_failures_total', 'meshapi calls that returned no data', ('endpoint',))
+call_in_flight = Gauge('meshapi_call_in_flight', 'meshapi calls in flight', ('endpoint',))
+
+handler_seconds = Histogram('bot_handler_seconds', 'Latency of bot update handlers', ('handler',))
+handler_errors = Counter('bot_handler_errors_total', 'Exceptions raised by bot update handlers', ('handler', 'error'))
+handler_in_flight = Gauge('bot_handler_in_flight', 'Bot update handlers in flight', ('handler',))
+
+loop_lag = Histogram('event_loop_lag_seconds', 'How late the event loop woke up a sleeping task',
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+
+def instrument_call(endpoint):
+    """Decorator for meshapi endpoints: latency, in-flight count and calls that returned None."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            call_in_flight.inc(endpoint)
+            started = time.monotonic()
+            try:
+                result = await func(*args, **kwargs)
+            finally:
+                call_in_flight.dec(endpoint)
+                call_seconds.observe(endpoint, value=time.monotonic() - started)
+            if result is None:
+                call_failures.inc(endpoint)
+            return result
+        return wrapper
+    return decorator
+
+
+def instrument_handler(name, func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        handler_in_flight.inc(name)
+        started = time.monotonic()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            handler_errors.inc(name, e.__class__.__name__)
+            raise
+        finally:
+            handler_in_flight.dec(name)
+            handler_seconds.observe(name, value=time.monotonic() - started)
+    return wrapper
+
+
+async def sample_loop_lag(interval=0.5) -> None:
+    # a blocking call anywhere in the process shows up as a late wake-up here
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        loop_lag.observe(value=max(0.0, time.monotonic() - started - interval))
+
+
+def expose() -> str:
+    return '\n'.join(line for metric in registry for line in metric.expose()) + '\n'
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=expose(), content_type='text/plain', charset='utf-8')
+
+
+runner: web.AppRunner = None
+lag_task: asyncio.Task = None
+
+
+async def start(host='127.0.0.1', port=9464) -> None:
+    global runner, lag_task
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    lag_task = asyncio.create_task(sample_loop_lag())
+
+
+async def stop() -> None:
+    global runner, lag_task
+
+    if lag_task is not None:
+        lag_task.cancel()
+        lag_task = None
+    if runner is not None:
+        await runner.cleanup()
+        runner = None
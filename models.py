@@ -0,0 +1,167 @@
+from dataclasses import dataclass
+import json
+
+# orjson is optional, it only makes decoding faster
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+@dataclass(slots=True)
+class Activity():
+    type: str
+    begin_utc: int
+    end_utc: int
+    room_number: str = None
+    subject_name: str = None
+    replaced: bool = False
+    homework: str = None
+
+
+@dataclass(slots=True)
+class ScheduleDay():
+    date: str
+    summary: str
+    activities: list
+
+    @classmethod
+    def from_json(cls, text):
+        data = loads(text)
+        activities = []
+        for event in data['activities']:
+            lesson = event.get('lesson') if event['type'] == 'LESSON' else None
+            if lesson:
+                activities.append(Activity(event['type'], event['begin_utc'], event['end_utc'], event.get('room_number'),
+                                           lesson.get('subject_name'), lesson.get('replaced', False), lesson.get('homework')))
+            else:
+                activities.append(Activity(event['type'], event['begin_utc'], event['end_utc']))
+        return cls(data['date'], data['summary'], activities)
+
+
+@dataclass(slots=True)
+class Profile():
+    id: int
+    contingent_guid: str
+    last_name: str
+    first_name: str
+    middle_name: str
+    birth_date: str
+    phone: str
+    email: str
+    class_name: str
+    snils: str
+    school_id: int
+    school_name: str
+    school_short_name: str
+
+    @classmethod
+    def from_json(cls, text):
+        child = loads(text)['children'][0]
+        school = child.get('school') or {}
+        return cls(child.get('id'), child.get('contingent_guid'), child.get('last_name'), child.get('first_name'),
+                   child.get('middle_name'), child.get('birth_date'), child.get('phone'), child.get('email'),
+                   child.get('class_name'), child.get('snils'), school.get('id'), school.get('name'), school.get('short_name'))
+
+
+@dataclass(slots=True)
+class Material():
+    type: str
+    name: str
+    uuid: str
+
+
+def homework_materials(entry) -> list:
+    """Decodes the JSON string embedded in a homework entry, keeping only the materials."""
+    return [Material(x['type'], x['name'], x.get('uuid')) for x in loads(entry['homework_entry']['data'])['materialObj']]
+
+
+@dataclass(slots=True)
+class Attachment():
+    name: str
+    url: str
+
+
+@dataclass(slots=True)
+class Test():
+    name: str
+    material_id: str
+    url: str = None
+
+
+@dataclass(slots=True)
+class HomeworkEntry():
+    subject: str
+    text: str
+    created_at: str
+    updated_at: str
+    attachments: list
+    execute: list  # tests to do, with launch urls
+    examine: int  # number of materials that are only to be studied
+
+
+@dataclass(slots=True)
+class Mark():
+    value: int
+    weight: int
+    is_exam: bool
+    comment: str = ''
+
+
+@dataclass(slots=True)
+class Period():
+    name: str
+    avg: str
+    final_mark: str
+    marks: list
+
+
+@dataclass(slots=True)
+class SubjectMarks():
+    subject: str
+    avg: str
+    periods: list
+
+
+def progress(text) -> list:
+    """Decodes progress/json into SubjectMarks, keeping only what the marks report shows."""
+    return [SubjectMarks(entry['subject_name'], entry['avg_five'], [
+        Period(period['name'], period['avg_five'], period.get('final_mark'),
+               [Mark(int(mark['values'][0]['original']), mark['weight'], mark['is_exam']) for mark in period['marks']])
+        for period in entry['periods']
+    ]) for entry in loads(text)]
+
+
+MODELS = {cls.__name__: cls for cls in (Activity, ScheduleDay, Profile, Material, Attachment, Test, HomeworkEntry, Mark, Period,
+                                        SubjectMarks)}
+
+
+def to_plain(value):
+    """JSON-ready form of a cached value that keeps models, tuples and non-string dict keys intact."""
+    name = type(value).__name__
+    if name in MODELS:
+        return {'__model__': name, 'fields': [to_plain(getattr(value, field)) for field in value.__slots__]}
+    if isinstance(value, tuple):
+        return {'__tuple__': [to_plain(x) for x in value]}
+    if isinstance(value, list):
+        return [to_plain(x) for x in value]
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: to_plain(x) for key, x in value.items()}
+        return {'__items__': [[to_plain(key), to_plain(x)] for key, x in value.items()]}
+    return value
+
+
+def from_plain(value):
+    if isinstance(value, list):
+        return [from_plain(x) for x in value]
+    if isinstance(value, dict):
+        if '__model__' in value:
+            return MODELS[value['__model__']](*[from_plain(x) for x in value['fields']])
+        if '__tuple__' in value:
+            return tuple(from_plain(x) for x in value['__tuple__'])
+        if '__items__' in value:
+            return {from_plain(key): from_plain(x) for key, x in value['__items__']}
+        return {key: from_plain(x) for key, x in value.items()}
+    return value
@@ -0,0 +1,152 @@
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import asyncio
+import heapq
+import itertools
+import time
+
+# lower goes first: replacing "Загрузка..." matters more than sending the rest of a long answer
+PRIORITIES = {
+    'answerCallbackQuery': 0,
+    'editMessageText': 0,
+    'deleteMessage': 1,
+    'sendMessage': 2,
+    'sendDocument': 3
+}
+DEFAULT_PRIORITY = 2
+
+
+class TokenBucket():
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0 if it is available now)."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def full(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.capacity
+
+
+class Gate():
+    """Lets callers through at the bucket's rate, lowest priority value first, and can be paused for a RetryAfter."""
+
+    def __init__(self, rate, capacity) -> None:
+        self.bucket = TokenBucket(rate, capacity)
+        self.waiters = []  # heap of (priority, seq, future)
+        self.seq = itertools.count()
+        self.paused_until = 0
+        self.task: asyncio.Task = None
+
+    async def wait(self, priority) -> None:
+        if not self.waiters and self.paused_until <= time.monotonic() and self.bucket.delay() == 0:
+            self.bucket.consume()
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        if self.task is None:
+            self.task = asyncio.create_task(self.release())
+        await future
+
+    async def release(self) -> None:
+        try:
+            while self.waiters:
+                delay = max(self.paused_until - time.monotonic(), self.bucket.delay())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                _, _, future = heapq.heappop(self.waiters)
+                if not future.done():
+                    self.bucket.consume()
+                    future.set_result(None)
+        finally:
+            self.task = None
+
+    def pause(self, seconds) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        return not self.waiters and self.paused_until <= time.monotonic() and self.bucket.full()
+
+
+class Outbox(BaseRateLimiter):
+    """Rate limiter for every Bot API call: a global and a per-chat token bucket, priorities and RetryAfter handling.
+
+    Defaults follow Telegram's documented limits: ~30 messages per second overall and about one per second per chat.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3, max_idle_chats=1000) -> None:
+        self.global_gate = Gate(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_gates = {}
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+
+        self.sent = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def chat_gate(self, chat_id) -> Gate:
+        if chat_id not in self.chat_gates:
+            if len(self.chat_gates) >= self.max_idle_chats:
+                for key in [key for key, gate in self.chat_gates.items() if gate.idle()]:
+                    del self.chat_gates[key]
+            self.chat_gates[chat_id] = Gate(self.chat_rate, self.chat_burst)
+        return self.chat_gates[chat_id]
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITIES.get(endpoint, DEFAULT_PRIORITY)
+        chat_id = data.get('chat_id')
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+
+        for attempt in range(max_retries + 1):
+            started = time.monotonic()
+            if chat_id is not None:
+                await self.chat_gate(chat_id).wait(priority)
+            await self.global_gate.wait(priority)
+
+            waited = time.monotonic() - started
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                self.retries += 1
+                # flood control for one chat shouldn't stop everyone else
+                (self.chat_gate(chat_id) if chat_id is not None else self.global_gate).pause(e.retry_after + 0.1)
+
+    def stats(self) -> dict:
+        return {
+            'queued': len(self.global_gate.waiters) + sum(len(gate.waiters) for gate in self.chat_gates.values()),
+            'sent': self.sent,
+            'retries': self.retries,
+            'wait_total': round(self.wait_total, 3),
+            'wait_max': round(self.wait_max, 3),
+            'chats': len(self.chat_gates)
+        }
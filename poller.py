@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+
+import logsink
+
+PUSH_EVENTS = {'create_mark', 'update_mark', 'create_homework', 'update_homework'}
+# per-student poll interval adapts between these: students with fresh events are polled more often
+BASE_INTERVAL = 10 * 60
+MIN_INTERVAL = 3 * 60
+MAX_INTERVAL = 60 * 60
+CONCURRENCY = 10
+MAX_EVENTS = 20  # per delivery, when the last seen event is no longer in the list
+# how often the chats to poll are re-read when they come from members()
+SYNC_INTERVAL = MIN_INTERVAL
+
+
+def event_key(entry) -> str:
+    if 'id' in entry:
+        return str(entry['id'])
+    return f'{entry["datetime"]}/{entry["event_type"]}/{entry.get("subject_name")}'
+
+
+class Poller():
+    """Polls notifications for opted-in chats and delivers events that weren't seen before.
+
+    fetch(chat_id) returns the notification list (newest first) or None, deliver(chat_id, events) sends new events.
+    last_seen(chat_id) / set_last_seen(chat_id, key) persist the newest seen event key.
+    With several workers, claim(chat_id) returns whether this worker may poll the chat now, and members() returns
+    every opted-in chat, re-read each SYNC_INTERVAL so chats opted in or out on another worker are picked up.
+    All of them are coroutine functions.
+    """
+
+    def __init__(self, fetch, deliver, last_seen, set_last_seen, concurrency=CONCURRENCY, claim=None, members=None) -> None:
+        self.fetch = fetch
+        self.deliver = deliver
+        self.last_seen = last_seen
+        self.set_last_seen = set_last_seen
+        self.claim = claim
+        self.members = members
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue = []  # heap of (due, chat_id, generation)
+        self.intervals = {}
+        self.generations = {}  # a chat that was removed and added again must not be polled twice
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task = None
+        self.sync_task: asyncio.Task = None
+        self.polls = 0
+        self.delivered = 0
+
+    def start(self, chat_ids) -> None:
+        # spread the first round evenly over one interval instead of polling everyone at once
+        chat_ids = list(chat_ids)
+        now = time.monotonic()
+        for i, chat_id in enumerate(chat_ids):
+            self.generations[chat_id] = next(self.counter)
+            self.schedule(chat_id, now + BASE_INTERVAL * i / len(chat_ids))
+        self.task = asyncio.create_task(self.run())
+        if self.members is not None:
+            self.sync_task = asyncio.create_task(self.sync())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            self.sync_task = None
+
+    async def sync(self) -> None:
+        while True:
+            await asyncio.sleep(SYNC_INTERVAL)
+            try:
+                chat_ids = set(await self.members())
+            except Exception as e:
+                logsink.log_error('push', None, e)
+                continue
+            for chat_id in chat_ids - self.generations.keys():
+                self.add(chat_id)
+            for chat_id in self.generations.keys() - chat_ids:
+                self.remove(chat_id)
+
+    def add(self, chat_id) -> None:
+        if chat_id in self.generations:
+            return
+        self.generations[chat_id] = next(self.counter)
+        self.schedule(chat_id, time.monotonic() + random.uniform(0, BASE_INTERVAL))
+
+    def remove(self, chat_id) -> None:
+        # stale queue entries are skipped when they come up
+        self.generations.pop(chat_id, None)
+        self.intervals.pop(chat_id, None)
+
+    def schedule(self, chat_id, due) -> None:
+        self.intervals.setdefault(chat_id, BASE_INTERVAL)
+        heapq.heappush(self.queue, (due, chat_id, self.generations[chat_id]))
+        self.wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            due, chat_id, generation = self.queue[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.queue)
+            if self.generations.get(chat_id) != generation:
+                continue
+            if self.claim is not None and not await self.claim(chat_id):
+                # polled by another worker this time
+                self.schedule(chat_id, time.monotonic() + self.intervals[chat_id] * random.uniform(0.9, 1.1))
+                continue
+
+            await self.semaphore.acquire()
+            asyncio.create_task(self.poll(chat_id, generation))
+
+    async def poll(self, chat_id, generation) -> None:
+        scheduled = False
+        try:
+            self.polls += 1
+            events = await self.fetch(chat_id)
+            new = await self.new_events(chat_id, events) if events is not None else []
+
+            if self.generations.get(chat_id) != generation:
+                return
+
+            interval = self.intervals[chat_id]
+            interval = max(MIN_INTERVAL, interval / 2) if new else min(MAX_INTERVAL, interval * 1.5)
+            self.intervals[chat_id] = interval
+            self.schedule(chat_id, time.monotonic() + interval * random.uniform(0.9, 1.1))
+            scheduled = True
+
+            if new:
+                self.delivered += len(new)
+                await self.deliver(chat_id, new)
+        except Exception as e:
+            logsink.log_error('push', chat_id, e)
+            if not scheduled and self.generations.get(chat_id) == generation:
+                self.schedule(chat_id, time.monotonic() + MAX_INTERVAL)
+        finally:
+            self.semaphore.release()
+
+    async def new_events(self, chat_id, events) -> list:
+        if not events:
+            return []
+
+        last = await self.last_seen(chat_id)
+        newest = event_key(events[0])
+        if newest != last:
+            await self.set_last_seen(chat_id, newest)
+        if last is None:
+            # first poll only remembers where we are
+            return []
+
+        new = []
+        for entry in events:
+            if event_key(entry) == last:
+                break
+            if entry['event_type'] in PUSH_EVENTS:
+                new.append(entry)
+        return new[:MAX_EVENTS]
+
+    def stats(self) -> dict:
+        return {
+            'students': len(self.intervals),
+            'polls': self.polls,
+            'delivered': self.delivered
+        }
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+from pytz import timezone
+import asyncio
+import random
+
+import logsink
+
+MSK = timezone('Europe/Moscow')
+
+# a chat is prefetched for an action it used on at least MIN_DAYS of the last HISTORY_DAYS days
+HISTORY_DAYS = 14
+MIN_DAYS = 3
+# off-peak hours (Moscow time, [start, end)) before the morning and the evening peaks
+WINDOWS = ((4, 6), (15, 17))
+CONCURRENCY = 4
+# prefetched entries must outlive the gap between the window and the peak after it
+TTL = 4 * 60 * 60
+
+
+def next_school_day(now: datetime) -> datetime:
+    # before noon people look at today, later at tomorrow; there are no lessons on Sunday
+    day = now.date() if now.hour < 12 else now.date() + timedelta(days=1)
+    if day.weekday() == 6:
+        day += timedelta(days=1)
+    return datetime(day.year, day.month, day.day)
+
+
+class Prefetcher():
+    """Learns which chats look at their schedule/homework regularly and loads the next school day for them off-peak.
+
+    loaders maps an action to `async def f(chat_id, date: datetime, ttl)` that warms the cache for that day.
+    Only what the loader caches for that single day gets warmed: a request for a longer range that is cached as a whole
+    (homework) still goes to MESH and only benefits from what the loader stored along the way.
+    load_usage(chat_ids) returns {chat_id: usage} and save_usage(chat_id, usage) persists it (both coroutine
+    functions), where usage is {action: [day ordinals]}.
+    """
+
+    def __init__(self, loaders, load_usage, save_usage, windows=WINDOWS, concurrency=CONCURRENCY, ttl=TTL) -> None:
+        self.loaders = loaders
+        self.load_usage = load_usage
+        self.save_usage = save_usage
+        self.windows = windows
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.ttl = ttl
+        self.usage = {}
+        self.task: asyncio.Task = None
+        self.rounds = 0
+        self.prefetched = 0
+        self.failed = 0
+
+    async def start(self, chat_ids) -> None:
+        self.usage = await self.load_usage(list(chat_ids))
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def record(self, chat_id, action) -> None:
+        if action not in self.loaders:
+            return
+
+        today = datetime.now(MSK).date().toordinal()
+        days = self.usage.get(chat_id, {}).get(action, [])
+        if days and days[-1] == today:
+            return
+
+        # one write per chat, action and day; other workers may have recorded days of their own since this one
+        # loaded the usage, so the stored usage is merged in instead of being overwritten
+        stored = (await self.load_usage([chat_id])).get(chat_id, {})
+        usage = self.usage.get(chat_id, {})
+        merged = {}
+        for name in usage.keys() | stored.keys() | {action}:
+            merged_days = set(usage.get(name, [])) | set(stored.get(name, []))
+            if name == action:
+                merged_days.add(today)
+            merged[name] = sorted(day for day in merged_days if day > today - HISTORY_DAYS)
+        self.usage[chat_id] = merged
+        await self.save_usage(chat_id, merged)
+
+    def active(self) -> list:
+        since = datetime.now(MSK).date().toordinal() - HISTORY_DAYS
+        return [(chat_id, action) for chat_id, usage in self.usage.items() for action, days in usage.items()
+                if sum(day > since for day in days) >= MIN_DAYS]
+
+    def next_window(self, now: datetime) -> tuple[datetime, datetime]:
+        for days in (0, 1):
+            for start, end in sorted(self.windows):
+                begin = MSK.localize(datetime(now.year, now.month, now.day, start) + timedelta(days=days))
+                finish = MSK.localize(datetime(now.year, now.month, now.day, end) + timedelta(days=days))
+                if finish > now:
+                    return max(begin, now), finish
+        raise ValueError('no prefetch windows')
+
+    async def run(self) -> None:
+        while True:
+            begin, end = self.next_window(datetime.now(MSK))
+            await asyncio.sleep((begin - datetime.now(MSK)).total_seconds())
+            await self.prefetch(next_school_day(begin), (end - datetime.now(MSK)).total_seconds())
+            await asyncio.sleep(max(0, (end - datetime.now(MSK)).total_seconds()))
+
+    async def prefetch(self, day: datetime, spread) -> None:
+        """Loads day for every active chat, starting them at random moments over the first half of `spread` seconds."""
+        self.rounds += 1
+
+        async def one(chat_id, action):
+            await asyncio.sleep(random.uniform(0, spread / 2))
+            async with self.semaphore:
+                try:
+                    if await self.loaders[action](chat_id, day, self.ttl) is None:
+                        self.failed += 1
+                    else:
+                        self.prefetched += 1
+                except Exception as e:
+                    self.failed += 1
+                    logsink.log_error('prefetch', chat_id, e)
+
+        await asyncio.gather(*[one(chat_id, action) for chat_id, action in self.active()])
+
+    def stats(self) -> dict:
+        return {
+            'chats': len(self.usage),
+            'active': len(self.active()),
+            'rounds': self.rounds,
+            'prefetched': self.prefetched,
+            'failed': self.failed
+        }
@@ -0,0 +1,80 @@
+from telegram.ext import BaseUpdateProcessor
+import asyncio
+
+# PTB takes its own semaphore before calling do_process_update, so waiting there for a chat's turn would hold a
+# slot; its limit only bounds the number of update tasks, the real cap is ChatProcessor.slots
+MAX_TASKS = 10000
+
+
+class ChatQueue():
+    __slots__ = ('lock', 'pending')
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class ChatProcessor(BaseUpdateProcessor):
+    """Runs updates of different chats concurrently, at most `concurrency` at a time, and updates of one chat
+    strictly one after another in the order they arrived.
+
+    A chat with `chat_queue` updates already waiting gets its new updates dropped, so someone hammering a button
+    can't pile up work (or memory) while the bot is busy with their previous presses.
+    """
+
+    def __init__(self, concurrency=32, chat_queue=8) -> None:
+        super().__init__(MAX_TASKS)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.chat_queue = chat_queue
+        self.chats = {}
+        self.running = 0
+        self.processed = 0
+        self.dropped = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            await self.run(coroutine)
+            return
+
+        queue = self.chats.get(chat.id)
+        if queue is None:
+            queue = self.chats[chat.id] = ChatQueue()
+        elif queue.pending > self.chat_queue:
+            self.dropped += 1
+            coroutine.close()
+            return
+
+        # do_process_update is entered in arrival order and asyncio.Lock wakes waiters first in, first out
+        queue.pending += 1
+        try:
+            async with queue.lock:
+                await self.run(coroutine)
+        finally:
+            queue.pending -= 1
+            if queue.pending == 0:
+                del self.chats[chat.id]
+
+    async def run(self, coroutine) -> None:
+        async with self.slots:
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+                self.processed += 1
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'pending': sum(queue.pending for queue in self.chats.values()),
+            'chats': len(self.chats),
+            'processed': self.processed,
+            'dropped': self.dropped
+        }
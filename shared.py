@@ -0,0 +1,246 @@
+import asyncio
+import socket
+import time
+
+
+class Backend():
+    """Key/value store shared by the bot workers. Keys and values are strings; ttl is in seconds.
+
+    Methods are coroutines: a networked backend must never block the event loop while it waits for a reply.
+    """
+
+    async def get(self, key) -> str:
+        raise NotImplementedError
+
+    async def get_many(self, keys) -> list:
+        return [await self.get(key) for key in keys]
+
+    async def set(self, key, value, ttl=None) -> None:
+        raise NotImplementedError
+
+    async def set_many(self, items: dict, ttl=None) -> None:
+        for key, value in items.items():
+            await self.set(key, value, ttl)
+
+    async def add(self, key, value, ttl=None) -> bool:
+        """Sets key only if it doesn't exist; returns whether it was set."""
+        raise NotImplementedError
+
+    async def delete(self, key) -> None:
+        raise NotImplementedError
+
+    # sets of members, used to list keys without scanning
+    async def set_add(self, key, member) -> None:
+        raise NotImplementedError
+
+    async def set_remove(self, key, member) -> None:
+        raise NotImplementedError
+
+    async def members(self, key) -> list:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBackend(Backend):
+    """In-process backend: one worker, but the same code path as the networked one.
+
+    Nothing in it awaits, so every method is atomic with respect to the other tasks.
+    """
+
+    def __init__(self) -> None:
+        self.values = {}  # key -> (expires_at or None, value)
+        self.sets = {}
+
+    async def get(self, key) -> str:
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] < time.monotonic():
+            self.values.pop(key, None)
+            return None
+        return entry[1]
+
+    async def set(self, key, value, ttl=None) -> None:
+        self.values[key] = (time.monotonic() + ttl if ttl else None, value)
+
+    async def add(self, key, value, ttl=None) -> bool:
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key) -> None:
+        self.values.pop(key, None)
+
+    async def set_add(self, key, member) -> None:
+        self.sets.setdefault(key, set()).add(member)
+
+    async def set_remove(self, key, member) -> None:
+        self.sets.get(key, set()).discard(member)
+
+    async def members(self, key) -> list:
+        return list(self.sets.get(key, ()))
+
+
+class RedisError(Exception):
+    pass
+
+
+def encode_command(*args) -> bytes:
+    parts = [f'*{len(args)}\r\n'.encode()]
+    for arg in args:
+        arg = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(f'${len(arg)}\r\n'.encode() + arg + b'\r\n')
+    return b''.join(parts)
+
+
+class Connection():
+    __slots__ = ('reader', 'writer')
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError('connection closed')
+        kind, rest = line[:1], line[1:-2]
+        match kind:
+            case b'+':
+                return rest.decode()
+            case b'-':
+                return RedisError(rest.decode())
+            case b':':
+                return int(rest)
+            case b'$':
+                length = int(rest)
+                if length < 0:
+                    return None
+                data = await self.reader.readexactly(length + 2)
+                return data[:-2].decode()
+            case b'*':
+                length = int(rest)
+                return None if length < 0 else [await self.read_reply() for _ in range(length)]
+        raise RedisError(f'unexpected reply {line!r}')
+
+    async def execute(self, *commands) -> list:
+        # all commands go out in one write and their replies are read back in order (pipelining)
+        self.writer.write(b''.join(encode_command(*command) for command in commands))
+        await self.writer.drain()
+        return [await self.read_reply() for _ in commands]
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class RedisBackend(Backend):
+    """Minimal RESP client for Redis (or anything speaking its protocol, like bench/kvserver.py) on asyncio streams.
+
+    Keeps up to `pool_size` connections, each used by one task at a time. Every call is bounded by `timeout`;
+    a connection that failed or timed out may have replies in flight, so it is closed instead of reused.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, timeout=1.0, prefix='meshbot:', pool_size=8) -> None:
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.prefix = prefix
+        self.pool_size = pool_size
+        self.idle = []
+        self.slots: asyncio.Semaphore = None
+
+    async def connect(self) -> Connection:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(reader, writer)
+        if self.password:
+            await conn.execute(('AUTH', self.password))
+        if self.db:
+            await conn.execute(('SELECT', self.db))
+        return conn
+
+    async def pipeline(self, *commands) -> list:
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.pool_size)
+
+        async with self.slots:
+            for attempt in range(2):
+                conn = self.idle.pop() if self.idle else None
+                try:
+                    if conn is None:
+                        conn = await asyncio.wait_for(self.connect(), self.timeout)
+                    replies = await asyncio.wait_for(conn.execute(*commands), self.timeout)
+                except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+                    if conn is not None:
+                        conn.close()
+                    # an idle connection may have been closed by the server, a fresh one gets one more try
+                    if attempt or isinstance(e, TimeoutError):
+                        raise
+                    continue
+                except BaseException:
+                    if conn is not None:
+                        conn.close()
+                    raise
+
+                self.idle.append(conn)
+                for reply in replies:
+                    if isinstance(reply, RedisError):
+                        raise reply
+                return replies
+
+    async def command(self, *args):
+        return (await self.pipeline(args))[0]
+
+    async def get(self, key) -> str:
+        return await self.command('GET', self.prefix + key)
+
+    async def get_many(self, keys) -> list:
+        keys = list(keys)
+        return await self.command('MGET', *[self.prefix + key for key in keys]) if keys else []
+
+    async def set(self, key, value, ttl=None) -> None:
+        if ttl:
+            await self.command('SET', self.prefix + key, value, 'PX', int(ttl * 1000))
+        else:
+            await self.command('SET', self.prefix + key, value)
+
+    async def set_many(self, items: dict, ttl=None) -> None:
+        if items:
+            expiry = ('PX', int(ttl * 1000)) if ttl else ()
+            await self.pipeline(*[('SET', self.prefix + key, value, *expiry) for key, value in items.items()])
+
+    async def add(self, key, value, ttl=None) -> bool:
+        args = ('SET', self.prefix + key, value, 'NX') + (('PX', int(ttl * 1000)) if ttl else ())
+        return await self.command(*args) == 'OK'
+
+    async def delete(self, key) -> None:
+        await self.command('DEL', self.prefix + key)
+
+    async def set_add(self, key, member) -> None:
+        await self.command('SADD', self.prefix + key, member)
+
+    async def set_remove(self, key, member) -> None:
+        await self.command('SREM', self.prefix + key, member)
+
+    async def members(self, key) -> list:
+        return await self.command('SMEMBERS', self.prefix + key)
+
+    async def close(self) -> None:
+        for conn in self.idle:
+            conn.close()
+        self.idle.clear()
+
+
+def connect(backend='memory', **kwargs) -> Backend:
+    """Backend from the 'shared' section of env.json, e.g. {"backend": "redis", "host": "10.0.0.5"}."""
+    match backend:
+        case 'memory':
+            return MemoryBackend()
+        case 'redis':
+            return RedisBackend(**kwargs)
+    raise ValueError(f'Unknown shared backend {backend!r}')
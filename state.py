@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import json
+import os
+import time
+
+
+class StateStore():
+    """Conversation state with a sliding TTL and LRU eviction once max_entries is reached.
+
+    Values must be plain JSON values if the store is persisted.
+    get/set/pop/has are coroutines only to match SharedStateStore; nothing in them awaits.
+    """
+
+    def __init__(self, ttl, max_entries) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.evictions = 0
+
+    async def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+
+        if entry[0] < time.time():
+            del self.entries[key]
+            return default
+
+        self.entries[key] = (time.time() + self.ttl, entry[1])
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key, value) -> None:
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    async def has(self, key) -> bool:
+        return await self.get(key) is not None
+
+    def purge(self) -> None:
+        now = time.time()
+        for key in [key for key, (expires_at, _) in self.entries.items() if expires_at < now]:
+            del self.entries[key]
+
+    def __len__(self) -> int:
+        self.purge()
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        return {'live': len(self), 'evictions': self.evictions}
+
+    def save(self, path) -> None:
+        self.purge()
+        data = [[key, expires_at, value] for key, (expires_at, value) in self.entries.items()]
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+
+    def load(self, path) -> None:
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        now = time.time()
+        for key, expires_at, value in data:
+            if expires_at >= now:
+                self.entries[key] = (expires_at, value)
+
+
+class SharedStateStore():
+    """StateStore over a shared.Backend, so any worker can continue a conversation another one started.
+
+    Entries expire in the backend itself; values are stored as JSON.
+    """
+
+    def __init__(self, name, backend, ttl) -> None:
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+
+    def key(self, key) -> str:
+        return f'state:{self.name}:{key}'
+
+    async def get(self, key, default=None):
+        data = await self.backend.get(self.key(key))
+        if data is None:
+            return default
+
+        # sliding TTL, like StateStore
+        await self.backend.set(self.key(key), data, self.ttl)
+        return json.loads(data)
+
+    async def set(self, key, value) -> None:
+        await self.backend.set(self.key(key), json.dumps(value), self.ttl)
+
+    async def pop(self, key, default=None):
+        data = await self.backend.get(self.key(key))
+        if data is None:
+            return default
+        await self.backend.delete(self.key(key))
+        return json.loads(data)
+
+    async def has(self, key) -> bool:
+        return await self.backend.get(self.key(key)) is not None
+
+    def stats(self) -> dict:
+        # entries live in the backend, this worker has nothing to count
+        return {}
+
+    # nothing to persist locally, the backend keeps the entries
+    def save(self, path) -> None:
+        pass
+
+    def load(self, path) -> None:
+        pass
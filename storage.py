@@ -0,0 +1,274 @@
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import time
+
+
+class Storage():
+    """Backend for per-chat user records ({'token': ..., 'student_id': ...}) keyed by chat id.
+
+    The methods are coroutines so a networked storage doesn't block the event loop; the local ones just run
+    their statements, an SQLite statement on a local file takes microseconds.
+    """
+
+    async def get(self, chat_id) -> dict:
+        raise NotImplementedError
+
+    async def put(self, chat_id, record: dict) -> None:
+        raise NotImplementedError
+
+    async def delete(self, chat_id) -> None:
+        raise NotImplementedError
+
+    async def keys(self) -> list:
+        raise NotImplementedError
+
+    async def get_many(self, chat_ids) -> dict:
+        res = {}
+        for chat_id in chat_ids:
+            record = await self.get(chat_id)
+            if record is not None:
+                res[str(chat_id)] = record
+        return res
+
+    # small key/value namespaces for data that outlives a process but isn't a user record;
+    # values written with a ttl (seconds) are gone after it
+    async def get_values(self, namespace, keys) -> dict:
+        raise NotImplementedError
+
+    async def put_values(self, namespace, items: dict, ttl=None) -> None:
+        raise NotImplementedError
+
+    async def prune(self) -> int:
+        """Drops expired values where the backend doesn't do it by itself; returns how many."""
+        return 0
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryStorage(Storage):
+    def __init__(self) -> None:
+        self.users = {}
+        self.values = {}
+
+    async def get(self, chat_id) -> dict:
+        return self.users.get(str(chat_id))
+
+    async def put(self, chat_id, record: dict) -> None:
+        self.users[str(chat_id)] = record
+
+    async def delete(self, chat_id) -> None:
+        self.users.pop(str(chat_id), None)
+
+    async def keys(self) -> list:
+        return list(self.users)
+
+    async def get_values(self, namespace, keys) -> dict:
+        values = self.values.get(namespace, {})
+        now = time.time()
+        return {key: values[key][1] for key in keys if key in values and (values[key][0] is None or values[key][0] > now)}
+
+    async def put_values(self, namespace, items: dict, ttl=None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        self.values.setdefault(namespace, {}).update((key, (expires_at, value)) for key, value in items.items())
+
+    async def prune(self) -> int:
+        now = time.time()
+        pruned = 0
+        for values in self.values.values():
+            for key in [key for key, (expires_at, _) in values.items() if expires_at is not None and expires_at <= now]:
+                del values[key]
+                pruned += 1
+        return pruned
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path='db.sqlite3') -> None:
+        # autocommit mode: every statement is its own atomic transaction
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # the primary key doubles as the chat_id index
+        self.conn.execute('CREATE TABLE IF NOT EXISTS users (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                          'expires_at REAL, PRIMARY KEY (namespace, key))')
+        # kv tables created before values could expire
+        if 'expires_at' not in [row[1] for row in self.conn.execute('PRAGMA table_info(kv)')]:
+            self.conn.execute('ALTER TABLE kv ADD COLUMN expires_at REAL')
+            # these were keyed without the student then, nothing reads them anymore
+            self.conn.execute("DELETE FROM kv WHERE namespace IN ('homework', 'launch_url')")
+
+    async def get(self, chat_id) -> dict:
+        row = self.conn.execute('SELECT data FROM users WHERE chat_id = ?', (str(chat_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def put(self, chat_id, record: dict) -> None:
+        self.conn.execute('INSERT INTO users (chat_id, data) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data',
+                          (str(chat_id), json.dumps(record, ensure_ascii=False)))
+
+    async def delete(self, chat_id) -> None:
+        self.conn.execute('DELETE FROM users WHERE chat_id = ?', (str(chat_id),))
+
+    async def keys(self) -> list:
+        return [row[0] for row in self.conn.execute('SELECT chat_id FROM users')]
+
+    async def get_values(self, namespace, keys) -> dict:
+        keys = list(keys)
+        res = {}
+        # stay well below SQLite's limit on bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(f'SELECT key, value FROM kv WHERE namespace = ? AND key IN ({",".join("?" * len(chunk))}) '
+                                     'AND (expires_at IS NULL OR expires_at > ?)', (namespace, *chunk, time.time()))
+            res.update((key, json.loads(value)) for key, value in rows)
+        return res
+
+    async def put_values(self, namespace, items: dict, ttl=None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) '
+                                  'ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at',
+                                  [(namespace, key, json.dumps(value, ensure_ascii=False), expires_at) for key, value in items.items()])
+
+    async def prune(self) -> int:
+        return self.conn.execute('DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),)).rowcount
+
+    async def close(self) -> None:
+        self.conn.close()
+
+    def migrate_json(self, path='db.json') -> int:
+        """One-time import of the old db.json; the file is renamed afterwards so it isn't imported twice."""
+        if not os.path.exists(path):
+            return 0
+
+        with open(path, 'r', encoding='utf-8') as f:
+            old_db = json.load(f)
+
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR IGNORE INTO users (chat_id, data) VALUES (?, ?)',
+                                  [(str(k), json.dumps(v, ensure_ascii=False)) for k, v in old_db.items()])
+
+        os.rename(path, path + '.migrated')
+        return len(old_db)
+
+
+class SharedStorage(Storage):
+    """User records and kv namespaces in a shared.Backend, so every worker sees the same users."""
+
+    def __init__(self, backend) -> None:
+        self.backend = backend
+
+    async def get(self, chat_id) -> dict:
+        data = await self.backend.get(f'user:{chat_id}')
+        return json.loads(data) if data is not None else None
+
+    async def get_many(self, chat_ids) -> dict:
+        chat_ids = [str(chat_id) for chat_id in chat_ids]
+        values = await self.backend.get_many([f'user:{chat_id}' for chat_id in chat_ids])
+        return {chat_id: json.loads(value) for chat_id, value in zip(chat_ids, values) if value is not None}
+
+    async def put(self, chat_id, record: dict) -> None:
+        await self.backend.set(f'user:{chat_id}', json.dumps(record, ensure_ascii=False))
+        await self.backend.set_add('users', str(chat_id))
+
+    async def delete(self, chat_id) -> None:
+        await self.backend.delete(f'user:{chat_id}')
+        await self.backend.set_remove('users', str(chat_id))
+
+    async def keys(self) -> list:
+        return await self.backend.members('users')
+
+    async def get_values(self, namespace, keys) -> dict:
+        keys = list(keys)
+        values = await self.backend.get_many([f'kv:{namespace}:{key}' for key in keys])
+        return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    async def put_values(self, namespace, items: dict, ttl=None) -> None:
+        # the backend expires them itself
+        await self.backend.set_many({f'kv:{namespace}:{key}': json.dumps(value, ensure_ascii=False) for key, value in items.items()}, ttl)
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+    async def migrate_sqlite(self, path='db.sqlite3', json_path='db.json') -> int:
+        """One-time import of a single-worker setup's users and kv values (and its db.json, if that was never migrated);
+        the file is renamed afterwards so it isn't imported twice. Users and values already in the backend are kept."""
+        if not os.path.exists(path) and not os.path.exists(json_path):
+            return 0
+
+        local = SQLiteStorage(path)
+        local.migrate_json(json_path)
+        users = await local.get_many(await local.keys())
+        for chat_id, record in users.items():
+            if await self.backend.add(f'user:{chat_id}', json.dumps(record, ensure_ascii=False)):
+                await self.backend.set_add('users', chat_id)
+
+        now = time.time()
+        rows = local.conn.execute('SELECT namespace, key, value, expires_at FROM kv WHERE expires_at IS NULL OR expires_at > ?', (now,))
+        for namespace, key, value, expires_at in rows.fetchall():
+            # stored as JSON in both, copied as is
+            await self.backend.add(f'kv:{namespace}:{key}', value, expires_at - now if expires_at else None)
+
+        await local.close()
+        os.rename(path, path + '.migrated')
+        return len(users)
+
+
+class TokenDB():
+    """Read-through cache of user records over a Storage.
+
+    Records must be written back with `await db.set(chat_id, record)`, in-place changes are not persisted.
+    With a storage shared between workers, `cache_ttl` bounds how long another worker's write can go unseen.
+    """
+
+    def __init__(self, storage: Storage, cache_size=1024, cache_ttl=None) -> None:
+        self.storage = storage
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache = OrderedDict()  # chat_id -> (cached_at, record)
+
+    def cached(self, chat_id):
+        entry = self.cache.get(chat_id)
+        if entry is None or (self.cache_ttl is not None and time.monotonic() - entry[0] >= self.cache_ttl):
+            return None
+        self.cache.move_to_end(chat_id)
+        return entry[1]
+
+    async def get(self, chat_id, default=None):
+        chat_id = str(chat_id)
+        record = self.cached(chat_id)
+        if record is not None:
+            return record
+
+        record = await self.storage.get(chat_id)
+        if record is None:
+            self.cache.pop(chat_id, None)
+            return default
+
+        self.remember(chat_id, record)
+        return record
+
+    def remember(self, chat_id, record) -> None:
+        self.cache[chat_id] = (time.monotonic(), record)
+        self.cache.move_to_end(chat_id)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def set(self, chat_id, record: dict) -> None:
+        await self.storage.put(str(chat_id), record)
+        self.remember(str(chat_id), record)
+
+    async def delete(self, chat_id) -> None:
+        await self.storage.delete(str(chat_id))
+        self.cache.pop(str(chat_id), None)
+
+    async def keys(self) -> list:
+        return await self.storage.keys()
+
+    async def items(self) -> list:
+        """(chat_id, record) of every user, read in one batch where the storage can."""
+        return list((await self.storage.get_many(await self.storage.keys())).items())
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Clock():
+    """Stands in for the time module of the module under test, so TTLs can be stepped over without sleeping."""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
@@ -0,0 +1,89 @@
+import pytest
+
+import breaker
+
+
+@pytest.fixture
+def circuit(clock, monkeypatch):
+    monkeypatch.setattr(breaker, 'time', clock)
+    return breaker.Breaker(failures=3, slow=1.0, open_for=30, probes=1)
+
+
+def test_opens_after_consecutive_failures(circuit):
+    for _ in range(2):
+        assert circuit.allow()
+        circuit.failure()
+    assert circuit.state == breaker.CLOSED
+
+    circuit.failure()
+    assert circuit.state == breaker.OPEN
+    assert not circuit.allow()
+    assert circuit.opened == 1
+
+
+def test_success_resets_the_failure_count(circuit):
+    circuit.failure()
+    circuit.failure()
+    circuit.success(0.1)
+    circuit.failure()
+    assert circuit.state == breaker.CLOSED
+
+
+def test_slow_success_counts_as_failure(circuit):
+    for _ in range(3):
+        circuit.success(5.0)
+    assert circuit.state == breaker.OPEN
+
+
+def test_half_open_admits_probes_then_closes_on_success(circuit, clock):
+    for _ in range(3):
+        circuit.failure()
+
+    clock.advance(29)
+    assert not circuit.allow()
+
+    clock.advance(1)
+    assert circuit.allow()
+    assert circuit.state == breaker.HALF_OPEN
+    # only one probe at a time
+    assert not circuit.allow()
+
+    circuit.success(0.1)
+    assert circuit.state == breaker.CLOSED
+    assert circuit.allow()
+
+
+def test_failed_probe_opens_again(circuit, clock):
+    for _ in range(3):
+        circuit.failure()
+    clock.advance(30)
+    assert circuit.allow()
+
+    circuit.failure()
+    assert circuit.state == breaker.OPEN
+    assert circuit.opened == 2
+    assert not circuit.allow()
+
+    # the open period starts over from the failed probe
+    clock.advance(30)
+    assert circuit.allow()
+
+
+def test_cancelled_probe_lets_another_one_go(circuit, clock):
+    for _ in range(3):
+        circuit.failure()
+    clock.advance(30)
+    assert circuit.allow()
+    assert not circuit.allow()
+
+    circuit.cancel()
+    assert circuit.allow()
+
+
+def test_breakers_share_settings_and_report_states():
+    breakers = breaker.Breakers(failures=1)
+    breakers.get('schedule').failure()
+    breakers.get('marks')
+
+    assert breakers.get('schedule') is breakers.get('schedule')
+    assert breakers.stats() == {'schedule': breaker.STATE_CODES[breaker.OPEN], 'marks': breaker.STATE_CODES[breaker.CLOSED]}
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+import cache
+
+
+@pytest.fixture
+def responses(clock, monkeypatch):
+    monkeypatch.setattr(cache, 'time', clock)
+    return cache.Cache(max_stale=60)
+
+
+def counting(*results):
+    """Loader returning results one call at a time; .calls counts the calls."""
+    results = list(results)
+
+    async def loader():
+        loader.calls += 1
+        await asyncio.sleep(0)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    loader.calls = 0
+    return loader
+
+
+def test_concurrent_loads_run_the_loader_once(responses):
+    loader = counting('value')
+
+    async def run():
+        return await asyncio.gather(*[responses.load(('marks', 1), 10, loader) for _ in range(5)])
+
+    assert asyncio.run(run()) == ['value'] * 5
+    assert loader.calls == 1
+    assert responses.misses == 1
+    assert responses.coalesced == 4
+
+
+def test_cached_value_is_served_until_it_expires(responses, clock):
+    loader = counting('old', 'new')
+
+    assert asyncio.run(responses.load(('marks', 1), 10, loader)) == 'old'
+    assert asyncio.run(responses.load(('marks', 1), 10, loader)) == 'old'
+    assert loader.calls == 1
+    assert responses.hits == 1
+
+    clock.advance(11)
+    assert asyncio.run(responses.load(('marks', 1), 10, loader)) == 'new'
+    assert loader.calls == 2
+
+
+def test_failed_load_is_not_cached(responses):
+    loader = counting(None, 'value')
+
+    assert asyncio.run(responses.load(('marks', 1), 10, loader)) is None
+    assert asyncio.run(responses.load(('marks', 1), 10, loader)) == 'value'
+    assert loader.calls == 2
+
+
+def test_failed_reload_serves_the_stale_value(responses, clock):
+    loader = counting('old', None)
+    asyncio.run(responses.load(('marks', 1), 10, loader))
+    stored_at = clock.now
+    clock.advance(30)
+
+    async def handler():
+        reads = cache.track_stale()
+        return await responses.load(('marks', 1), 10, loader), reads
+
+    assert asyncio.run(handler()) == ('old', [stored_at])
+    assert responses.stale_served == 1
+
+
+def test_stale_value_is_dropped_after_max_stale(responses, clock):
+    loader = counting('old', None)
+    asyncio.run(responses.load(('marks', 1), 10, loader))
+    clock.advance(10 + 61)
+
+    assert asyncio.run(responses.load(('marks', 1), 10, loader)) is None
+    assert responses.stale_served == 0
+
+
+def test_waiters_get_the_stale_value_too(responses, clock):
+    loader = counting('old', None)
+    asyncio.run(responses.load(('marks', 1), 10, loader))
+    clock.advance(30)
+
+    async def run():
+        return await asyncio.gather(*[responses.load(('marks', 1), 10, loader) for _ in range(3)])
+
+    assert asyncio.run(run()) == ['old'] * 3
+    assert loader.calls == 2
+
+
+def test_loader_errors_reach_every_waiter(responses):
+    loader = counting(ValueError('boom'))
+
+    async def run():
+        return await asyncio.gather(*[responses.load(('marks', 1), 10, loader) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert loader.calls == 1
+    assert not responses.inflight
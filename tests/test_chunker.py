@@ -0,0 +1,42 @@
+import chunker
+
+
+def test_short_fragment_is_kept_whole():
+    assert list(chunker.split('<b>short</b>\n', 100)) == ['<b>short</b>\n']
+
+
+def test_long_fragment_is_split_within_the_limit():
+    fragment = ''.join(f'line {i} ' * 20 + '\n' for i in range(100))
+    parts = list(chunker.split(fragment, 1000))
+
+    assert len(parts) > 1
+    assert all(len(part) <= 1000 for part in parts)
+    assert ''.join(parts) == fragment
+
+
+def test_open_tags_are_closed_and_reopened_at_a_cut():
+    fragment = '<b>' + ''.join(f'mark {i}\n' for i in range(300)) + '</b>'
+    parts = list(chunker.split(fragment, 1000))
+
+    assert len(parts) > 1
+    for part in parts:
+        assert part.startswith('<b>')
+        assert part.endswith('</b>')
+        assert part.count('<b>') == part.count('</b>')
+
+
+def test_long_line_is_not_cut_inside_a_tag_or_an_entity():
+    line = 'x &amp; <a href="https://example.com/some/long/path">link</a> ' * 200
+    for part in chunker.split(line, 1000):
+        assert len(part) <= 1000
+        assert part.count('<a ') == part.count('</a>')
+        # an entity cut in two leaves a piece of it without the ';'
+        assert '&' not in part.replace('&amp;', '')
+
+
+def test_pack_keeps_order_and_limit():
+    fragments = [f'<i>{i}</i> ' * 30 + '\n' for i in range(50)]
+    messages = list(chunker.pack(fragments, 1000))
+
+    assert all(len(message) <= 1000 for message in messages)
+    assert ''.join(messages) == ''.join(fragments)
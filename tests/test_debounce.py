@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+import debounce
+import outbox
+
+
+@pytest.fixture
+def presses(clock, monkeypatch):
+    monkeypatch.setattr(debounce, 'time', clock)
+    # the per-chat buckets
+    monkeypatch.setattr(outbox, 'time', clock)
+    return debounce.Debouncer(cooldown=3, chat_rate=0.5, chat_burst=2)
+
+
+def loader(result=None, delay=0):
+    async def load():
+        load.calls += 1
+        await asyncio.sleep(delay)
+        return result
+
+    load.calls = 0
+    return load
+
+
+def test_press_during_a_load_waits_for_it(presses):
+    load = loader(delay=0.01)
+    answers = []
+
+    async def answer(outcome):
+        answers.append(outcome)
+
+    async def run():
+        return await asyncio.gather(presses.run(1, 'marks', load, answer), presses.run(1, 'marks', load, answer))
+
+    assert asyncio.run(run()) == ['started', 'coalesced']
+    assert load.calls == 1
+    assert answers == ['started', 'coalesced']
+
+
+def test_press_right_after_a_success_is_dropped(presses, clock):
+    load = loader()
+
+    assert asyncio.run(presses.run(1, 'marks', load)) == 'started'
+    assert asyncio.run(presses.run(1, 'marks', load)) == 'dropped'
+    clock.advance(3)
+    assert asyncio.run(presses.run(1, 'marks', load)) == 'started'
+    assert load.calls == 2
+
+
+def test_failed_load_starts_no_cooldown(presses):
+    load = loader(False)
+
+    assert asyncio.run(presses.run(1, 'marks', load)) == 'started'
+    assert asyncio.run(presses.run(1, 'marks', load)) == 'started'
+    assert load.calls == 2
+
+
+def test_load_that_raised_starts_no_cooldown(presses):
+    async def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        asyncio.run(presses.run(1, 'marks', fail))
+    assert asyncio.run(presses.run(1, 'marks', loader())) == 'started'
+    assert not presses.inflight
+
+
+def test_chat_rate_limits_across_buttons(presses, clock):
+    outcomes = [asyncio.run(presses.run(1, action, loader())) for action in ('marks', 'profile', 'notifications')]
+
+    assert outcomes == ['started', 'started', 'limited']
+    # other chats have buckets of their own
+    assert asyncio.run(presses.run(2, 'marks', loader())) == 'started'
+    clock.advance(2)
+    assert asyncio.run(presses.run(1, 'notifications', loader())) == 'started'
+    assert presses.stats()['limited'] == 1
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import export
+
+
+def unfold(text) -> str:
+    return text.replace('\r\n ', '').removesuffix('\r\n')
+
+
+def test_short_line_is_not_folded():
+    assert export.ics_fold('SUMMARY:Алгебра') == 'SUMMARY:Алгебра\r\n'
+
+
+def test_long_line_is_folded_at_75_octets():
+    line = 'DESCRIPTION:' + 'x' * 300
+    folded = export.ics_fold(line)
+
+    assert all(len(part.encode('utf-8')) <= export.ICS_LINE for part in folded.removesuffix('\r\n').split('\r\n'))
+    assert unfold(folded) == line
+
+
+def test_multibyte_characters_are_not_cut():
+    line = 'DESCRIPTION:' + 'Домашнее задание ' * 20
+    folded = export.ics_fold(line)
+
+    # every folded line decodes on its own
+    for part in folded.removesuffix('\r\n').split('\r\n'):
+        assert len(part.encode('utf-8')) <= export.ICS_LINE
+    assert unfold(folded) == line
+
+
+def test_escape():
+    assert export.ics_escape('a;b,c\\d\ne') == r'a\;b\,c\\d\ne'
+
+
+def test_chunks_cover_the_range_a_week_at_a_time():
+    chunks = list(export.chunks(datetime(2024, 2, 1), datetime(2024, 2, 20)))
+
+    assert chunks[0] == (datetime(2024, 2, 1), datetime(2024, 2, 7))
+    assert chunks[-1] == (datetime(2024, 2, 15), datetime(2024, 2, 20))
+    assert len(chunks) == 3
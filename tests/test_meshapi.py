@@ -0,0 +1,75 @@
+from datetime import datetime
+import asyncio
+
+from aiohttp import web
+import aiohttp
+import pytest
+
+import meshapi
+import storage
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    monkeypatch.setattr(meshapi, 'db', storage.TokenDB(storage.MemoryStorage()))
+    monkeypatch.setattr(meshapi, 'response_cache', meshapi.cache.Cache(scope=meshapi.student_of))
+    monkeypatch.setattr(meshapi, 'FANOUT_BACKOFF', 0)
+
+
+async def serve(status):
+    """Upstream answering every request with status; returns the runner, its base url and the request counter."""
+    requests = []
+
+    async def handle(request):
+        requests.append(request.path)
+        return web.Response(status=status)
+
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f'http://127.0.0.1:{runner.addresses[0][1]}', requests
+
+
+def test_expired_token_stops_the_schedule_fan_out(offline, monkeypatch):
+    async def run():
+        runner, base, requests = await serve(401)
+        monkeypatch.setattr(meshapi, 'SCHOOL_URL', base)
+        monkeypatch.setattr(meshapi, 'session', aiohttp.ClientSession())
+        try:
+            await meshapi.db.set('1', {'token': 'token', 'student_id': '2'})
+            res = await meshapi.schedule('1', datetime(2024, 2, 1), datetime(2024, 3, 31))
+        finally:
+            await meshapi.session.close()
+            await runner.cleanup()
+        return res, requests
+
+    res, requests = asyncio.run(run())
+    assert res is None
+    assert asyncio.run(meshapi.token_invalid('1'))
+    # the days already in flight when the first 401 came back, not all 60
+    assert len(requests) <= meshapi.FANOUT_CONCURRENCY
+
+
+def test_auth_error_on_launch_urls_marks_the_token(offline, monkeypatch):
+    async def run():
+        runner, base, requests = await serve(401)
+        monkeypatch.setattr(meshapi, 'SCHOOL_URL', base)
+        monkeypatch.setattr(meshapi, 'session', aiohttp.ClientSession())
+        try:
+            await meshapi.db.set('1', {'token': 'token', 'student_id': '2'})
+            entry = meshapi.models.HomeworkEntry('Алгебра', 'текст', '', '', [], [
+                meshapi.models.Test(f'тест {i}', str(i)) for i in range(20)
+            ], [])
+            await meshapi.resolve_launch_urls('1', [('100', '', entry)], 'token', '2')
+        finally:
+            await meshapi.session.close()
+            await runner.cleanup()
+        return entry, requests
+
+    entry, requests = asyncio.run(run())
+    assert asyncio.run(meshapi.token_invalid('1'))
+    assert all(test.url is None for test in entry.execute)
+    assert len(requests) <= meshapi.FANOUT_CONCURRENCY
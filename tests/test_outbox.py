@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+import pytest
+
+import outbox
+
+
+def call(log, name, failures=0):
+    """Bot API call that raises RetryAfter(0) `failures` times, then succeeds; every attempt is logged."""
+    state = {'failures': failures}
+
+    async def callback():
+        log.append((name, time.monotonic()))
+        if state['failures']:
+            state['failures'] -= 1
+            raise RetryAfter(0)
+        return name
+
+    return callback
+
+
+def test_retry_after_pauses_the_chat_and_retries():
+    limiter = outbox.Outbox(chat_rate=100, chat_burst=10, max_retries=3)
+    log = []
+
+    async def run():
+        return await asyncio.gather(
+            limiter.process_request(call(log, 'flooded', failures=2), (), {}, 'sendMessage', {'chat_id': 1}, None),
+            limiter.process_request(call(log, 'other'), (), {}, 'sendMessage', {'chat_id': 2}, None))
+
+    started = time.monotonic()
+    assert asyncio.run(run()) == ['flooded', 'other']
+    attempts = [at for name, at in log if name == 'flooded']
+    assert len(attempts) == 3
+    # each RetryAfter paused the chat for retry_after + 0.1 seconds
+    assert attempts[2] - attempts[0] >= 0.2
+    # the other chat wasn't held up
+    assert [at for name, at in log if name == 'other'][0] - started < 0.1
+    assert limiter.retries == 2
+    assert limiter.sent == 2
+
+
+def test_retry_after_is_raised_once_retries_run_out():
+    limiter = outbox.Outbox(max_retries=1)
+    log = []
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(limiter.process_request(call(log, 'flooded', failures=5), (), {}, 'sendMessage', {'chat_id': 1}, None))
+    assert len(log) == 2
+
+
+def test_rate_limit_args_override_the_retries():
+    limiter = outbox.Outbox(max_retries=3)
+    log = []
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(limiter.process_request(call(log, 'flooded', failures=5), (), {}, 'sendMessage', {'chat_id': 1}, 0))
+    assert len(log) == 1
+
+
+def test_queued_edits_go_before_sends():
+    limiter = outbox.Outbox(chat_rate=20, chat_burst=1)
+    log = []
+
+    async def run():
+        # the first call takes the only token, the rest queue up behind it
+        first = asyncio.create_task(limiter.process_request(call(log, 'first'), (), {}, 'sendMessage', {'chat_id': 1}, None))
+        await asyncio.sleep(0)
+        rest = [limiter.process_request(call(log, name), (), {}, endpoint, {'chat_id': 1}, None)
+                for name, endpoint in (('send', 'sendMessage'), ('document', 'sendDocument'), ('edit', 'editMessageText'))]
+        await asyncio.gather(first, *rest)
+
+    asyncio.run(run())
+    assert [name for name, _ in log] == ['first', 'edit', 'send', 'document']
@@ -0,0 +1,81 @@
+import asyncio
+
+import poller
+
+
+def make_poller(seen=None):
+    seen = {} if seen is None else seen
+
+    async def last_seen(chat_id):
+        return seen.get(chat_id)
+
+    async def set_last_seen(chat_id, key):
+        seen[chat_id] = key
+
+    return poller.Poller(None, None, last_seen, set_last_seen), seen
+
+
+def event(event_id, event_type='create_mark'):
+    return {'id': event_id, 'event_type': event_type}
+
+
+def test_first_poll_only_remembers_the_newest_event():
+    p, seen = make_poller()
+
+    assert asyncio.run(p.new_events('1', [event(3), event(2)])) == []
+    assert seen == {'1': '3'}
+
+
+def test_events_newer_than_the_last_seen_one_are_returned():
+    p, seen = make_poller({'1': '2'})
+    events = [event(5), event(4, 'some_other_event'), event(3, 'create_homework'), event(2), event(1)]
+
+    assert asyncio.run(p.new_events('1', events)) == [event(5), event(3, 'create_homework')]
+    assert seen == {'1': '5'}
+
+
+def test_nothing_new():
+    p, seen = make_poller({'1': '2'})
+
+    assert asyncio.run(p.new_events('1', [event(2), event(1)])) == []
+    assert asyncio.run(p.new_events('1', [])) == []
+    assert seen == {'1': '2'}
+
+
+def test_unknown_last_seen_is_capped():
+    p, _ = make_poller({'1': 'gone'})
+    events = [event(i) for i in range(100, 0, -1)]
+
+    assert asyncio.run(p.new_events('1', events)) == events[:poller.MAX_EVENTS]
+
+
+def test_event_key_without_id():
+    entry = {'datetime': '2024-02-01 10:00:00.000', 'event_type': 'create_mark', 'subject_name': 'Алгебра'}
+    assert poller.event_key(entry) == '2024-02-01 10:00:00.000/create_mark/Алгебра'
+
+
+def test_sync_follows_the_shared_members(monkeypatch):
+    monkeypatch.setattr(poller, 'SYNC_INTERVAL', 0.01)
+    members = {'1', '2'}
+
+    async def read_members():
+        return list(members)
+
+    async def run():
+        p, _ = make_poller()
+        p.members = read_members
+        p.start(['1', '3'])
+        try:
+            await asyncio.sleep(0.05)
+            first = set(p.generations)
+            members.discard('1')
+            members.add('4')
+            await asyncio.sleep(0.05)
+            return first, set(p.generations)
+        finally:
+            await p.stop()
+
+    first, second = asyncio.run(run())
+    # opted in on another worker gets scheduled here too, opted out gets dropped
+    assert first == {'1', '2'}
+    assert second == {'2', '4'}
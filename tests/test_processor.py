@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+import asyncio
+
+import processor
+
+
+def update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id) if chat_id is not None else None)
+
+
+def test_updates_of_one_chat_run_in_order_one_at_a_time():
+    p = processor.ChatProcessor(concurrency=8)
+    log = []
+
+    async def handler(i):
+        log.append(('start', i))
+        await asyncio.sleep(0.01 * (5 - i))
+        log.append(('end', i))
+
+    async def run():
+        await asyncio.gather(*[p.do_process_update(update(1), handler(i)) for i in range(5)])
+
+    asyncio.run(run())
+    assert log == [(event, i) for i in range(5) for event in ('start', 'end')]
+    assert p.stats()['processed'] == 5
+    assert p.chats == {}
+
+
+def test_different_chats_run_concurrently_up_to_the_limit():
+    p = processor.ChatProcessor(concurrency=3)
+    running = []
+
+    async def handler():
+        running.append(p.running)
+        await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*[p.do_process_update(update(chat_id), handler()) for chat_id in range(6)])
+
+    asyncio.run(run())
+    assert max(running) == 3
+
+
+def test_chat_with_a_full_queue_drops_new_updates():
+    p = processor.ChatProcessor(concurrency=8, chat_queue=2)
+    handled = []
+
+    async def handler(i):
+        handled.append(i)
+        await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*[p.do_process_update(update(1), handler(i)) for i in range(6)])
+
+    asyncio.run(run())
+    # one running and chat_queue waiting are let in, the next ones are dropped
+    assert handled == [0, 1, 2]
+    assert p.dropped == 3
+
+
+def test_updates_without_a_chat_are_not_serialized():
+    p = processor.ChatProcessor(concurrency=8)
+    started = []
+
+    async def handler(i):
+        started.append(i)
+        await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*[p.do_process_update(update(None), handler(i)) for i in range(3)])
+
+    asyncio.run(run())
+    assert sorted(started) == [0, 1, 2]
+    assert p.processed == 3
@@ -0,0 +1,133 @@
+import asyncio
+import os
+
+import pytest
+
+import cache
+import shared
+import storage
+from bench.kvserver import KVServer
+
+
+def with_server(test, **options):
+    """Runs test(backend, server) against a RedisBackend talking to a local bench.kvserver."""
+    async def run():
+        server = await KVServer().start()
+        backend = shared.RedisBackend(port=server.port, **options)
+        try:
+            return await test(backend, server)
+        finally:
+            await backend.close()
+            await server.stop()
+
+    return asyncio.run(run())
+
+
+def test_commands_round_trip():
+    async def test(backend, server):
+        await backend.set('a', 'значение')
+        await backend.set_many({'b': '2', 'c': '3'}, ttl=60)
+        added = await backend.add('a', 'other'), await backend.add('d', '4', ttl=60)
+        await backend.delete('c')
+        await backend.set_add('users', '1')
+        await backend.set_add('users', '2')
+        await backend.set_remove('users', '1')
+        return await backend.get('a'), await backend.get_many(['b', 'c', 'd', 'missing']), added, await backend.members('users')
+
+    value, values, added, members = with_server(test)
+    assert value == 'значение'
+    assert values == ['2', None, '4', None]
+    assert added == (False, True)
+    assert members == ['2']
+
+
+def test_keys_expire():
+    async def test(backend, server):
+        await backend.set('a', '1', ttl=0.05)
+        await backend.add('b', '1', ttl=0.05)
+        await asyncio.sleep(0.1)
+        return await backend.get('a'), await backend.add('b', '2'), await backend.get('b')
+
+    assert with_server(test) == (None, True, '2')
+
+
+def test_concurrent_calls_share_a_bounded_pool():
+    async def test(backend, server):
+        results = await asyncio.gather(*[backend.set(f'k{i}', str(i)) for i in range(50)])
+        return results, await backend.get_many([f'k{i}' for i in range(50)]), server.connections
+
+    results, values, connections = with_server(test, pool_size=4)
+    assert values == [str(i) for i in range(50)]
+    assert connections <= 4
+
+
+def test_dropped_connection_is_replaced():
+    async def test(backend, server):
+        await backend.set('a', '1')
+        # the server closes the idle connection, the next call retries on a fresh one
+        for conn in backend.idle:
+            conn.writer.transport.abort()
+        return await backend.get('a')
+
+    assert with_server(test) == '1'
+
+
+def test_unreachable_server_fails_within_the_timeout():
+    backend = shared.RedisBackend(port=1, timeout=0.2)
+
+    with pytest.raises(OSError):
+        asyncio.run(backend.get('a'))
+
+
+def test_shared_storage_users_and_values():
+    async def test(backend, server):
+        db = storage.SharedStorage(backend)
+        await db.put(1, {'token': 'a', 'student_id': '2'})
+        await db.put(3, {'token': 'b', 'student_id': '4'})
+        await db.delete(3)
+        await db.put_values('usage', {'1': {'schedule': [1]}}, ttl=60)
+        return await db.keys(), await db.get_many(['1', '3']), await db.get_values('usage', ['1', '2'])
+
+    keys, records, values = with_server(test)
+    assert keys == ['1']
+    assert records == {'1': {'token': 'a', 'student_id': '2'}}
+    assert values == {'1': {'schedule': [1]}}
+
+
+def test_workers_share_one_load():
+    async def test(backend, server):
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {'marks': [5, 4]}
+
+        workers = [cache.Cache(shared=backend) for _ in range(3)]
+        results = await asyncio.gather(*[worker.load(('marks', '2'), 60, loader) for worker in workers])
+        return results, len(calls)
+
+    results, calls = with_server(test)
+    assert results == [{'marks': [5, 4]}] * 3
+    assert calls == 1
+
+
+def test_migrate_sqlite_keeps_what_the_backend_has(tmp_path):
+    path = os.path.join(tmp_path, 'db.sqlite3')
+    local = storage.SQLiteStorage(path)
+    asyncio.run(local.put(1, {'token': 'old'}))
+    asyncio.run(local.put(5, {'token': 'local'}))
+    asyncio.run(local.put_values('usage', {'5': {'schedule': [1]}}))
+    asyncio.run(local.close())
+
+    async def test(backend, server):
+        db = storage.SharedStorage(backend)
+        await db.put(1, {'token': 'shared'})
+        migrated = await db.migrate_sqlite(path, os.path.join(tmp_path, 'db.json'))
+        return migrated, await db.get_many(await db.keys()), await db.get_values('usage', ['5'])
+
+    migrated, records, values = with_server(test)
+    assert migrated == 2
+    assert records == {'1': {'token': 'shared'}, '5': {'token': 'local'}}
+    assert values == {'5': {'schedule': [1]}}
+    assert os.path.exists(path + '.migrated')
@@ -0,0 +1,56 @@
+import asyncio
+import os
+
+import pytest
+
+import shared
+import state
+
+
+@pytest.fixture
+def prompts(clock, monkeypatch):
+    monkeypatch.setattr(state, 'time', clock)
+    return state.StateStore(ttl=60, max_entries=2)
+
+
+def test_entries_expire_after_the_sliding_ttl(prompts, clock):
+    asyncio.run(prompts.set(1, 100))
+    clock.advance(50)
+    # a read extends the ttl
+    assert asyncio.run(prompts.get(1)) == 100
+    clock.advance(50)
+    assert asyncio.run(prompts.has(1))
+    clock.advance(61)
+    assert asyncio.run(prompts.get(1)) is None
+
+
+def test_least_recently_used_entry_is_evicted(prompts):
+    asyncio.run(prompts.set(1, 100))
+    asyncio.run(prompts.set(2, 200))
+    asyncio.run(prompts.get(1))
+    asyncio.run(prompts.set(3, 300))
+
+    assert asyncio.run(prompts.has(1))
+    assert not asyncio.run(prompts.has(2))
+    assert prompts.stats() == {'live': 2, 'evictions': 1}
+
+
+def test_save_and_load_keep_live_entries(prompts, clock, tmp_path):
+    asyncio.run(prompts.set('1', 100))
+    path = os.path.join(tmp_path, 'token_messages.json')
+    prompts.save(path)
+
+    loaded = state.StateStore(ttl=60, max_entries=2)
+    loaded.load(path)
+    assert asyncio.run(loaded.pop('1')) == 100
+    assert asyncio.run(loaded.pop('1')) is None
+
+
+def test_shared_store_round_trip():
+    store = state.SharedStateStore('token_messages', shared.MemoryBackend(), ttl=60)
+
+    async def run():
+        await store.set(1, 100)
+        return await store.has(1), await store.pop(1), await store.has(1)
+
+    assert asyncio.run(run()) == (True, 100, False)
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+import sqlite3
+
+import storage
+
+
+def test_sqlite_upsert_and_delete(tmp_path):
+    db = storage.SQLiteStorage(os.path.join(tmp_path, 'db.sqlite3'))
+
+    async def run():
+        await db.put(1, {'token': 'a', 'student_id': '2'})
+        await db.put('1', {'token': 'b', 'student_id': '2'})
+        await db.put(3, {'token': 'c', 'student_id': '4'})
+        first = await db.get(1), sorted(await db.keys())
+        await db.delete(3)
+        return first, await db.get(3), await db.keys()
+
+    (record, keys), deleted, left = asyncio.run(run())
+    assert record == {'token': 'b', 'student_id': '2'}
+    assert keys == ['1', '3']
+    assert deleted is None
+    assert left == ['1']
+
+
+def test_sqlite_keeps_records_across_connections(tmp_path):
+    path = os.path.join(tmp_path, 'db.sqlite3')
+    db = storage.SQLiteStorage(path)
+    asyncio.run(db.put(1, {'token': 'токен', 'student_id': '2'}))
+    asyncio.run(db.close())
+
+    assert asyncio.run(storage.SQLiteStorage(path).get(1)) == {'token': 'токен', 'student_id': '2'}
+
+
+def test_migrate_json_imports_once(tmp_path):
+    json_path = os.path.join(tmp_path, 'db.json')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump({'1': {'token': 'a', 'student_id': '2'}, '5': {'token': 'b', 'student_id': '6'}}, f)
+    db = storage.SQLiteStorage(os.path.join(tmp_path, 'db.sqlite3'))
+    # a record already in SQLite wins over the old file
+    asyncio.run(db.put(1, {'token': 'new', 'student_id': '2'}))
+
+    assert db.migrate_json(json_path) == 2
+    assert not os.path.exists(json_path)
+    assert os.path.exists(json_path + '.migrated')
+    assert db.migrate_json(json_path) == 0
+    assert asyncio.run(db.get_many(['1', '5', '7'])) == {'1': {'token': 'new', 'student_id': '2'}, '5': {'token': 'b', 'student_id': '6'}}
+
+
+def test_token_db_caches_and_writes_through():
+    backend = storage.MemoryStorage()
+    db = storage.TokenDB(backend, cache_size=1)
+
+    async def run():
+        await db.set(1, {'token': 'a'})
+        backend.users['1'] = {'token': 'changed elsewhere'}
+        cached = await db.get(1)
+        # the cache holds one record, reading another one evicts the first
+        await db.set(2, {'token': 'b'})
+        return cached, await db.get(1), await db.get(3, 'missing'), await db.items()
+
+    cached, reread, missing, items = asyncio.run(run())
+    assert cached == {'token': 'a'}
+    assert reread == {'token': 'changed elsewhere'}
+    assert missing == 'missing'
+    assert sorted(items) == [('1', {'token': 'changed elsewhere'}), ('2', {'token': 'b'})]
+
+
+def test_values_expire_and_get_pruned(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(storage, 'time', clock)
+    for db in (storage.SQLiteStorage(os.path.join(tmp_path, 'db.sqlite3')), storage.MemoryStorage()):
+        async def run():
+            await db.put_values('homework', {'2:10': {'updated_at': 'x'}, '2:11': {'updated_at': 'y'}}, ttl=60)
+            await db.put_values('usage', {'1': {'schedule': [1]}})
+            # a rewrite replaces the value and its expiry
+            await db.put_values('homework', {'2:11': {'updated_at': 'z'}}, ttl=600)
+            clock.advance(61)
+            return await db.get_values('homework', ['2:10', '2:11', '2:12']), await db.get_values('usage', ['1']), await db.prune()
+
+        homework, usage, pruned = asyncio.run(run())
+        assert homework == {'2:11': {'updated_at': 'z'}}
+        assert usage == {'1': {'schedule': [1]}}
+        assert pruned == 1
+
+
+def test_old_kv_table_gets_expiry_and_loses_unkeyed_homework(tmp_path):
+    path = os.path.join(tmp_path, 'db.sqlite3')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE kv (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (namespace, key))')
+    conn.executemany('INSERT INTO kv VALUES (?, ?, ?)', [('homework', '10', '{}'), ('launch_url', '10/1', '"u"'), ('usage', '1', '{}')])
+    conn.commit()
+    conn.close()
+
+    db = storage.SQLiteStorage(path)
+    assert asyncio.run(db.get_values('homework', ['10'])) == {}
+    assert asyncio.run(db.get_values('launch_url', ['10/1'])) == {}
+    assert asyncio.run(db.get_values('usage', ['1'])) == {'1': {}}
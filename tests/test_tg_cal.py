@@ -0,0 +1,70 @@
+from datetime import date, datetime
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+
+import tg_cal
+
+
+class Bot():
+    def __init__(self) -> None:
+        self.calls = []
+
+    async def edit_message_text(self, text, chat_id, message_id, reply_markup=None, **kwargs):
+        self.calls.append(('edit', text, reply_markup))
+
+    async def delete_message(self, chat_id, message_id):
+        self.calls.append(('delete', chat_id, message_id))
+
+
+MSG = SimpleNamespace(chat_id=1, id=2)
+
+
+def buttons(markup):
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+
+def press(data, callbacks=None):
+    bot = Bot()
+    asyncio.run(tg_cal.handle_picker(MSG, bot, data, callbacks or {}))
+    return bot.calls
+
+
+@pytest.mark.parametrize('action', list(tg_cal.ACTION_CODES))
+def test_callback_data_fits_telegram_limit(action):
+    markup = tg_cal.month_keyboard(2024, 2, date(2024, 2, 10), date(2024, 2, 1), action)
+    assert all(len(data.encode()) <= 64 for data in buttons(markup))
+
+
+def test_first_date_reopens_the_picker_for_the_end_date():
+    (kind, text, markup), = press('pk:d:h:-:20240210')
+
+    assert kind == 'edit'
+    assert text == tg_cal.picker_text(True)
+    days = [data for data in buttons(markup) if data.startswith('pk:d:')]
+    # days before the first one can't be picked as the end
+    assert days[0] == 'pk:d:h:20240210:20240210'
+    assert 'pk:d:h:20240210:20240209' not in days
+
+
+def test_second_date_calls_the_action():
+    called = []
+
+    async def homework(msg, bot, date1, date2):
+        called.append((msg, date1, date2))
+
+    assert press('pk:d:h:20240210:20240215', {'homework': homework}) == []
+    assert called == [(MSG, datetime(2024, 2, 10), datetime(2024, 2, 15))]
+
+
+def test_navigation_keeps_the_first_date():
+    (_, text, markup), = press('pk:n:si:202403:20240210')
+
+    assert text == tg_cal.picker_text(True)
+    assert 'pk:n:si:202402:20240210' in buttons(markup)
+    assert 'pk:n:si:202404:20240210' in buttons(markup)
+
+
+def test_close_deletes_the_picker():
+    assert press('pk:x') == [('delete', 1, 2)]
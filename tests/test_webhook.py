@@ -0,0 +1,48 @@
+import asyncio
+
+from aiohttp import web
+import aiohttp
+
+import webhook
+
+
+def post_all(server: webhook.Webhook, *headers) -> list:
+    """Status of a POST of an empty update with each of the headers, against a running server."""
+    async def run():
+        runner = web.AppRunner(server.app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f'http://127.0.0.1:{runner.addresses[0][1]}/telegram'
+        try:
+            async with aiohttp.ClientSession() as session:
+                statuses = []
+                for h in headers:
+                    async with session.post(url, data=b'{}', headers=h) as response:
+                        statuses.append(response.status)
+                return statuses
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_wrong_or_missing_secret_is_rejected():
+    server = webhook.Webhook(None, 'secret')
+
+    assert post_all(server, {}, {webhook.SECRET_HEADER: 'wrong'}) == [403, 403]
+    assert server.rejected == 2
+
+
+def test_non_ascii_secret_is_rejected_not_an_error():
+    server = webhook.Webhook(None, 'secret')
+
+    assert post_all(server, {webhook.SECRET_HEADER: 'секрет'}, {webhook.SECRET_HEADER: 'sécret'}) == [403, 403]
+
+
+def test_right_secret_passes_the_check():
+    server = webhook.Webhook(None, 'secret')
+
+    # not started yet, so the update is turned away after the secret check
+    assert post_all(server, {webhook.SECRET_HEADER: 'secret'}) == [503]
+    assert server.rejected == 0
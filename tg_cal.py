@@ -1,66 +1,78 @@
-from datetime import datetime
+from datetime import datetime, date
+from functools import lru_cache
 import calendar
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot, Message
 from dateutil.relativedelta import relativedelta
 
 
-class Calendar():
-    def __init__(self, msg, callback, bot: Bot) -> None:
-        self.callback = callback
-        self.msg_text = 'Выберите начальную дату'
-        self.msg: Message = msg
-        self.date = datetime.today()
-        self.date1 = None
-        self.bot: Bot = bot
+# Stateless picker: the month, the first chosen date and the action live in callback_data
+# ("pk:n:<action>:<yyyymm>:<first>" to navigate, "pk:d:<action>:<first>:<date>" to pick, "pk:x" to close),
+# so any press can be handled without server-side state.
+PICKER_PREFIX = 'pk:'
+ACTION_CODES = {
+    'schedule': 's',
+    'homework': 'h',
+    'marksdate': 'm',
+    'export_schedule_ics': 'si',
+    'export_schedule_csv': 'sc',
+    'export_homework_ics': 'hi',
+    'export_homework_csv': 'hc'
+}
+ACTIONS = {v: k for k, v in ACTION_CODES.items()}
 
-    @classmethod
-    async def create(cls, msg, callback, bot):
-        self = Calendar(msg, callback, bot)
-        await self.setup_buttons()
-        return self
 
-    async def setup_buttons(self):
-        btns = [[InlineKeyboardButton(self.date.strftime('%B %Y'), callback_data='ignore')]]
-        day_names = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
-        btns.append([InlineKeyboardButton(x, callback_data='ignore') for x in day_names])
-        cal = calendar.monthcalendar(self.date.year, self.date.month)
-        today = datetime.today()
-        for week in cal:
-            week_btns = []
-            for day in week:
-                if day == 0:
-                    week_btns.append(InlineKeyboardButton(' ', callback_data='ignore'))
-                else:
-                    this_date = datetime(day=day, month=self.date.month, year=self.date.year)
-                    if self.date1 and this_date < self.date1:
-                        week_btns.append(InlineKeyboardButton(' ', callback_data='ignore'))
-                    else:
-                        txt = str(day)
-                        if day == today.day and self.date.month == today.month and self.date.year == today.year:
-                            txt = '[' + txt + ']'
-                        week_btns.append(InlineKeyboardButton(txt, callback_data=f'date {self.date.year}/{self.date.month}/{day}'))
-            btns.append(week_btns)
+def picker_text(first) -> str:
+    return 'Выберите конечную дату' if first else 'Выберите начальную дату'
 
-        btns.append([InlineKeyboardButton('◀️', callback_data='cal_left'), InlineKeyboardButton(
-            '❌', callback_data='cal_close'), InlineKeyboardButton('▶️', callback_data='cal_right')])
 
-        await self.bot.edit_message_text(self.msg_text, self.msg.chat_id, self.msg.id, reply_markup=InlineKeyboardMarkup(btns))
+@lru_cache(maxsize=256)
+def month_keyboard(year, month, first: date, today: date, action) -> InlineKeyboardMarkup:
+    code = ACTION_CODES[action]
+    first_str = first.strftime('%Y%m%d') if first else '-'
 
-    async def forward(self):
-        self.date += relativedelta(months=1)
-        await self.setup_buttons()
+    btns = [[InlineKeyboardButton(date(year, month, 1).strftime('%B %Y'), callback_data='ignore')]]
+    day_names = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+    btns.append([InlineKeyboardButton(x, callback_data='ignore') for x in day_names])
+    for week in calendar.monthcalendar(year, month):
+        week_btns = []
+        for day in week:
+            if day == 0 or (first and date(year, month, day) < first):
+                week_btns.append(InlineKeyboardButton(' ', callback_data='ignore'))
+            else:
+                txt = f'[{day}]' if date(year, month, day) == today else str(day)
+                week_btns.append(InlineKeyboardButton(txt, callback_data=f'{PICKER_PREFIX}d:{code}:{first_str}:{year}{month:02}{day:02}'))
+        btns.append(week_btns)
 
-    async def backward(self):
-        self.date -= relativedelta(months=1)
-        await self.setup_buttons()
+    prev_month = date(year, month, 1) - relativedelta(months=1)
+    next_month = date(year, month, 1) + relativedelta(months=1)
+    btns.append([InlineKeyboardButton('◀️', callback_data=f'{PICKER_PREFIX}n:{code}:{prev_month.strftime("%Y%m")}:{first_str}'),
+                 InlineKeyboardButton('❌', callback_data=f'{PICKER_PREFIX}x'),
+                 InlineKeyboardButton('▶️', callback_data=f'{PICKER_PREFIX}n:{code}:{next_month.strftime("%Y%m")}:{first_str}')])
 
-    async def close(self):
-        await self.bot.delete_message(self.msg.chat_id, self.msg.id)
+    return InlineKeyboardMarkup(btns)
 
-    async def on_date(self, date):
-        if self.date1 is None:
-            self.date1 = date
-            self.msg_text = 'Выберите конечную дату'
-            await self.setup_buttons()
-        else:
-            await self.callback(self.msg, self.bot, self.date1, date)
+
+async def open_picker(bot: Bot, chat_id, message_id, action, year=None, month=None, first: date = None) -> None:
+    today = date.today()
+    keyboard = month_keyboard(year or today.year, month or today.month, first, today, action)
+    await bot.edit_message_text(picker_text(first), chat_id, message_id, reply_markup=keyboard)
+
+
+async def handle_picker(msg: Message, bot: Bot, data, callbacks) -> None:
+    """Handles a "pk:" button press; callbacks maps action names to `async def f(msg, bot, date1, date2)`."""
+    parts = data[len(PICKER_PREFIX):].split(':')
+
+    match parts[0]:
+        case 'x':
+            await bot.delete_message(msg.chat_id, msg.id)
+        case 'n':
+            _, code, month, first = parts
+            first = datetime.strptime(first, '%Y%m%d').date() if first != '-' else None
+            await open_picker(bot, msg.chat_id, msg.id, ACTIONS[code], int(month[:4]), int(month[4:]), first)
+        case 'd':
+            _, code, first, chosen = parts
+            chosen = datetime.strptime(chosen, '%Y%m%d')
+            if first == '-':
+                await open_picker(bot, msg.chat_id, msg.id, ACTIONS[code], chosen.year, chosen.month, chosen.date())
+            else:
+                await callbacks[ACTIONS[code]](msg, bot, datetime.strptime(first, '%Y%m%d'), chosen)
@@ -0,0 +1,112 @@
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+import asyncio
+import hmac
+import json
+import signal
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class Webhook():
+    """Embedded HTTP server that takes updates from Telegram instead of Application.run_polling.
+
+    POST <path> - an Update as JSON, accepted only with the secret token set in setWebhook
+    GET /healthz - the process is alive
+    GET /readyz - the application is started and takes updates (503 while starting and shutting down),
+                  so a load balancer stops sending updates to an instance before it stops
+    """
+
+    def __init__(self, application: Application, secret_token, path='/telegram') -> None:
+        self.application = application
+        self.secret_token = secret_token
+        self.path = path
+        self.ready = False
+        self.received = 0
+        self.rejected = 0
+
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get('/healthz', self.handle_health)
+        self.app.router.add_get('/readyz', self.handle_ready)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        # compared as bytes: compare_digest refuses str with non-ASCII characters, which anyone can send
+        secret = request.headers.get(SECRET_HEADER, '').encode('utf-8', 'surrogateescape')
+        if not hmac.compare_digest(secret, self.secret_token.encode('utf-8')):
+            self.rejected += 1
+            return web.Response(status=403)
+        if not self.ready:
+            # Telegram retries the update later, maybe on another instance
+            return web.Response(status=503)
+
+        try:
+            update = Update.de_json(json.loads(await request.text()), self.application.bot)
+        except Exception as e:
+            print(f'Bad update: {e}')
+            self.rejected += 1
+            return web.Response(status=400)
+
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.Response(text='ok')
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        if self.ready and self.application.running:
+            return web.Response(text='ready')
+        return web.Response(status=503, text='not ready')
+
+    def stats(self) -> dict:
+        return {'ready': int(self.ready), 'received': self.received, 'rejected': self.rejected}
+
+
+async def serve(application: Application, webhook: Webhook, url=None, listen='0.0.0.0', port=8080,
+                drop_pending_updates=False, stop: asyncio.Event = None) -> None:
+    """Runs the application behind the webhook server until `stop` is set.
+
+    Does what run_polling does around the update source: initialize, post_init, start, and stop, shutdown,
+    post_shutdown. With `url` set, registers <url><path> with Telegram; several instances behind one load balancer
+    register the same url, and none of them deletes it on shutdown.
+    """
+    stop = stop or asyncio.Event()
+
+    runner = web.AppRunner(webhook.app)
+    await runner.setup()
+    # healthz answers while the bot is still starting
+    await web.TCPSite(runner, listen, port).start()
+
+    try:
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        if url:
+            await application.bot.set_webhook(url + webhook.path, secret_token=webhook.secret_token,
+                                              allowed_updates=Update.ALL_TYPES, drop_pending_updates=drop_pending_updates)
+        await application.start()
+        webhook.ready = True
+        print(f'Webhook listening on {listen}:{port}{webhook.path}')
+
+        await stop.wait()
+    finally:
+        webhook.ready = False
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await runner.cleanup()
+
+
+def run(application: Application, webhook: Webhook, **kwargs) -> None:
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await serve(application, webhook, stop=stop, **kwargs)
+
+    asyncio.run(main())